@@ -10,8 +10,10 @@ import unicorn
 
 from .disasm import init_disassembler
 from ..smtlib import BitVec, Operators, Constant
+from ..smtlib.guard import oversized, oversized_policy, abstract
 from ..memory import ConcretizeMemory, InvalidMemoryAccess
 from ...utils.helpers import issymbolic
+from ...utils.cache import LRUCache
 from ...utils.emulate import UnicornEmulator
 from ...utils.event import Eventful
 
@@ -467,9 +469,11 @@ class Cpu(Eventful):
         super().__init__(**kwargs)
         self._regfile = regfile
         self._memory = memory
-        self._instruction_cache = {}
+        self._instruction_cache = LRUCache('instructions', 100000, 'Maximum number of decoded instructions kept per cpu')
         self._icount = 0
         self._last_pc = None
+        # Oversized locations to concretize, see _guard_value
+        self._oversized = []
         if not hasattr(self, "disasm"):
             self.disasm = init_disassembler(self._disasm, self.arch, self.mode)
         # Ensure that regfile created STACK/PC aliases
@@ -483,6 +487,7 @@ class Cpu(Eventful):
         state['icount'] = self._icount
         state['last_pc'] = self._last_pc
         state['disassembler'] = self._disasm
+        state['oversized'] = self._oversized
         return state
 
     def __setstate__(self, state):
@@ -492,6 +497,7 @@ class Cpu(Eventful):
         self._icount = state['icount']
         self._last_pc = state['last_pc']
         self._disasm = state['disassembler']
+        self._oversized = state.get('oversized', [])
         super().__setstate__(state)
 
     @property
@@ -536,6 +542,8 @@ class Cpu(Eventful):
         :type value: int or long or :obj:`Expression`
         '''
         self._publish('will_write_register', register, value)
+        if oversized(value):
+            value = self._guard_value(value, 'register', register)
         value = self._regfile.write(register, value)
         self._publish('did_write_register', register, value)
         return value
@@ -580,6 +588,32 @@ class Cpu(Eventful):
         except AttributeError:
             object.__setattr__(self, name, value)
 
+    def _guard_value(self, value, place, location):
+        '''
+        Handle an oversized value written to a register (`location` is its
+        name) or to memory (`location` is (address, size)).
+
+        With the 'abstract' policy it returns a fresh variable to write
+        instead. Otherwise it returns value and the location is concretized
+        when the instruction is done, one location at a time.
+        '''
+        policy = oversized_policy(place, value)
+        constraints = getattr(self._memory, 'constraints', None)
+        if policy == 'abstract' and constraints is not None:
+            return abstract(constraints, value)
+        if policy == 'abstract':
+            policy = 'ONE'
+        self._oversized.append((place, location, policy))
+        return value
+
+    def _concretize_oversized(self):
+        place, location, policy = self._oversized.pop(0)
+        if place == 'register':
+            raise ConcretizeRegister(self, location, "Concretizing oversized {}".format(location), policy=policy)
+        address, size = location
+        raise ConcretizeMemory(self._memory, address, size,
+                               "Concretizing oversized memory at {:#x}".format(address), policy=policy)
+
     #############################
     # Memory access
     @property
@@ -600,6 +634,8 @@ class Cpu(Eventful):
             size = self.address_bit_size
         assert size in SANE_SIZES
         self._publish('will_write_memory', where, expression, size)
+        if oversized(expression) and not issymbolic(where):
+            expression = self._guard_value(expression, 'memory', (where, size))
 
         data = [Operators.CHR(Operators.EXTRACT(expression, offset, 8)) for offset in range(0, size, 8)]
         self._memory.write(where, data, force)
@@ -843,6 +879,10 @@ class Cpu(Eventful):
         if issymbolic(self.PC):
             raise ConcretizeRegister(self, 'PC', policy='ALL')
 
+        # Left from the previous instruction
+        if self._oversized:
+            self._concretize_oversized()
+
         if not self.memory.access_ok(self.PC, 'x'):
             raise InvalidMemoryAccess(self.PC, 'x')
 
@@ -881,6 +921,8 @@ class Cpu(Eventful):
             raise e
         else:
             self._publish_instruction_as_executed(insn)
+            if self._oversized:
+                self._concretize_oversized()
 
     # FIXME(yan): In the case the instruction implementation invokes a system call, we would not be able to
     # publish the did_execute_instruction event from here, so we capture and attach it to the syscall
@@ -1,5 +1,8 @@
 
+import collections
+import multiprocessing
 import os
+import queue
 import random
 import logging
 import signal
@@ -7,11 +10,12 @@ import signal
 from ..exceptions import ExecutorError, SolverException
 from ..utils.nointerrupt import WithKeyboardInterruptAs
 from ..utils.event import Eventful
-from ..utils import config
-from .smtlib import Z3Solver, Expression
+from ..utils import config, cache
+from .smtlib import ConfiguredSolver, Expression, query_cache, solver_stats
+from .smtlib.guard import guard_stats
 from .state import Concretize, TerminateState
 
-from .workspace import Workspace
+from .workspace import Workspace, page_stats
 from multiprocessing.managers import SyncManager
 from contextlib import contextmanager
 
@@ -19,6 +23,8 @@ from contextlib import contextmanager
 
 consts = config.get_group('executor')
 consts.add('seed', default=1337, description='The seed to use when randomly selecting states')
+consts.add('keep_forked_state', default=True,
+           description='Continue running one of the states forked by a worker in memory instead of saving it to the workspace and loading it back')
 
 
 def mgr_init():
@@ -79,6 +85,11 @@ class Policy(object):
             self.context has a dict mapping state_ids -> summarize(state)'''
         raise NotImplementedError
 
+    def keep(self, state, solutions):
+        ''' Index of the solution in `solutions` whose fork of `state` the
+            worker continues running in memory, None to enqueue them all '''
+        return None
+
 
 class Random(Policy):
     def __init__(self, executor, *args, **kwargs):
@@ -88,6 +99,9 @@ class Random(Policy):
     def choice(self, state_ids):
         return random.choice(state_ids)
 
+    def keep(self, state, solutions):
+        return random.randrange(len(solutions))
+
 
 class Uncovered(Policy):
     def __init__(self, executor, *args, **kwargs):
@@ -163,6 +177,118 @@ class BranchLimited(Policy):
             return None
 
 
+class StateQueues(object):
+    '''
+    Queues of the ids of the states waiting to run, with work stealing.
+
+    The worker running in each process keeps the states it forks in a local
+    deque and picks the next one from it with the policy, no IPC involved.
+    A worker without states counts itself as idle in shared memory and waits
+    on a pipe, where busy workers hand over their oldest states when they see
+    idle ones. States put out of a worker (initial or loaded states) go
+    through that pipe too.
+
+    A shared count of the states queued anywhere or being run detects the
+    end of the exploration: when it is 0 no worker can fork a new state.
+    '''
+
+    # Seconds an idle worker waits for a state before checking for termination
+    POLL_INTERVAL = 0.05
+
+    def __init__(self):
+        self._pool = multiprocessing.Queue()
+        # Guards the updates of the counters below, they are read without it
+        self._counters_lock = multiprocessing.Lock()
+        # States queued anywhere or being run
+        self._outstanding = multiprocessing.RawValue('i', 0)
+        # States in the pool
+        self._pooled = multiprocessing.RawValue('i', 0)
+        # Workers waiting for a state
+        self._idle = multiprocessing.RawValue('i', 0)
+        # Queue of the worker in this process, None out of a worker
+        self._local = None
+
+    def _add(self, counter, value):
+        with self._counters_lock:
+            counter.value += value
+
+    def _to_pool(self, state_id):
+        self._add(self._pooled, 1)
+        self._pool.put(state_id)
+
+    def start_worker(self):
+        self._local = collections.deque()
+
+    def stop_worker(self):
+        ''' Hand the states left in the local queue (on shutdown) over to the pool '''
+        local, self._local = self._local, None
+        for state_id in local:
+            self._to_pool(state_id)
+
+    def put(self, state_id):
+        self._add(self._outstanding, 1)
+        if self._local is None:
+            self._to_pool(state_id)
+        else:
+            self._local.append(state_id)
+            self._share()
+
+    def _share(self):
+        ''' Hand states over to the idle workers, keeping one '''
+        local = self._local
+        wanted = self._idle.value - self._pooled.value
+        while wanted > 0 and len(local) > 1:
+            self._to_pool(local.popleft())
+            wanted -= 1
+
+    def get(self, choice, is_shutdown):
+        '''
+        The id of the next state for this worker to run, None when there are
+        no more or a shutdown was requested.
+
+        :param choice: the policy choice, picks an id out of a list of them
+        :param is_shutdown: callable telling whether to stop
+        '''
+        local = self._local
+        idle = False
+        try:
+            while not is_shutdown():
+                if local:
+                    self._share()
+                    state_id = choice(list(local))
+                    if state_id is not None:
+                        local.remove(state_id)
+                    return state_id
+
+                if not idle:
+                    self._add(self._idle, 1)
+                    idle = True
+                try:
+                    state_id = self._pool.get(timeout=self.POLL_INTERVAL)
+                except queue.Empty:
+                    if self._outstanding.value == 0:
+                        return None
+                    continue
+                self._add(self._pooled, -1)
+                return state_id
+            return None
+        finally:
+            if idle:
+                self._add(self._idle, -1)
+
+    def done(self):
+        ''' A state returned by get finished running (forked or terminated) '''
+        self._add(self._outstanding, -1)
+
+    def list(self):
+        ''' The ids of the queued states. Only exact while no worker runs '''
+        state_ids = list(self._local or ())
+        pooled = [self._pool.get() for _ in range(self._pooled.value)]
+        for state_id in pooled:
+            self._pool.put(state_id)
+        return state_ids + pooled
+
+
 class Executor(Eventful):
     '''
     The executor guides the execution of a single state, handles state forking
@@ -190,14 +316,17 @@ class Executor(Eventful):
         # Shutdown Event
         self._shutdown = self.manager.Event()
 
-        # States on storage. Shared dict state name ->  state stats
-        self._states = self.manager.list()
+        # Ids of the states on storage waiting to run
+        self._states = StateQueues()
 
         # Number of currently running workers. Initially no running workers
         self._running = self.manager.Value('i', 0)
 
         self._workspace = Workspace(self._lock, store)
 
+        # Solver queries before this mark are already accounted to some state
+        self._solver_stats_mark = solver_stats.mark()
+
         # Executor wide shared context
         if context is None:
             context = {}
@@ -272,7 +401,7 @@ class Executor(Eventful):
             return False
 
         for id in loaded_state_ids:
-            self._states.append(id)
+            self._states.put(id)
 
         return True
 
@@ -308,42 +437,35 @@ class Executor(Eventful):
 
     ###############################################
     # Priority queue
-    @sync
     def put(self, state_id):
         ''' Enqueue it for processing '''
-        self._states.append(state_id)
-        self._lock.notify_all()
+        self._states.put(state_id)
         return state_id
 
-    @sync
     def get(self):
-        ''' Dequeue a state with the max priority '''
-
-        # A shutdown has been requested
-        if self.is_shutdown():
-            return None
-
-        # if not more states in the queue, let's wait for some forks
-        while len(self._states) == 0:
-            # if no worker is running, bail out
-            if self.running == 0:
-                return None
-            # if a shutdown has been requested, bail out
-            if self.is_shutdown():
-                return None
-            # if there ares actually some workers running, wait for state forks
-            logger.debug("Waiting for available states")
-            self._lock.wait()
-
-        state_id = self._policy.choice(list(self._states))
-        if state_id is None:
-            return None
-        del self._states[self._states.index(state_id)]
-        return state_id
+        ''' Dequeue a state with the max priority, waiting for forks of
+            other workers if needed '''
+        return self._states.get(self._policy.choice, self.is_shutdown)
 
     def list(self):
         ''' Returns the list of states ids currently queued '''
-        return list(self._states)
+        return self._states.list()
+
+    def _account_solver_stats(self, state):
+        '''
+        Add the solver queries made since the last call to the totals kept in
+        the context of `state`, so each state knows what its path cost.
+        '''
+        mark = solver_stats.mark()
+        totals = solver_stats.totals(self._solver_stats_mark)
+        self._solver_stats_mark = mark
+        if state is None or not totals:
+            return
+        # Replace instead of update, forked states share the context values
+        stats = dict(state.context.get('solver_stats', {}))
+        for name, value in totals.items():
+            stats[name] = stats.get(name, 0) + value
+        state.context['solver_stats'] = stats
 
     def generate_testcase(self, state, message='Testcase generated'):
         '''
@@ -376,6 +498,17 @@ class Executor(Eventful):
         The optional setstate() function is supposed to set the concrete value
         in the child state.
 
+        '''
+        return self._fork(state, expression, policy, setstate)[0]
+
+    def _fork(self, state, expression, policy='ALL', setstate=None, keep=False):
+        '''
+        Like :meth:`fork`, but with `keep` the child chosen by
+        :meth:`Policy.keep` is not enqueued. `state` itself becomes that child
+        instead, so it runs on without being saved and loaded back.
+
+        :return: the state to continue with (None if every child was enqueued)
+            and its new id (None if it is still `state`)
         '''
         assert isinstance(expression, Expression)
 
@@ -384,13 +517,14 @@ class Executor(Eventful):
 
         # Find a set of solutions for expression
         solutions = state.concretize(expression, policy)
+        self._account_solver_stats(state)
 
         if not solutions:
             raise ExecutorError("Forking on unfeasible constraint set")
 
         if len(solutions) == 1:
             setstate(state, solutions[0])
-            return state
+            return state, None
 
         logger.info("Forking. Policy: %s. Values: %s",
                     policy,
@@ -398,25 +532,42 @@ class Executor(Eventful):
 
         self._publish('will_fork_state', state, expression, solutions, policy)
 
-        # Build and enqueue a state for each solution
+        kept = self._policy.keep(state, solutions) if keep else None
+
+        # Build and enqueue a state for each solution, as deltas of state
         children = []
-        for new_value in solutions:
-            with state as new_state:
-                new_state.constrain(expression == new_value)
+        with self._workspace.snapshot(state):
+            for index, new_value in enumerate(solutions):
+                if index == kept:
+                    continue
+                with state as new_state:
+                    new_state.constrain(expression == new_value)
 
-                # and set the PC of the new state to the concrete pc-dest
-                #(or other register or memory address to concrete)
-                setstate(new_state, new_value)
+                    # and set the PC of the new state to the concrete pc-dest
+                    #(or other register or memory address to concrete)
+                    setstate(new_state, new_value)
 
-                self._publish('did_fork_state', new_state, expression, new_value, policy)
+                    self._publish('did_fork_state', new_state, expression, new_value, policy)
 
-                # enqueue new_state
-                state_id = self.enqueue(new_state)
-                # maintain a list of children for logging purpose
-                children.append(state_id)
+                    # enqueue new_state
+                    state_id = self.enqueue(new_state)
+                    # maintain a list of children for logging purpose
+                    children.append(state_id)
 
-        logger.info("Forking current state into states %r", children)
-        return None
+        if kept is None:
+            logger.info("Forking current state into states %r", children)
+            return None, None
+
+        # The children share the platform of state, so the kept one is set
+        # up after all the others are saved
+        new_value = solutions[kept]
+        state.constrain(expression == new_value)
+        setstate(state, new_value)
+        self._publish('did_fork_state', state, expression, new_value, policy)
+        state_id = self._workspace.new_state_id()
+
+        logger.info("Forking current state into states %r, continuing with %r", children, state_id)
+        return state, state_id
 
     def run(self):
         '''
@@ -432,28 +583,35 @@ class Executor(Eventful):
             self._notify_start_run()
 
             logger.debug("Starting Manticore Symbolic Emulator Worker (pid %d).", os.getpid())
-            solver = Z3Solver()
+            solver = ConfiguredSolver()
+            query_cache_stats = query_cache.stats
+            run_cache_stats = cache.stats()
+            run_guard_stats = dict(guard_stats)
+            run_page_stats = dict(page_stats)
+            run_solver_stats = solver_stats.mark()
+            self._solver_stats_mark = run_solver_stats
+            self._states.start_worker()
+            # Whether a state got from the queues is still running
+            running_state = False
             while not self.is_shutdown():
                 try:  # handle fatal errors: exceptions in Manticore
                     try:  # handle external (e.g. solver) errors, and executor control exceptions
                         # select a suitable state to analyze
                         if current_state is None:
-                            with self._lock:
-                                # notify siblings we are about to stop this run
-                                self._notify_stop_run()
-                                try:
-                                    # Select a single state_id
-                                    current_state_id = self.get()
-                                    # load selected state from secondary storage
-                                    if current_state_id is not None:
-                                        self._publish('will_load_state', current_state_id)
-                                        current_state = self._workspace.load_state(current_state_id)
-                                        self.forward_events_from(current_state, True)
-                                        self._publish('did_load_state', current_state, current_state_id)
-                                        logger.info("load state %r", current_state_id)
-                                    # notify siblings we have a state to play with
-                                finally:
-                                    self._notify_start_run()
+                            if running_state:
+                                self._states.done()
+                                running_state = False
+                            # Select a single state_id
+                            current_state_id = self.get()
+                            # load selected state from secondary storage
+                            if current_state_id is not None:
+                                running_state = True
+                                self._publish('will_load_state', current_state_id)
+                                current_state = self._workspace.load_state(current_state_id)
+                                self._account_solver_stats(None)
+                                self.forward_events_from(current_state, True)
+                                self._publish('did_load_state', current_state, current_state_id)
+                                logger.info("load state %r", current_state_id)
 
                         # If current_state is still None. We are done.
                         if current_state is None:
@@ -469,6 +627,7 @@ class Executor(Eventful):
                                 break
                         else:
                             # Notify this worker is done
+                            self._account_solver_stats(current_state)
                             self._publish('will_terminate_state', current_state, current_state_id, 'Shutdown')
                             current_state = None
 
@@ -478,10 +637,18 @@ class Executor(Eventful):
                         # policy
                         # setstate()
                         logger.debug("Generic state fork on condition")
-                        current_state = self.fork(current_state, e.expression, e.policy, e.setstate)
+                        current_state, state_id = self._fork(current_state, e.expression, e.policy, e.setstate,
+                                                             keep=consts.keep_forked_state)
+                        # Continue with a child kept in memory as if it was loaded
+                        if state_id is not None:
+                            current_state_id = state_id
+                            self._publish('will_load_state', current_state_id)
+                            self._publish('did_load_state', current_state, current_state_id)
+                            logger.info("continue with state %r", current_state_id)
 
                     except TerminateState as e:
                         # Notify this worker is done
+                        self._account_solver_stats(current_state)
                         self._publish('will_terminate_state', current_state, current_state_id, e)
 
                         logger.debug("Generic terminate state")
@@ -496,6 +663,7 @@ class Executor(Eventful):
                         logger.error("Exception: %s\n%s", str(e), trace)
 
                         # Notify this state is done
+                        self._account_solver_stats(current_state)
                         self._publish('will_terminate_state', current_state, current_state_id, e)
 
                         if solver.check(current_state.constraints):
@@ -513,6 +681,49 @@ class Executor(Eventful):
                     logger.setState(None)
 
             assert current_state is None or self.is_shutdown()
+            if running_state:
+                self._states.done()
+            self._states.stop_worker()
+            self._workspace.release_snapshot()
+
+            # Aggregate what this worker got out of the solver query cache
+            if query_cache.hits + query_cache.misses > query_cache_stats['hits'] + query_cache_stats['misses']:
+                with self.locked_context('query_cache', dict) as stats:
+                    for name, value in query_cache.stats.items():
+                        if name != 'size':
+                            value -= query_cache_stats[name]
+                        stats[name] = stats.get(name, 0) + value
+                logger.info("Solver query cache: %r", query_cache.stats)
+
+            # Aggregate the effectiveness of the caches used by this worker
+            report = cache.stats(since=run_cache_stats)
+            with self.locked_context('cache_stats', dict) as stats:
+                cache.merge(stats, report)
+            if cache.consts.log_stats:
+                cache.log_stats(report, logger)
+
+            # Aggregate the oversized values found by this worker
+            oversized = {key: count - run_guard_stats.get(key, 0) for key, count in guard_stats.items()
+                         if count != run_guard_stats.get(key, 0)}
+            if oversized:
+                with self.locked_context('oversized_values', dict) as stats:
+                    for key, count in oversized.items():
+                        stats[key] = stats.get(key, 0) + count
+                logger.info("Oversized values: %r", oversized)
+
+            # Aggregate the memory pages this worker saved to the workspace
+            pages = {key: count - run_page_stats.get(key, 0) for key, count in page_stats.items()
+                     if count != run_page_stats.get(key, 0)}
+            if pages:
+                with self.locked_context('workspace_stats', dict) as stats:
+                    for key, count in pages.items():
+                        stats[key] = stats.get(key, 0) + count
+
+            # Aggregate the solver queries made by this worker
+            report = solver_stats.report(run_solver_stats)
+            if report['callers']:
+                with self.locked_context('solver_stats', dict) as stats:
+                    solver_stats.merge(stats, report)
 
             # notify siblings we are about to stop this run
             self._notify_stop_run()
@@ -1,3 +1,5 @@
+import itertools
+import pickle
 from abc import ABCMeta, abstractmethod
 from weakref import WeakValueDictionary
 from .smtlib import Operators, ConstraintSet, arithmetic_simplify, solver, TooManySolutions, BitVec, BitVecConstant
@@ -94,6 +96,9 @@ class Map(object, metaclass=ABCMeta):
 
     '''
 
+    # Concrete maps are pickled in pages of 2**_page_bits bytes
+    _page_bits = 12
+
     def __init__(self, start, size, perms, name=None):
         '''
         Abstract memory map.
@@ -240,6 +245,31 @@ class Map(object, metaclass=ABCMeta):
         '''
 
 
+def _anonmap_from_pages(cls, start, size, perms, pages):
+    ''' Unpickle a map saved by :meth:`AnonMap.__reduce__` '''
+    anonmap = cls(start, size, perms)
+    anonmap._data[:] = b''.join(pages)
+    # Pickling the map again refers to the same pages
+    anonmap._pages = list(pages)
+    return anonmap
+
+
+def _anonmap_from_buffer(cls, start, size, perms, data):
+    ''' Unpickle a map saved by :meth:`AnonMap.__reduce_ex__`, taking over `data` '''
+    anonmap = cls(start, size, perms)
+    anonmap._data = data if type(data) is bytearray else bytearray(data)
+    return anonmap
+
+
+def _filemap_from_pages(cls, start, size, perms, filename, offset, pages):
+    ''' Unpickle a map saved by :meth:`FileMap.__reduce__` '''
+    overlay = itertools.chain.from_iterable(zip(offsets, values) for offsets, values in pages)
+    filemap = cls(start, size, perms, filename, offset, overlay)
+    # Pickling the map again refers to the same pages
+    filemap._overlay_pages = {offsets[0] >> cls._page_bits: (offsets, values) for offsets, values in pages}
+    return filemap
+
+
 class AnonMap(Map):
     ''' A concrete anonymous memory map '''
 
@@ -254,6 +284,10 @@ class AnonMap(Map):
         '''
         super().__init__(start, size, perms, **kwargs)
         self._data = bytearray(size)
+        # Writes since the map was built, to tell it changed
+        self._version = 0
+        # Pages of the data as bytes (None if written since), built when pickled
+        self._pages = None
         if data_init is not None:
             assert len(data_init) <= size, 'More initial data than reserved memory'
             # check that the values this slice points to are ints
@@ -263,7 +297,28 @@ class AnonMap(Map):
                 self._data[0:len(data_init)] = [ord(s) for s in data_init]
 
     def __reduce__(self):
-        return (self.__class__, (self.start, len(self), self.perms, self._data, ))
+        # The pages not written since the last pickle are the same objects,
+        # so deltas of a snapshot (see manticore.core.snapshot) share them
+        pages = self._pages
+        if pages is None:
+            pages = self._pages = [None] * ((len(self) - 1 >> self._page_bits) + 1)
+        data = self._data
+        for page, page_data in enumerate(pages):
+            if page_data is None:
+                pages[page] = bytes(data[page << self._page_bits:page + 1 << self._page_bits])
+        return (_anonmap_from_pages, (self.__class__, self.start, len(self), self.perms, tuple(pages)))
+
+    def __reduce_ex__(self, protocol):
+        # From protocol 5 the data is an out-of-band buffer, that serializers
+        # like FastSerializer write without copying it into the pickle
+        if protocol < 5:
+            return self.__reduce__()
+        return (_anonmap_from_buffer, (self.__class__, self.start, len(self), self.perms, pickle.PickleBuffer(self._data)))
+
+    @property
+    def version(self):
+        ''' Changes whenever the map data or permissions change '''
+        return self._version, self.perms
 
     def split(self, address):
         if address <= self.start:
@@ -280,6 +335,14 @@ class AnonMap(Map):
         assert not isinstance(index, slice) or \
             len(value) == index.stop - index.start
         index = self._get_offset(index)
+        self._version += 1
+        pages = self._pages
+        if pages is not None:
+            if isinstance(index, slice):
+                for page in range(index.start >> self._page_bits, (index.stop - 1 >> self._page_bits) + 1):
+                    pages[page] = None
+            else:
+                pages[index >> self._page_bits] = None
         if isinstance(index, slice):
             if not isinstance(value[0], int):
                 value = [Operators.ORD(n) for n in value]
@@ -330,9 +393,38 @@ class FileMap(Map):
             self._overlay = dict(overlay)
         else:
             self._overlay = dict()
+        # Writes since the map was built, to tell it changed
+        self._version = 0
+        # Overlay of each page as (offsets, values) tuples, built when
+        # pickled, and the pages written since
+        self._overlay_pages = None
+        self._dirty_pages = set()
 
     def __reduce__(self):
-        return (self.__class__, (self.start, len(self), self.perms, self._filename, self._offset, self._overlay))
+        # The pages not written since the last pickle are the same objects,
+        # so deltas of a snapshot (see manticore.core.snapshot) share them
+        overlay = self._overlay
+        pages = self._overlay_pages
+        if pages is None:
+            dirty = {offset >> self._page_bits for offset in overlay}
+            pages = self._overlay_pages = {}
+        else:
+            dirty = self._dirty_pages
+        for page in dirty:
+            offsets = tuple(offset for offset in range(page << self._page_bits, page + 1 << self._page_bits)
+                            if offset in overlay)
+            if offsets:
+                pages[page] = (offsets, tuple(overlay[offset] for offset in offsets))
+            else:
+                pages.pop(page, None)
+        self._dirty_pages.clear()
+        return (_filemap_from_pages, (self.__class__, self.start, len(self), self.perms, self._filename, self._offset,
+                                      tuple(pages[page] for page in sorted(pages))))
+
+    @property
+    def version(self):
+        ''' Changes whenever the map overlay or permissions change '''
+        return self._version, self.perms
 
     def __del__(self):
         munmap(self._data, self._mapped_size)
@@ -344,11 +436,16 @@ class FileMap(Map):
         assert not isinstance(index, slice) or \
             len(value) == index.stop - index.start
         index = self._get_offset(index)
+        self._version += 1
         if isinstance(index, slice):
             for i in range(index.stop - index.start):
                 self._overlay[index.start + i] = value[i]
+            if self._overlay_pages is not None:
+                self._dirty_pages.update(range(index.start >> self._page_bits, (index.stop - 1 >> self._page_bits) + 1))
         else:
             self._overlay[index] = value
+            if self._overlay_pages is not None:
+                self._dirty_pages.add(index >> self._page_bits)
 
     def __getitem__(self, index):
         def get_byte_at_offset(offset):
@@ -1,13 +1,40 @@
+import collections
 import itertools
 import sys
+import weakref
 
 from manticore.utils.helpers import PickleSerializer
-from .expression import BitVecVariable, BoolVariable, ArrayVariable, Array, Bool, BitVec, BoolConstant, ArrayProxy, BoolEq, Variable, Constant
-from .visitors import GetDeclarations, TranslatorSmtlib, get_variables, simplify, replace, translate_to_smtlib
+from .expression import BitVecVariable, BoolVariable, ArrayVariable, Array, Bool, BitVec, BoolConstant, ArrayProxy, Variable
+from .visitors import GetDeclarations, TranslatorSmtlib, get_variables, simplify, replace, evaluate
 import logging
 
 logger = logging.getLogger(__name__)
 
+# SMT-LIB text of every constraint translated so far, keyed by identity.
+# Constraints are immutable once added, entries die with their expression.
+_constraint_smtlib = {}
+
+
+def constraint_to_smtlib(constraint):
+    ''' Returns the SMT-LIB assertion for `constraint`, translating it only
+        the first time it is seen.
+        Its shared subterms are let bindings local to the assertion, so the
+        same constraint can be asserted more than once.
+    '''
+    key = id(constraint)
+    cached = _constraint_smtlib.get(key)
+    if cached is not None:
+        return cached[1]
+
+    translator = TranslatorSmtlib(use_bindings=True)
+    translator.visit(constraint)
+    constraint_str = translator.result
+    smtlib = '(assert %s)\n' % constraint_str if constraint_str != 'true' else ''
+
+    ref = weakref.ref(constraint, lambda _, key=key: _constraint_smtlib.pop(key, None))
+    _constraint_smtlib[key] = (ref, smtlib)
+    return smtlib
+
 
 class ConstraintSet(object):
     ''' Constraint Sets
@@ -16,12 +43,45 @@ class ConstraintSet(object):
     new variables.
     '''
 
+    #: Number of slicing index layers (one per parent) after which a child flattens them
+    MAX_INDEX_DEPTH = 32
+
     def __init__(self):
         self._constraints = list()
         self._parent = None
         self._sid = 0
         self._declarations = {}
         self._child = None
+        # Bumped whenever the constraints, declarations or parent of this set change
+        self._version = 0
+        # Slicing index, built lazily. Union-find of variable names to the
+        # cluster of constraints that (transitively) share variables.
+        #  _uf: variable name -> parent variable name (roots map to themselves)
+        #  _clusters: root variable name (or None for variable-free
+        #             constraints) -> [constraints, variables], or None for
+        #             a root of a parent merged into another cluster
+        #  _owned: roots whose cluster lists belong to this set and not to a parent
+        # Both maps are ChainMaps over the maps of the parents, so children
+        # only write the entries they change.
+        self._uf = None
+        self._clusters = None
+        self._owned = None
+        # Serialization of the constraints owned by this set (declarations of
+        # the variables not declared by the parents plus assertions).
+        # Children reuse it instead of translating the whole lineage.
+        self._smtlib = None
+        self._smtlib_count = 0
+        self._smtlib_declared = None
+        # Last (partial) satisfying assignment found by the solver, as a
+        # (values, evaluation cache) pair. Children use their parent's one.
+        self._model = None
+
+    def _invalidate(self):
+        ''' Drop the slicing index and serialization derived from the constraints '''
+        self._uf = self._clusters = self._owned = None
+        self._smtlib = self._smtlib_declared = None
+        self._smtlib_count = 0
+        self._version += 1
 
     def __reduce__(self):
         return (self.__class__, (), {'_parent': self._parent, '_constraints': self._constraints, '_sid': self._sid, '_declarations': self._declarations})
@@ -36,6 +96,9 @@ class ConstraintSet(object):
 
     def __exit__(self, ty, value, traceback):
         self._child._parent = None
+        # The child index and serialization depend on the parent, which can
+        # change from now on
+        self._child._invalidate()
         self._child = None
 
     def __len__(self):
@@ -66,114 +129,275 @@ class ConstraintSet(object):
             if not constraint.value:
                 logger.info("Adding an impossible constant constraint")
                 self._constraints = [constraint]
+                self._invalidate()
             else:
                 return
 
         self._constraints.append(constraint)
+        self._version += 1
+        if self._clusters is not None:
+            self._index(constraint)
 
         if check:
             from manticore.core.smtlib import solver
             if not solver.check(self):
                 raise ValueError("Added an impossible constraint")
 
+    @property
+    def version(self):
+        ''' Changes whenever constraints or variables are added to this set
+            (not to its parents) or it is detached from its parent '''
+        return self._version
+
     def _get_sid(self):
         ''' Returns a unique id. '''
         assert self._child is None
         self._sid += 1
+        self._version += 1
         return self._sid
 
+    def _find(self, name):
+        ''' Union-find root of variable `name` '''
+        uf = self._uf
+        root = name
+        while uf[root] != root:
+            root = uf[root]
+        # path compression
+        while uf[name] != root:
+            uf[name], name = root, uf[name]
+        return root
+
+    def _own_cluster(self, root):
+        ''' Returns the cluster of root, copying it first if it is shared with a parent '''
+        cluster = self._clusters[root]
+        if root not in self._owned:
+            cluster = [list(cluster[0]), list(cluster[1])]
+            self._clusters[root] = cluster
+            self._owned.add(root)
+        return cluster
+
+    def _index(self, constraint):
+        ''' Add constraint to the slicing index, merging the clusters it links '''
+        variables = constraint.variables
+        if not variables:
+            if None not in self._clusters:
+                self._clusters[None] = [[], []]
+                self._owned.add(None)
+            self._own_cluster(None)[0].append(constraint)
+            return
+
+        uf = self._uf
+        roots = set()
+        new_variables = []
+        for var in variables:
+            if var.name in uf:
+                roots.add(self._find(var.name))
+            else:
+                uf[var.name] = var.name
+                new_variables.append(var)
+
+        # Union by size: merge every other cluster into the largest one
+        if roots:
+            root = max(roots, key=lambda r: len(self._clusters[r][0]))
+            roots.remove(root)
+        else:
+            root = new_variables[0].name
+            self._clusters[root] = [[], []]
+            self._owned.add(root)
+        cluster = self._own_cluster(root)
+        for other in roots:
+            other_constraints, other_variables = self._clusters[other]
+            # Hides the cluster in the maps of the parents, if it was theirs
+            self._clusters[other] = None
+            self._owned.discard(other)
+            cluster[0].extend(other_constraints)
+            cluster[1].extend(other_variables)
+            uf[other] = root
+        for var in new_variables:
+            uf[var.name] = root
+        cluster[1].extend(new_variables)
+        cluster[0].append(constraint)
+
+    def _build_index(self):
+        ''' Make sure the slicing index is available. Children index their own
+            constraints on top of the index of their parent, which they only
+            read. Past MAX_INDEX_DEPTH parents, they start from a flat copy of it. '''
+        if self._clusters is not None:
+            return
+        if self._parent is None:
+            self._uf = collections.ChainMap()
+            self._clusters = collections.ChainMap()
+        else:
+            parent = self._parent
+            parent._build_index()
+            if len(parent._uf.maps) < self.MAX_INDEX_DEPTH:
+                self._uf = parent._uf.new_child()
+                self._clusters = parent._clusters.new_child()
+            else:
+                self._uf = collections.ChainMap({}, dict(parent._uf))
+                self._clusters = collections.ChainMap({}, {root: cluster for root, cluster in parent._clusters.items()
+                                                           if cluster is not None})
+        self._owned = set()
+        for constraint in self._constraints:
+            self._index(constraint)
+
+    @property
+    def cluster_stats(self):
+        ''' Statistics of the independent constraint clusters, for tuning '''
+        self._build_index()
+        sizes = [len(cluster[0]) for cluster in self._clusters.values() if cluster is not None]
+        return {'clusters': len(sizes),
+                'variables': len(self._uf),
+                'constraints': sum(sizes),
+                'max_cluster': max(sizes, default=0),
+                'mean_cluster': sum(sizes) / len(sizes) if sizes else 0}
+
     def __get_related(self, related_to=None):
+        self._build_index()
         if related_to is not None:
-            number_of_constraints = len(self.constraints)
-            remaining_constraints = set(self.constraints)
             related_variables = get_variables(related_to)
-            related_constraints = set()
-
-            added = True
-            while added:
-                added = False
-                logger.debug('Related variables %r', [x.name for x in related_variables])
-                for constraint in list(remaining_constraints):
-                    if isinstance(constraint, BoolConstant):
-                        if constraint.value:
-                            continue
-                        else:
-                            related_constraints = {constraint}
-                            break
-
-                    variables = get_variables(constraint)
-                    if related_variables & variables:
-                        remaining_constraints.remove(constraint)
-                        related_constraints.add(constraint)
-                        related_variables |= variables
-                        added = True
-
-            logger.debug('Reduced %d constraints!!', number_of_constraints - len(related_constraints))
+            roots = set()
+            for var in related_variables:
+                if var.name in self._uf:
+                    roots.add(self._find(var.name))
+            # Variable free constraints (i.e. False) are always relevant
+            if None in self._clusters:
+                roots.add(None)
         else:
             related_variables = set()
-            for constraint in self.constraints:
-                related_variables |= get_variables(constraint)
-            related_constraints = set(self.constraints)
+            roots = [root for root, cluster in self._clusters.items() if cluster is not None]
+
+        related_constraints = set()
+        for root in roots:
+            constraints, variables = self._clusters[root]
+            related_constraints.update(constraints)
+            related_variables.update(variables)
+
+        logger.debug('Reduced %d constraints!!', len(self) - len(related_constraints))
         return related_variables, related_constraints
 
-    def to_string(self, related_to=None, replace_constants=True):
-        ''' Returns a smtlib representation of the current state '''
-        related_variables, related_constraints = self.__get_related(related_to)
-
-        if replace_constants:
-            constant_bindings = {}
-            for expression in self.constraints:
-                if isinstance(expression, BoolEq) and \
-                   isinstance(expression.operands[0], Variable) and \
-                   isinstance(expression.operands[1], Constant):
-                    constant_bindings[expression.operands[0]] = expression.operands[1]
-
-        tmp = set()
-        result = ''
-        for var in related_variables:
-            # FIXME
-            # band aid hack around the fact that we are double declaring stuff :( :(
-            if var.declaration in tmp:
-                logger.warning("Variable '%s' was copied twice somewhere", var.name)
-                continue
-            tmp.add(var.declaration)
-            result += var.declaration + '\n'
-
-        translator = TranslatorSmtlib(use_bindings=True)
-        for constraint in related_constraints:
-            if replace_constants:
-                if isinstance(constraint, BoolEq) and \
-                   isinstance(constraint.operands[0], Variable) and \
-                   isinstance(constraint.operands[1], Constant):
-                    var = constraint.operands[0]
-                    expression = constraint.operands[1]
-                    expression = simplify(replace(expression, constant_bindings))
-                    constraint = var == expression
-
-            translator.visit(constraint)
-        for name, exp, smtlib in translator.bindings:
-            if isinstance(exp, BitVec):
-                result += '(declare-fun %s () (_ BitVec %d))' % (name, exp.size)
-            elif isinstance(exp, Bool):
-                result += '(declare-fun %s () Bool)' % name
-            elif isinstance(exp, Array):
-                result += '(declare-fun %s () (Array (_ BitVec %d) (_ BitVec %d)))' % (name, exp.index_bits, exp.value_bits)
+    def get_related(self, related_to=None):
+        ''' Returns the related variables and constraints of `related_to` as a pair,
+            see :meth:`get_related_variables` and :meth:`get_related_constraints` '''
+        return self.__get_related(related_to)
+
+    def get_related_constraints(self, related_to=None):
+        ''' Returns the constraints that share variables (transitively) with `related_to` '''
+        return self.__get_related(related_to)[1]
+
+    def get_related_variables(self, related_to=None):
+        ''' Returns the variables of `related_to` and of the constraints related to it '''
+        return self.__get_related(related_to)[0]
+
+    @property
+    def model(self):
+        ''' Returns the last model found for this set or its parents as a
+            (values, evaluation cache) pair, None if there is no model.
+        '''
+        cs = self
+        while cs is not None and cs._model is None:
+            cs = cs._parent
+        if cs is not None:
+            self._model = cs._model
+        return self._model
+
+    def update_model(self, values):
+        ''' Merge a satisfying assignment of some of the variables into the model.
+            Each independent cluster of constraints is satisfied by the values
+            of the last model found for it.
+
+            :param dict values: variable names to values, see :func:`evaluate`
+        '''
+        model = self.model
+        merged = dict(model[0]) if model is not None else {}
+        merged.update(values)
+        self._model = (merged, {})
+
+    def model_satisfies(self, expression):
+        ''' Returns True if the current model satisfies expression and the
+            constraints related to it. False means it is not known.
+        '''
+        model = self.model
+        if model is None:
+            return False
+        values, cache = model
+        if isinstance(expression, Bool):
+            if evaluate(expression, values, cache) is not True:
+                return False
+            related_to = expression
+        else:
+            related_to = None
+        for constraint in self.get_related_constraints(related_to):
+            if evaluate(constraint, values, cache) is not True:
+                return False
+        return True
+
+    def _smtlib_segment(self):
+        ''' Returns the SMT-LIB text of the constraints owned by this set.
+            It is extended with the constraints added since the last call.
+        '''
+        if self._smtlib is None:
+            self._smtlib = []
+            self._smtlib_count = 0
+            self._smtlib_declared = set()
+
+        if self._smtlib_count < len(self._constraints):
+            if self._parent is not None:
+                self._parent._build_index()
+                parent_variables = self._parent._uf
             else:
-                raise Exception("Type not supported %r", exp)
-            result += '(assert (= %s %s))\n' % (name, smtlib)
+                parent_variables = ()
+            declared = self._smtlib_declared
+            for constraint in self._constraints[self._smtlib_count:]:
+                for var in constraint.variables:
+                    if var.name not in declared and var.name not in parent_variables:
+                        declared.add(var.name)
+                        self._smtlib.append(var.declaration + '\n')
+                self._smtlib.append(constraint_to_smtlib(constraint))
+            self._smtlib_count = len(self._constraints)
+        return self._smtlib
 
-        constraint_str = translator.pop()
-        while constraint_str is not None:
-            if constraint_str != 'true':
-                result += '(assert %s)\n' % constraint_str
-            constraint_str = translator.pop()
-        return result
+    def to_string(self, related_to=None, replace_constants=True):
+        ''' Returns a smtlib representation of the current state
+
+        :param related_to: only serialize the constraints related to this expression
+        :param replace_constants: unused, variables bound to constants are
+                                  already emitted as simple equalities
+        '''
+        if related_to is not None:
+            related_variables, related_constraints = self.__get_related(related_to)
+            if len(related_constraints) < len(self):
+                tmp = set()
+                result = []
+                for var in related_variables:
+                    # FIXME
+                    # band aid hack around the fact that we are double declaring stuff :( :(
+                    if var.declaration in tmp:
+                        logger.warning("Variable '%s' was copied twice somewhere", var.name)
+                        continue
+                    tmp.add(var.declaration)
+                    result.append(var.declaration + '\n')
+                for constraint in related_constraints:
+                    result.append(constraint_to_smtlib(constraint))
+                return ''.join(result)
+
+        # Everything is related, concatenate the serialization of the lineage
+        chain = []
+        cs = self
+        while cs is not None:
+            chain.append(cs)
+            cs = cs._parent
+        result = []
+        for cs in reversed(chain):
+            result.extend(cs._smtlib_segment())
+        return ''.join(result)
 
     def _declare(self, var):
         ''' Declare the variable `var` '''
         if var.name in self._declarations:
             raise ValueError('Variable already declared')
         self._declarations[var.name] = var
+        self._version += 1
         return var
 
     def get_declared_variables(self):
@@ -231,7 +455,7 @@ class ConstraintSet(object):
         ''' True if expression_var is declared in this constraint set '''
         if not isinstance(expression_var, Variable):
             raise ValueError("Expression must be a Variable")
-        return any(expression_var is x for x in self.get_declared_variables())
+        return self._declarations.get(expression_var.name) is expression_var
 
     def migrate(self, expression, name_migration_map=None):
         ''' Migrate an expression created for a different constraint set to self.
@@ -1,31 +1,214 @@
-from functools import reduce
+from ...utils import config
 import numbers
 import uuid
-
-
-class Expression(object):
+import weakref
+
+consts = config.get_group('smt')
+consts.add('hash_cons', default=False, description='Share a single node among structurally identical constants and operations')
+
+# Shared empty set, e.g. the taint of all the untainted expressions
+_EMPTY_TAINT = frozenset()
+
+# Taint labels are interned as bits and the taint of an expression is stored
+# as the int with the bits of its labels, so untainted is 0 and propagating
+# taint is an OR. Bits are only meaningful in this process, pickles carry
+# the labels.
+_taint_bits = {}
+_taint_labels = []
+# Taint masks already seen, as frozensets of labels
+_taint_sets = {0: _EMPTY_TAINT}
+
+
+def taint_mask(labels):
+    ''' The taint mask with the bits of `labels`, interning new ones '''
+    mask = 0
+    for label in labels:
+        bit = _taint_bits.get(label)
+        if bit is None:
+            bit = _taint_bits[label] = 1 << len(_taint_labels)
+            _taint_labels.append(label)
+        mask |= bit
+    return mask
+
+
+def taint_labels(mask):
+    ''' The frozenset of the labels in a taint mask '''
+    try:
+        return _taint_sets[mask]
+    except KeyError:
+        pass
+    labels = frozenset(label for bit, label in enumerate(_taint_labels) if mask >> bit & 1)
+    _taint_sets[mask] = labels
+    return labels
+
+
+# Canonical constants and operations by (class, operand ids, fields). A node
+# keeps its operands alive so their ids are not reused while it is in here.
+_hash_consed = weakref.WeakValueDictionary()
+
+# Untainted BitVecConstants with values under 256, by (size, value). They are
+# shared even when hash consing is disabled.
+_small_constants = {}
+
+# Names of the slots of each expression class
+_class_fields = {}
+
+# Slots caching something derived from the operands. They are not part of
+# the value of a node so they are not copied, pickled or hash consed.
+_cache_fields = ('__weakref__', '_variables', '_metrics')
+
+
+def _fields(cls):
+    try:
+        return _class_fields[cls]
+    except KeyError:
+        fields = tuple(name for klass in reversed(cls.__mro__)
+                       for name in klass.__dict__.get('__slots__', ())
+                       if name not in _cache_fields)
+        _class_fields[cls] = fields
+        return fields
+
+
+def _small_constant(size, value):
+    ''' The shared untainted BitVecConstant, None if `value` is not small '''
+    if type(value) is not int or not 0 <= value < 256:
+        return None
+    key = (size, value)
+    constant = _small_constants.get(key)
+    if constant is None:
+        constant = _small_constants[key] = type.__call__(BitVecConstant, size, value)
+    return constant
+
+
+def hash_cons(expression):
+    ''' Returns the canonical node structurally equal to `expression`.
+        The operands of `expression` are expected to be canonical already,
+        so equal operands are the same objects.
+        Only constants and operations are shared; anything else is returned
+        as is.
+    '''
+    if not isinstance(expression, (Constant, Operation)):
+        return expression
+    if type(expression) is BitVecConstant and not expression._taint:
+        constant = _small_constant(expression.size, expression._value)
+        if constant is not None:
+            return constant
+    operands = getattr(expression, '_operands', ())
+    try:
+        key = (type(expression),
+               tuple(map(id, operands)),
+               tuple(getattr(expression, name, None) for name in _fields(type(expression)) if name != '_operands'))
+        return _hash_consed.setdefault(key, expression)
+    except TypeError:
+        # Some unhashable field
+        return expression
+
+
+def expression_values(expression):
+    ''' The values of the fields of `expression` as pickled, with its taint
+        as labels '''
+    return tuple(getattr(expression, name, None) if name != '_taint' else
+                 taint_labels(expression._taint) if expression._taint else 0
+                 for name in _fields(expression.__class__))
+
+
+def fill_expression(expression, values):
+    ''' Set the fields of an expression made with __new__ to `values`, from
+        :func:`expression_values` '''
+    for name, value in zip(_fields(expression.__class__), values):
+        if name == '_taint':
+            # Older pickles have the empty frozenset for no taint. Not read
+            # back from the node: array views delegate it to their array,
+            # which may not be filled yet
+            value = taint_mask(value) if value else 0
+        setattr(expression, name, value)
+
+
+def _rebuild_expression(cls, values):
+    ''' Unpickle an expression, into its canonical node if hash consing is enabled '''
+    expression = cls.__new__(cls)
+    fill_expression(expression, values)
+    if consts.hash_cons:
+        return hash_cons(expression)
+    if cls is BitVecConstant and not expression._taint:
+        constant = _small_constant(expression.size, expression._value)
+        if constant is not None:
+            return constant
+    return expression
+
+
+class ExpressionType(type):
+    ''' Expression metaclass.
+        Builds canonical constants and operations when `smt.hash_cons` is
+        enabled, and shares small untainted BitVecConstants.
+    '''
+
+    def __call__(cls, *args, **kwargs):
+        if cls is BitVecConstant and len(args) == 2 and not kwargs:
+            constant = _small_constant(*args)
+            if constant is not None:
+                return constant
+        expression = super().__call__(*args, **kwargs)
+        if consts.hash_cons:
+            return hash_cons(expression)
+        return expression
+
+
+class Expression(object, metaclass=ExpressionType):
     ''' Abstract taintable Expression. '''
 
+    __slots__ = ('_taint', '__weakref__')
+
     def __init__(self, taint=()):
         if self.__class__ is Expression:
             raise TypeError
         assert isinstance(taint, (tuple, frozenset))
         super().__init__()
-        self._taint = frozenset(taint)
+        self._taint = taint_mask(taint) if taint else 0
 
     def __repr__(self):
-        return '<{:s} at {:x}{:s}>'.format(type(self).__name__, id(self), self.taint and '-T' or '')
+        return '<{:s} at {:x}{:s}>'.format(type(self).__name__, id(self), self._taint and '-T' or '')
 
     @property
     def is_tainted(self):
-        return len(self._taint) != 0
+        return self._taint != 0
 
     @property
     def taint(self):
-        return self._taint
+        ''' The taint labels of this expression, a frozenset '''
+        return taint_labels(self._taint)
+
+    @property
+    def variables(self):
+        ''' The free variables of this expression, a frozenset '''
+        return _EMPTY_TAINT
+
+    @property
+    def depth(self):
+        ''' Depth of the expression tree, 1 for a leaf '''
+        return 1
+
+    @property
+    def tree_size(self):
+        ''' Number of nodes of the expression tree, counting a shared
+            subexpression at each of its uses '''
+        return 1
+
+    def __reduce__(self):
+        return _rebuild_expression, (self.__class__, expression_values(self))
+
+    def __copy__(self):
+        # Copies are private, they may be modified
+        result = self.__class__.__new__(self.__class__)
+        for name in _fields(self.__class__):
+            if hasattr(self, name):
+                setattr(result, name, getattr(self, name))
+        return result
 
 
 class Variable(Expression):
+    __slots__ = ()
+
     def __init__(self, name, *args, **kwargs):
         if self.__class__ is Variable:
             raise TypeError
@@ -41,6 +224,10 @@ class Variable(Expression):
     def name(self):
         return self._name
 
+    @property
+    def variables(self):
+        return frozenset((self,))
+
     def __deepcopy__(self, memo):
         cls = self.__class__
         memo[id(self)] = self
@@ -51,6 +238,8 @@ class Variable(Expression):
 
 
 class Constant(Expression):
+    __slots__ = ()
+
     def __init__(self, value, *args, **kwargs):
         if self.__class__ is Constant:
             raise TypeError
@@ -64,27 +253,110 @@ class Constant(Expression):
 
 
 class Operation(Expression):
+    __slots__ = ()
+
     def __init__(self, *operands, **kwargs):
         if self.__class__ is Operation:
             raise TypeError
         assert len(operands) > 0
         assert all(isinstance(x, Expression) for x in operands)
         self._operands = operands
-
-        # If taint was not forced by a keyword argument, calculate default
-        if 'taint' not in kwargs:
-            kwargs['taint'] = reduce(lambda x, y: x.union(y.taint), operands, frozenset())
-
+        taint = kwargs.get('taint')
         super().__init__(**kwargs)
 
+        # If taint was not forced by a keyword argument, it is the one of the operands
+        if taint is None:
+            mask = 0
+            for operand in operands:
+                mask |= operand._taint
+            self._taint = mask
+
     @property
     def operands(self):
         return self._operands
 
+    @property
+    def variables(self):
+        ''' The free variables of this expression, a frozenset.
+            It is computed once, from the cached sets of the operands.
+        '''
+        try:
+            return self._variables
+        except AttributeError:
+            return _bottom_up(self, '_variables', _union_variables)
+
+    @property
+    def depth(self):
+        try:
+            return self._metrics[0]
+        except AttributeError:
+            return _bottom_up(self, '_metrics', _combine_metrics)[0]
+
+    @property
+    def tree_size(self):
+        try:
+            return self._metrics[1]
+        except AttributeError:
+            return _bottom_up(self, '_metrics', _combine_metrics)[1]
+
+
+def _bottom_up(operation, slot, combine):
+    ''' Set the `slot` of operation, and of the operations under it missing
+        it, to combine(operands). Returns the value for operation. '''
+    # Iterative post-order over the operations not computed yet, deep
+    # store chains would overflow the Python stack otherwise
+    stack = [operation]
+    while stack:
+        node = stack[-1]
+        pending = False
+        for operand in node._operands:
+            operand = _unproxied(operand)
+            if isinstance(operand, Operation) and not hasattr(operand, slot):
+                stack.append(operand)
+                pending = True
+        if not pending:
+            stack.pop()
+            setattr(node, slot, combine(node._operands))
+    return getattr(operation, slot)
+
+
+def _combine_metrics(operands):
+    ''' (depth, tree size) of an operation from the ones of its operands '''
+    depth = 0
+    size = 1
+    for operand in operands:
+        depth = max(depth, operand.depth)
+        size += operand.tree_size
+    return depth + 1, size
+
+
+def _unproxied(expression):
+    ''' The array under ArrayProxy and ArraySlice wrappers '''
+    while isinstance(expression, (ArrayProxy, ArraySlice)):
+        expression = expression._array
+    return expression
+
+
+def _union_variables(operands):
+    ''' Union of the variables of `operands`, reusing the set of an operand
+        when it already covers the others (the common case). '''
+    result = _EMPTY_TAINT
+    for operand in operands:
+        variables = operand.variables
+        if not variables or variables is result or variables <= result:
+            continue
+        if result <= variables:
+            result = variables
+        else:
+            result = result | variables
+    return result
+
 
 ###############################################################################
 # Booleans
 class Bool(Expression):
+    __slots__ = ()
+
     def __init__(self, *operands, **kwargs):
         super().__init__(*operands, **kwargs)
 
@@ -139,6 +411,8 @@ class Bool(Expression):
 
 
 class BoolVariable(Bool, Variable):
+    __slots__ = ('_name',)
+
     def __init__(self, name, *args, **kwargs):
         super().__init__(name, *args, **kwargs)
 
@@ -148,6 +422,8 @@ class BoolVariable(Bool, Variable):
 
 
 class BoolConstant(Bool, Constant):
+    __slots__ = ('_value',)
+
     def __init__(self, value, *args, **kwargs):
         assert isinstance(value, bool)
         super().__init__(value, *args, **kwargs)
@@ -157,26 +433,36 @@ class BoolConstant(Bool, Constant):
 
 
 class BoolOperation(Operation, Bool):
+    __slots__ = ('_operands', '_variables', '_metrics')
+
     def __init__(self, *operands, **kwargs):
         super().__init__(*operands, **kwargs)
 
 
 class BoolNot(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, value, **kwargs):
         super().__init__(value, **kwargs)
 
 
 class BoolEq(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, **kwargs):
         super().__init__(a, b, **kwargs)
 
 
 class BoolAnd(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, **kwargs):
         super().__init__(a, b, **kwargs)
 
 
 class BoolOr(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, **kwargs):
         assert isinstance(a, Bool)
         assert isinstance(b, Bool)
@@ -184,11 +470,15 @@ class BoolOr(BoolOperation):
 
 
 class BoolXor(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, **kwargs):
         super().__init__(a, b, **kwargs)
 
 
 class BoolITE(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, cond, true, false, **kwargs):
         assert isinstance(true, Bool)
         assert isinstance(false, Bool)
@@ -199,6 +489,8 @@ class BoolITE(BoolOperation):
 class BitVec(Expression):
     ''' This adds a bitsize to the Expression class '''
 
+    __slots__ = ('size',)
+
     def __init__(self, size, *operands, **kwargs):
         super().__init__(*operands, **kwargs)
         self.size = size
@@ -429,6 +721,8 @@ class BitVec(Expression):
 
 
 class BitVecVariable(BitVec, Variable):
+    __slots__ = ('_name',)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -438,6 +732,8 @@ class BitVecVariable(BitVec, Variable):
 
 
 class BitVecConstant(BitVec, Constant):
+    __slots__ = ('_value',)
+
     def __init__(self, size, value, *args, **kwargs):
         assert isinstance(value, int)
         super().__init__(size, value, *args, **kwargs)
@@ -455,76 +751,106 @@ class BitVecConstant(BitVec, Constant):
 
 
 class BitVecOperation(BitVec, Operation):
+    __slots__ = ('_operands', '_variables', '_metrics')
+
     def __init__(self, size, *operands, **kwargs):
         super().__init__(size, *operands, **kwargs)
 
 
 class BitVecAdd(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecSub(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecMul(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecDiv(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecUnsignedDiv(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecMod(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecRem(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecUnsignedRem(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecShiftLeft(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecShiftRight(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecArithmeticShiftLeft(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecArithmeticShiftRight(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecAnd(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecOr(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert isinstance(a, BitVec)
         assert isinstance(b, BitVec)
@@ -533,68 +859,92 @@ class BitVecOr(BitVecOperation):
 
 
 class BitVecXor(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a.size, a, b, *args, **kwargs)
 
 
 class BitVecNot(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, **kwargs):
         super().__init__(a.size, a, **kwargs)
 
 
 class BitVecNeg(BitVecOperation):
+    __slots__ = ()
+
     def __init__(self, a, *args, **kwargs):
         super().__init__(a.size, a, *args, **kwargs)
 
 
 # Comparing two bitvectors results in a Bool
 class LessThan(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a, b, *args, **kwargs)
 
 
 class LessOrEqual(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a, b, *args, **kwargs)
 
 
 class Equal(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class GreaterThan(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class GreaterOrEqual(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class UnsignedLessThan(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         super().__init__(a, b, *args, **kwargs)
         assert a.size == b.size
 
 
 class UnsignedLessOrEqual(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class UnsignedGreaterThan(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super().__init__(a, b, *args, **kwargs)
 
 
 class UnsignedGreaterOrEqual(BoolOperation):
+    __slots__ = ()
+
     def __init__(self, a, b, *args, **kwargs):
         assert a.size == b.size
         super(UnsignedGreaterOrEqual,
@@ -609,6 +959,9 @@ class Array(Expression):
     (BV32 -> BV8  or BV64 -> BV8)
 
     """
+
+    __slots__ = ('_index_bits', '_index_max', '_value_bits')
+
     def __init__(self, index_bits, index_max, value_bits, *operands, **kwargs):
         assert index_bits in (32, 64, 256)
         assert value_bits in (8, 16, 32, 64, 256)
@@ -918,6 +1271,8 @@ class Array(Expression):
 
 
 class ArrayVariable(Array, Variable):
+    __slots__ = ('_name',)
+
     def __init__(self, index_bits, index_max, value_bits, name, *operands, **kwargs):
         super().__init__(index_bits, index_max, value_bits, name, **kwargs)
 
@@ -927,12 +1282,16 @@ class ArrayVariable(Array, Variable):
 
 
 class ArrayOperation(Array, Operation):
+    __slots__ = ('_operands', '_variables', '_metrics')
+
     def __init__(self, array, *operands, **kwargs):
         assert isinstance(array, Array)
         super().__init__(array.index_bits, array.index_max, array.value_bits, array, *operands, **kwargs)
 
 
 class ArrayStore(ArrayOperation):
+    __slots__ = ()
+
     def __init__(self, array, index, value, *args, **kwargs):
         assert isinstance(array, Array)
         assert isinstance(index, BitVec) and index.size == array.index_bits
@@ -957,6 +1316,8 @@ class ArrayStore(ArrayOperation):
 
 
 class ArraySlice(Array):
+    __slots__ = ('_array', '_slice_offset', '_slice_size')
+
     def __init__(self, array, offset, size, *args, **kwargs):
         if not isinstance(array, Array):
             raise ValueError("Array expected")
@@ -989,8 +1350,25 @@ class ArraySlice(Array):
         return self._array.value_bits
 
     @property
-    def taint(self):
-        return self._array.taint
+    def _taint(self):
+        return self._array._taint
+
+    @_taint.setter
+    def _taint(self, value):
+        # The taint is the one of the array
+        pass
+
+    @property
+    def variables(self):
+        return self._array.variables
+
+    @property
+    def depth(self):
+        return self._array.depth
+
+    @property
+    def tree_size(self):
+        return self._array.tree_size
 
     def select(self, index):
         return self._array.select(index + self._slice_offset)
@@ -1000,16 +1378,27 @@ class ArraySlice(Array):
 
 
 class ArrayProxy(Array):
+    ''' Mutable wrapper of an array expression, used for memories.
+
+        It indexes the stores with a concrete index done since the last
+        store with a symbolic one, `_base`. Selects at a concrete index are
+        resolved from that index, or from `_base` if it was not written.
+    '''
+
     def __init__(self, array):
         assert isinstance(array, Array)
         self._concrete_cache = {}
         self._written = None
+        # Stores in the index overwritten by a later one
+        self._dead_stores = 0
         if isinstance(array, ArrayProxy):
             #copy constructor
             super().__init__(array.index_bits, array.index_max, array.value_bits)
             self._array = array._array
             self._name = array._name
             self._concrete_cache = dict(array._concrete_cache)
+            self._base = array._base
+            self._dead_stores = array._dead_stores
             if array._written is not None:
                 self._written = set(array._written)
         elif isinstance(array, ArrayVariable):
@@ -1017,11 +1406,13 @@ class ArrayProxy(Array):
             super().__init__(array.index_bits, array.index_max, array.value_bits)
             self._array = array
             self._name = array.name
+            self._base = array
         else:
             #arrayproxy for a prepopulated array
             super().__init__(array.index_bits, array.index_max, array.value_bits)
             self._name = array.underlying_variable.name
             self._array = array
+            self._base = array
 
     @property
     def underlying_variable(self):
@@ -1052,8 +1443,25 @@ class ArrayProxy(Array):
         return self._array.value_bits
 
     @property
-    def taint(self):
-        return self._array.taint
+    def _taint(self):
+        return self._array._taint
+
+    @_taint.setter
+    def _taint(self, value):
+        # The taint is the one of the array
+        pass
+
+    @property
+    def variables(self):
+        return self._array.variables
+
+    @property
+    def depth(self):
+        return self._array.depth
+
+    @property
+    def tree_size(self):
+        return self._array.tree_size
 
     def select(self, index):
         """ Array Select
@@ -1070,8 +1478,12 @@ class ArrayProxy(Array):
             from manticore.core.smtlib.visitors import simplify
             index = simplify(BitVecITE(self.index_bits, index < 0, self.index_max + index + 1, index))
 
-        if isinstance(index, Constant) and index.value in self._concrete_cache:
-            return self._concrete_cache[index.value]
+        if isinstance(index, Constant):
+            try:
+                return self._concrete_cache[index.value]
+            except KeyError:
+                # Not written since the last symbolic store
+                return self._base.select(index)
 
         return self._array.select(index)
 
@@ -1095,13 +1507,32 @@ class ArrayProxy(Array):
             value = self.cast_value(value)
         from manticore.core.smtlib.visitors import simplify
         index = simplify(index)
-        if isinstance(index, Constant):
-            self._concrete_cache[index.value] = value
         self.written.add(index)
         auxiliary = self._array.store(index, value)
         self._array = auxiliary
+        if isinstance(index, Constant):
+            if index.value in self._concrete_cache:
+                self._dead_stores += 1
+            self._concrete_cache[index.value] = value
+            if self._dead_stores > max(len(self._concrete_cache), 32):
+                self._compact()
+        else:
+            # It may alias any of the concrete stores so far
+            self._concrete_cache = {}
+            self._dead_stores = 0
+            self._base = auxiliary
         return self
 
+    def _compact(self):
+        ''' Rebuild the stores done since the last symbolic one without the
+            overwritten ones. Stores at different concrete indexes commute.
+        '''
+        array = self._base
+        for index, value in self._concrete_cache.items():
+            array = array.store(index, value)
+        self._array = array
+        self._dead_stores = 0
+
     def __getitem__(self, index):
         if isinstance(index, slice):
             start, stop = self._fix_index(index)
@@ -1129,6 +1560,8 @@ class ArrayProxy(Array):
         state['name'] = self.name
         state['_concrete_cache'] = self._concrete_cache
         state['_written'] = self._written
+        state['_base'] = self._base
+        state['_dead_stores'] = self._dead_stores
         return state
 
     def __setstate__(self, state):
@@ -1136,6 +1569,11 @@ class ArrayProxy(Array):
         self._name = state['name']
         self._concrete_cache = state['_concrete_cache']
         self._written = state['_written']
+        self._base = state['_base']
+        self._dead_stores = state['_dead_stores']
+
+    def __reduce__(self):
+        return self.__class__.__new__, (self.__class__,), self.__getstate__()
 
     def __copy__(self):
         return ArrayProxy(self)
@@ -1177,6 +1615,9 @@ class ArrayProxy(Array):
 class ArraySelect(BitVec, Operation):
     """ Expression representing array access
     """
+
+    __slots__ = ('_operands', '_variables', '_metrics')
+
     def __init__(self, array, index, *args, **kwargs):
         assert isinstance(array, Array)
         assert isinstance(index, BitVec) and index.size == array.index_bits
@@ -1194,6 +1635,9 @@ class ArraySelect(BitVec, Operation):
 class BitVecSignExtend(BitVecOperation):
     """ Expression representing sign extension
     """
+
+    __slots__ = ('extend',)
+
     def __init__(self, operand, size_dest, *args, **kwargs):
         assert isinstance(operand, BitVec)
         assert isinstance(size_dest, int)
@@ -1205,6 +1649,9 @@ class BitVecSignExtend(BitVecOperation):
 class BitVecZeroExtend(BitVecOperation):
     """ Expression representing zero extension
     """
+
+    __slots__ = ('extend',)
+
     def __init__(self, size_dest, operand, *args, **kwargs):
         assert isinstance(operand, BitVec)
         assert isinstance(size_dest, int)
@@ -1217,6 +1664,8 @@ class BitVecExtract(BitVecOperation):
     """ Expression representing bit extraction
     """
 
+    __slots__ = ('begining', 'end')
+
     def __init__(self, operand, offset, size, *args, **kwargs):
         assert isinstance(offset, int)
         assert isinstance(size, int)
@@ -1230,6 +1679,8 @@ class BitVecConcat(BitVecOperation):
     """ Expression representing concatenation
     """
 
+    __slots__ = ()
+
     def __init__(self, size_dest, *operands, **kwargs):
         assert isinstance(size_dest, int)
         assert all(isinstance(x, BitVec) for x in operands)
@@ -1241,6 +1692,8 @@ class BitVecITE(BitVecOperation):
     """ Expression representing if-than-else
     """
 
+    __slots__ = ()
+
     def __init__(self, size, condition, true_value, false_value, *args, **kwargs):
         assert isinstance(true_value, BitVec)
         assert isinstance(false_value, BitVec)
@@ -0,0 +1,66 @@
+'''
+Guard against values whose expressions grow without bound, like flags
+computed by chains of ITEs or EVM SHA3 results over all the known hashes.
+Both the simplifier and the solver degrade badly on those.
+
+The platforms check the values written to registers, memory and the EVM
+stack with :func:`oversized`. An oversized value is concretized with the
+`smt.oversized_policy` or, with the 'abstract' policy, replaced by a fresh
+variable constrained to be equal to it (:func:`abstract`).
+'''
+import collections
+import logging
+
+from .expression import Operation, Bool
+from ...utils import config
+
+logger = logging.getLogger(__name__)
+
+consts = config.get_group('smt')
+consts.add('max_expression_depth', default=0,
+           description='Depth over which a value written to a register, memory or the EVM stack is concretized or abstracted (0 disables the check)')
+consts.add('max_expression_size', default=0,
+           description='Like max_expression_depth, for the number of nodes of the expression tree (shared subexpressions count at each use)')
+consts.add('oversized_policy', default='ONE',
+           description="What to do with oversized values: a concretization policy (ONE, SAMPLED, MINMAX, ALL) or 'abstract' to replace them by a fresh variable constrained to be equal")
+
+# Oversized values found, by '<place>/<policy>'
+guard_stats = collections.Counter()
+
+
+def oversized(value):
+    ''' True if value is an expression over smt.max_expression_depth or
+        smt.max_expression_size '''
+    if not isinstance(value, Operation):
+        return False
+    max_depth = consts.max_expression_depth
+    if max_depth and value.depth > max_depth:
+        return True
+    max_size = consts.max_expression_size
+    return bool(max_size) and value.tree_size > max_size
+
+
+def oversized_policy(place, value):
+    ''' The policy for an oversized value written to `place` (e.g.
+        'register'), counting it in guard_stats '''
+    policy = consts.oversized_policy
+    guard_stats['%s/%s' % (place, policy)] += 1
+    logger.info("Oversized value written to %s (depth %d, %d nodes), policy %s",
+                place, value.depth, value.tree_size, policy)
+    return policy
+
+
+def abstract(constraints, value, name='OVERSIZED'):
+    '''
+    A fresh variable constrained to be equal to `value`, with its taint
+
+    :param ConstraintSet constraints: where to declare the variable and the constraint
+    :param value: the expression to abstract
+    :param str name: base name of the variable
+    '''
+    if isinstance(value, Bool):
+        variable = constraints.new_bool(name=name, taint=value.taint, avoid_collisions=True)
+    else:
+        variable = constraints.new_bitvec(value.size, name=name, taint=value.taint, avoid_collisions=True)
+    constraints.add(variable == value)
+    return variable
@@ -15,6 +15,7 @@
 # You can create new symbols operate on them. The declarations will be sent to the smtlib process when needed.
 # You can add new constraints. A new constraint may change the state from {None, sat} to {sat, unsat, unknown}
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 from subprocess import PIPE, Popen, check_output
 
 from ...exceptions import Z3NotFoundError, SolverException, SolverUnknown, TooManySolutions
@@ -27,9 +28,18 @@ import shlex
 import time
 from .visitors import *
 from ...utils.helpers import issymbolic, istainted, taint_with, get_taints
+from ...utils.cache import LRUCache
 from ...utils import config
 import io
+import os
 import collections
+import hashlib
+import heapq
+import pickle
+import selectors
+import shutil
+import sqlite3
+import sys
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +48,318 @@ consts.add('timeout', default=240, description='Timeout, in seconds, for each Z3
 consts.add('memory', default=16384, description='Max memory for Z3 to use (in Megabytes)')
 consts.add('maxsolutions', default=10000, description='Maximum solutions to provide when solving for all values')
 consts.add('z3_bin', default='z3', description='Z3 binary to use')
+consts.add('solver', default='z3', description='Solver backend to use: z3 (SMT-LIB piped to a z3 process), z3api (z3 Python bindings) or portfolio (race several SMT-LIB solver processes)')
+consts.add('optimize_strategy', default='bitwise', description='How to find min/max values when the solver has no native optimization: bitwise (one check per bit) or linear (tighten the bound one solution at a time)')
+consts.add('model_cache', default=False, description='Keep the last model found for each state and answer can_be_true from it when it satisfies the query')
+consts.add('model_array_limit', default=256, description='Maximum size of the (bounded) arrays whose elements are kept in the model cache')
+consts.add('portfolio_size', default=2, description='Number of z3 processes, each with a different random seed, raced by the portfolio solver')
+consts.add('portfolio_commands', default='', description='Semicolon separated command lines of the SMT-LIB solvers raced by the portfolio solver (e.g. "z3 -smt2 -in;yices-smt2 --incremental"). Overrides portfolio_size')
+consts.add('incremental', default=False, description='Keep one Z3 process per worker and only push the constraints that changed between queries')
+consts.add('query_cache', default=False, description='Cache solver query results keyed by the related constraints and the query')
+consts.add('query_cache_size', default=100000, description='Maximum number of query results kept in memory by each worker')
+consts.add('query_stats', default=True, description='Record the caller, size, time and result of every solver query')
+consts.add('query_stats_slowest', default=20, description='Number of the slowest solver queries kept in the query statistics')
+consts.add('query_cache_file', default='', description='Optional sqlite file backing the query cache, shared among workers and runs')
+
+
+class QueryCache(object):
+    ''' Solver query results cache
+
+    Keys are a hash of the canonical SMT-LIB text of the declarations and
+    constraints related to the query plus the query itself, so sibling states asking the same
+    question hit the same entry. Results are kept in a bounded in-memory LRU
+    and, if a file name is given, in a sqlite database that outlives the run
+    and is shared by all the workers using it.
+    '''
+
+    def __init__(self, max_size=None, filename=None):
+        self._max_size = max_size
+        self._filename = filename
+        self._entries = collections.OrderedDict()
+        self._db = None
+        self._db_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self):
+        return consts.query_cache_size if self._max_size is None else self._max_size
+
+    @property
+    def filename(self):
+        return consts.query_cache_file if self._filename is None else self._filename
+
+    def _connection(self):
+        if not self.filename:
+            return None
+        # sqlite connections can not be shared with forked workers
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.filename, timeout=60)
+            self._db.execute('CREATE TABLE IF NOT EXISTS queries (key TEXT PRIMARY KEY, value BLOB)')
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    @staticmethod
+    def key(query, constraints, expression, *args):
+        ''' Canonical key for a query over constraints
+
+        :param str query: the name of the solver method
+        :param ConstraintSet constraints: the constraints the query runs under
+        :param expression: the queried expression
+        :param args: any other parameters affecting the result
+        :rtype: str
+        '''
+        related_to = expression if isinstance(expression, Expression) else None
+        variables, related = constraints.get_related(related_to)
+        # Variables of different sorts can share a name. Declaration and
+        # constraint order is irrelevant for the result
+        texts = sorted(var.declaration for var in variables)
+        texts.extend(sorted(constraint_to_smtlib(constraint) for constraint in related))
+        if isinstance(expression, Expression):
+            texts.append(translate_to_smtlib(expression, use_bindings=True))
+        else:
+            texts.append(repr(expression))
+        texts.append(query)
+        texts.append(repr(args))
+        return hashlib.sha1('\n'.join(texts).encode()).hexdigest()
+
+    def get(self, key):
+        ''' Returns (True, value) for a cached query and (False, None) otherwise '''
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, self._entries[key]
+
+        db = self._connection()
+        if db is not None:
+            row = db.execute('SELECT value FROM queries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                value = pickle.loads(row[0])
+                self._remember(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return True, value
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        db = self._connection()
+        if db is not None:
+            db.execute('INSERT OR REPLACE INTO queries VALUES (?, ?)', (key, pickle.dumps(value)))
+            db.commit()
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'evictions': self.evictions,
+                'size': len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+query_cache = QueryCache()
+
+
+class SolverStats(object):
+    ''' Solver query instrumentation
+
+    Every query (a call to one of the public methods of a solver) is
+    attributed to the function that made it: the first one up the stack that
+    is neither in the smtlib package nor one of the `forwarders`. For each
+    caller it accumulates the number of queries and checks, the constraints,
+    variables and bytes of SMT-LIB sent, the wall and check time and how many
+    queries ended in each result. The result of a query is the status of its
+    last check, 'cached' if it needed none and 'error' if it raised before
+    the first one.
+    '''
+
+    #: Functions that only forward their arguments to the solver, by module
+    forwarders = {'manticore.core.state': {'is_feasible', 'can_be_true', 'must_be_true', 'solve_one',
+                                           'solve_n', 'solve_max', 'solve_min', 'solve_buffer'}}
+
+    def __init__(self):
+        self.callers = collections.defaultdict(collections.Counter)
+        # The query being recorded, None if there is none
+        self.query = None
+        self._count = 0
+        # Heap of (time, number, query) with the slowest queries
+        self._slowest = []
+
+    @staticmethod
+    def _caller(frame):
+        ''' The function that made the query, looking up the stack from `frame` '''
+        while frame is not None:
+            module = frame.f_globals.get('__name__', '')
+            name = frame.f_code.co_name
+            if not module.startswith(__package__) and name not in SolverStats.forwarders.get(module, ()):
+                return '{}.{}'.format(module.rsplit('.', 1)[-1], name)
+            frame = frame.f_back
+        return 'unknown'
+
+    @contextmanager
+    def recording(self, method, frame):
+        ''' Record the query made in the body of the with statement
+
+        :param str method: the name of the solver method queried
+        :param frame: the frame of the call to it
+        '''
+        query = {'method': method,
+                 'caller': self._caller(frame),
+                 'checks': 0,
+                 'constraints': 0,
+                 'variables': 0,
+                 'bytes': 0,
+                 'check_time': 0.0,
+                 'result': 'cached'}
+        self.query = query
+        start = time.time()
+        try:
+            yield query
+        except BaseException:
+            if query['checks'] == 0:
+                query['result'] = 'error'
+            raise
+        finally:
+            query['time'] = time.time() - start
+            self.query = None
+            self._add(query)
+
+    def sent(self, smtlib):
+        ''' Account SMT-LIB text sent to the solver by the current query '''
+        query = self.query
+        if query is not None:
+            query['bytes'] += len(smtlib) + 1
+            query['constraints'] += smtlib.count('(assert ')
+            query['variables'] += smtlib.count('(declare-fun ')
+
+    def asserted(self, constraints, variables):
+        ''' Account constraints and variables given to an in-process solver '''
+        query = self.query
+        if query is not None:
+            query['constraints'] += constraints
+            query['variables'] += variables
+
+    def checked(self, status, elapsed):
+        ''' Account a satisfiability check of the current query '''
+        query = self.query
+        if query is not None:
+            query['checks'] += 1
+            query['check_time'] += elapsed
+            query['result'] = status
+
+    def _add(self, query):
+        self._count += 1
+        stats = self.callers[query['caller']]
+        stats['queries'] += 1
+        for name in ('checks', 'constraints', 'variables', 'bytes', 'time', 'check_time'):
+            stats[name] += query[name]
+        stats[query['result']] += 1
+
+        entry = (query['time'], self._count, query)
+        if len(self._slowest) < consts.query_stats_slowest:
+            heapq.heappush(self._slowest, entry)
+        elif self._slowest and entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def mark(self):
+        ''' A snapshot to later get the statistics of the queries made after it '''
+        return {caller: collections.Counter(stats) for caller, stats in self.callers.items()}, self._count
+
+    def report(self, since=None):
+        ''' Statistics of the queries made after the `since` mark (or all of them)
+
+        :return: {'callers': {caller: {stat: value}}, 'slowest': [query, ...]}
+        :rtype: dict
+        '''
+        callers, count = since if since is not None else ({}, 0)
+        report = {'callers': {}, 'slowest': []}
+        for caller, stats in self.callers.items():
+            stats = stats - callers.get(caller, collections.Counter())
+            if stats:
+                report['callers'][caller] = dict(stats)
+        report['slowest'] = [dict(query) for _, number, query in sorted(self._slowest, reverse=True) if number > count]
+        return report
+
+    def totals(self, since=None):
+        ''' Statistics of the queries made after `since` summed over all the callers '''
+        totals = collections.Counter()
+        for stats in self.report(since)['callers'].values():
+            totals.update(stats)
+        return dict(totals)
+
+    @staticmethod
+    def merge(report, other):
+        ''' Add the statistics of the `other` report to `report`
+
+        :return: the updated report
+        '''
+        callers = report.setdefault('callers', {})
+        for caller, stats in other.get('callers', {}).items():
+            merged = collections.Counter(callers.get(caller, {}))
+            merged.update(stats)
+            callers[caller] = dict(merged)
+        slowest = report.get('slowest', []) + other.get('slowest', [])
+        slowest.sort(key=lambda query: query['time'], reverse=True)
+        report['slowest'] = slowest[:consts.query_stats_slowest]
+        return report
+
+    def clear(self):
+        self.callers.clear()
+        self._slowest = []
+
+
+solver_stats = SolverStats()
+
+
+def memoized(method):
+    ''' Answer a solver query from `query_cache` when `smt.query_cache` is enabled '''
+    def new_function(self, constraints, expression, *args, **kwargs):
+        if not consts.query_cache or not isinstance(expression, (Expression, bool)):
+            return method(self, constraints, expression, *args, **kwargs)
+        key = query_cache.key(method.__name__, constraints, expression, args, sorted(kwargs.items()))
+        found, value = query_cache.get(key)
+        if not found:
+            value = method(self, constraints, expression, *args, **kwargs)
+            query_cache.put(key, value)
+        if isinstance(value, list):
+            # Do not let callers modify the cached solutions
+            value = list(value)
+        return value
+    new_function.__name__ = method.__name__
+    new_function.__doc__ = method.__doc__
+    return new_function
+
+
+def instrumented(method):
+    ''' Record the query in `solver_stats` when `smt.query_stats` is enabled '''
+    def new_function(self, *args, **kwargs):
+        # Queries made by another query are part of it
+        if not consts.query_stats or solver_stats.query is not None:
+            return method(self, *args, **kwargs)
+        with solver_stats.recording(method.__name__, sys._getframe(1)):
+            return method(self, *args, **kwargs)
+    new_function.__name__ = method.__name__
+    new_function.__doc__ = method.__doc__
+    return new_function
+
 
 class Solver(object, metaclass=ABCMeta):
     """ Solver Baseclass
@@ -72,6 +394,31 @@ class Solver(object, metaclass=ABCMeta):
         solutions = self.get_all_values(constraints, expression, maxcnt=2, silent=True)
         return solutions == [True]
 
+    def _update_model(self, constraints, variables, get_values):
+        ''' Save the values of `variables` in the current (sat) solver model
+            into the model of `constraints`.
+            :param get_values: returns the model values of a list of expressions
+        '''
+        keys, terms = [], []
+        for var in variables:
+            if isinstance(var, Array):
+                if var.index_max is None or var.index_max > consts.model_array_limit:
+                    continue
+                for index in range(var.index_max):
+                    keys.append((var.name, index))
+                    terms.append(ArraySelect(var, BitVecConstant(var.index_bits, index)))
+            else:
+                keys.append((var.name, None))
+                terms.append(var)
+
+        values = {}
+        for (name, index), value in zip(keys, get_values(terms)):
+            if index is None:
+                values[name] = value
+            else:
+                values.setdefault(name, {})[index] = value
+        constraints.update_model(values)
+
     def get_all_values(self, constraints, x, maxcnt=10000, silent=False):
         ''' Returns a list with all the possible values for the symbol x'''
         raise Exception("Abstract method not implemented")
@@ -83,6 +430,21 @@ class Solver(object, metaclass=ABCMeta):
             :param val: an expression or symbol '''
         raise Exception("Abstract method not implemented")
 
+    @instrumented
+    def get_values(self, constraints, expressions):
+        ''' Ask the solver for one assignment of several expressions that is
+            consistent for all of them at once.
+            :param expressions: a list of expressions or concrete values
+            :return: a list with a concrete value for each expression '''
+        with constraints as temp_cs:
+            result = []
+            for expression in expressions:
+                value = self.get_value(temp_cs, expression)
+                if issymbolic(expression):
+                    temp_cs.add(expression == value)
+                result.append(value)
+            return result
+
     def max(self, constraints, X, M=10000):
         ''' Iteratively finds the maximum value for a symbol.
             :param X: a symbol or expression
@@ -126,10 +488,15 @@ class Z3Solver(Solver):
         '''
         super().__init__()
         self._proc = None
+        # Incremental mode: assertion frames currently pushed into the solver
+        # process. Each entry is (constraint_set, constraint_list, lo, hi, names)
+        # None if the process holds untracked assertions
+        self._frames = []
 
         self._command = f'{consts.z3_bin} -t:{consts.timeout*1000} -memory:{consts.memory} -smt2 -in'
         self._init = ['(set-logic QF_AUFBV)', '(set-option :global-decls false)']
         self._get_value_fmt = (re.compile('\(\((?P<expr>(.*))\ #x(?P<value>([0-9a-fA-F]*))\)\)'), 16)
+        self._sexpr_token = re.compile(r'\(|\)|[^\s()]+')
 
         self.debug = False
         # To cache what get-info returned; can be directly set when writing tests
@@ -141,6 +508,9 @@ class Z3Solver(Solver):
         self.support_reset = True
         logger.debug('Z3 version: %s', self.version)
 
+        # Accumulated {'calls', 'checks', 'time'} of each optimize strategy
+        self.optimize_stats = collections.defaultdict(collections.Counter)
+
         if self.version >= Version(4, 5, 0):
             self.support_maximize = False
             self.support_minimize = False
@@ -203,6 +573,7 @@ class Z3Solver(Solver):
         except BaseException:
             pass
         self._proc = None
+        self._frames = []
 
     # marshaling/pickle
     def __getstate__(self):
@@ -223,6 +594,7 @@ class Z3Solver(Solver):
 
     def _reset(self, constraints=None):
         ''' Auxiliary method to reset the smtlib external solver to initial defaults'''
+        self._frames = []
         if self._proc is None:
             self._start_proc()
         else:
@@ -242,6 +614,7 @@ class Z3Solver(Solver):
             :param cmd: a SMTLIBv2 command (ex. (check-sat))
         '''
         logger.debug('>%s', cmd)
+        solver_stats.sent(cmd)
         try:
             self._proc.stdout.flush()
             self._proc.stdin.write('{}\n'.format(cmd))
@@ -272,13 +645,19 @@ class Z3Solver(Solver):
         return buf
 
     # UTILS: check-sat get-value
+    def _check_sat(self):
+        ''' Send a (check-sat) and return the raw answer '''
+        self._send('(check-sat)')
+        return self._recv()
+
     def _check(self):
         ''' Check the satisfiability of the current state '''
         logger.debug("Solver.check() ")
         start = time.time()
-        self._send('(check-sat)')
-        _status = self._recv()
-        logger.debug("Check took %s seconds (%s)", time.time() - start, _status)
+        _status = self._check_sat()
+        elapsed = time.time() - start
+        logger.debug("Check took %s seconds (%s)", elapsed, _status)
+        solver_stats.checked(_status, elapsed)
         if _status not in ('sat', 'unsat', 'unknown'):
             raise SolverException(_status)
         if consider_unknown_as_unsat:
@@ -294,7 +673,7 @@ class Z3Solver(Solver):
     def _assert(self, expression):
         ''' Auxiliary method to send an assert '''
         assert isinstance(expression, Bool)
-        smtlib = translate_to_smtlib(expression)
+        smtlib = translate_to_smtlib(expression, use_bindings=True)
         self._send('(assert %s)' % smtlib)
 
     def _getvalue(self, expression):
@@ -307,13 +686,7 @@ class Z3Solver(Solver):
         assert isinstance(expression, Variable)
 
         if isinstance(expression, Array):
-            result = bytearray()
-            for c in expression:
-                expression_str = translate_to_smtlib(c)
-                self._send('(get-value (%s))' % expression_str)
-                response = self._recv()
-                result.append(int('0x{:s}'.format(response.split(expression_str)[1][3:-2]), 16))
-            return bytes(result)
+            return bytes(self._getvalues([translate_to_smtlib(c, use_bindings=True) for c in expression]))
         else:
             self._send('(get-value (%s))' % expression.name)
             ret = self._recv()
@@ -329,6 +702,121 @@ class Z3Solver(Solver):
 
         raise NotImplementedError("_getvalue only implemented for Bool and BitVec")
 
+    def _getvalues(self, expressions):
+        ''' Ask the solver for the value of several smtlib terms in a single
+            (get-value ...) round trip.
+            The current set of assertions must be sat.
+            :param expressions: smtlib terms
+            :return: the list of values, int for BitVecs and bool for Bools '''
+        if not expressions:
+            return []
+        self._send('(get-value (%s))' % ' '.join(expressions))
+        ret = self._recv()
+
+        # Parse the ((term value) (term value) ...) response as nested lists
+        stack = [[]]
+        for token in self._sexpr_token.findall(ret):
+            if token == '(':
+                stack.append([])
+            elif token == ')':
+                if len(stack) < 2:
+                    raise SolverException('SMTLIB error parsing response: %s' % ret)
+                item = stack.pop()
+                stack[-1].append(item)
+            else:
+                stack[-1].append(token)
+        if len(stack) != 1 or len(stack[0]) != 1 or len(stack[0][0]) != len(expressions):
+            raise SolverException('SMTLIB error parsing response: %s' % ret)
+
+        values = []
+        for pair in stack[0][0]:
+            value = pair[-1]
+            if value.startswith('#x'):
+                values.append(int(value[2:], 16))
+            elif value.startswith('#b'):
+                values.append(int(value[2:], 2))
+            elif value in ('true', 'false'):
+                values.append(value == 'true')
+            else:
+                raise SolverException('SMTLIB error parsing response: %s' % ret)
+        return values
+
+    def _start_query(self, constraints, related_to=None):
+        ''' Auxiliary method to load `constraints` in the solver before a query.
+            Any assertion sent after this is discarded by the next query.
+            :param constraints: the constraint set the query runs under
+            :param related_to: if not incremental, only send the constraints related to this expression
+        '''
+        if not consts.incremental:
+            self._reset(constraints.to_string(related_to=related_to))
+            # The process holds assertions outside of any tracked frame
+            self._frames = None
+            return
+        try:
+            self._sync(constraints)
+            # Scratch frame for the query specific assertions
+            self._push()
+            self._frames.append((None, None, 0, 0, set()))
+        except Exception:
+            self._stop_proc()
+            raise
+
+    def _sync(self, constraints):
+        ''' Make the assertion stack of the solver process match `constraints`.
+            Frames shared with the previous query are kept, diverging ones are
+            popped and only the missing constraints are pushed.
+        '''
+        chain = []
+        cs = constraints
+        while cs is not None:
+            chain.append(cs)
+            cs = cs._parent
+        chain.reverse()
+
+        # Find how many of the already pushed frames are a prefix of constraints
+        position, offset, keep = 0, 0, 0
+        for cs, constraint_list, lo, hi, _ in self._frames or ():
+            while position < len(chain) and offset == len(chain[position]._constraints):
+                position, offset = position + 1, 0
+            if position == len(chain) or cs is not chain[position]:
+                break
+            if cs._constraints is not constraint_list or lo != offset or hi > len(constraint_list):
+                break
+            offset = hi
+            keep += 1
+
+        if self._frames is None or keep == 0 and self._frames:
+            # Unrelated constraint lineage, start from scratch
+            logger.debug('Rebuilding solver for an unrelated constraint set')
+            self._reset()
+        elif keep < len(self._frames):
+            self._send('(pop %d)' % (len(self._frames) - keep))
+            del self._frames[keep:]
+
+        if self._proc is None:
+            self._reset()
+
+        declared = set()
+        for frame in self._frames:
+            declared |= frame[4]
+
+        # Push the missing delta of each constraint set in the chain
+        while position < len(chain):
+            cs = chain[position]
+            constraint_list = cs._constraints
+            if offset < len(constraint_list):
+                names = set()
+                self._push()
+                self._frames.append((cs, constraint_list, offset, len(constraint_list), names))
+                for constraint in constraint_list[offset:]:
+                    for var in constraint.variables:
+                        if var.name not in declared:
+                            self._send(var.declaration)
+                            declared.add(var.name)
+                            names.add(var.name)
+                    self._send(constraint_to_smtlib(constraint))
+            position, offset = position + 1, 0
+
     # push pop
     def _push(self):
         ''' Pushes and save the current constraint store and state.'''
@@ -338,7 +826,8 @@ class Z3Solver(Solver):
         ''' Recall the last pushed constraint store and state. '''
         self._send('(pop 1)')
 
-    #@memoized
+    @instrumented
+    @memoized
     def can_be_true(self, constraints, expression):
         ''' Check if two potentially symbolic values can be equal '''
         if isinstance(expression, bool):
@@ -346,17 +835,34 @@ class Z3Solver(Solver):
                 return expression
             else:
                 #if True check if constraints are feasible
-                self._reset(constraints)
-                return self._check() == 'sat'
+                if consts.model_cache and constraints.model_satisfies(expression):
+                    return True
+                self._start_query(constraints)
+                if self._check() != 'sat':
+                    return False
+                if consts.model_cache:
+                    self._update_model(constraints, constraints.get_related_variables(), self._model_values)
+                return True
         assert isinstance(expression, Bool)
+        if consts.model_cache and constraints.model_satisfies(expression):
+            return True
 
         with constraints as temp_cs:
             temp_cs.add(expression)
-            self._reset(temp_cs.to_string(related_to=expression))
-            return self._check() == 'sat'
+            self._start_query(temp_cs, related_to=expression)
+            if self._check() != 'sat':
+                return False
+            if consts.model_cache:
+                self._update_model(constraints, temp_cs.get_related_variables(expression), self._model_values)
+            return True
+
+    def _model_values(self, terms):
+        ''' Values of terms in the current model '''
+        return self._getvalues([translate_to_smtlib(term, use_bindings=True) for term in terms])
 
     # get-all-values min max minmax
-    #@memoized
+    @instrumented
+    @memoized
     def get_all_values(self, constraints, expression, maxcnt=None, silent=False):
         ''' Returns a list with all the possible values for the symbol x'''
         if not isinstance(expression, Expression):
@@ -378,7 +884,7 @@ class Z3Solver(Solver):
                 raise NotImplementedError("get_all_values only implemented for Bool and BitVec")
 
             temp_cs.add(var == expression)
-            self._reset(temp_cs.to_string(related_to=var))
+            self._start_query(temp_cs, related_to=var)
 
             result = []
             val = None
@@ -399,7 +905,8 @@ class Z3Solver(Solver):
 
             return result
 
-    #@memoized
+    @instrumented
+    @memoized
     def optimize(self, constraints, x, goal, M=10000):
         ''' Iteratively finds the maximum or minimal value for the operation
             (Normally Operators.UGT or Operators.ULT)
@@ -414,7 +921,7 @@ class Z3Solver(Solver):
             X = temp_cs.new_bitvec(x.size)
             temp_cs.add(X == x)
             aux = temp_cs.new_bitvec(X.size, name='optimized_')
-            self._reset(temp_cs.to_string(related_to=X))
+            self._start_query(temp_cs, related_to=X)
             self._send(aux.declaration)
 
             if getattr(self, 'support_{}'.format(goal)):
@@ -446,24 +953,75 @@ class Z3Solver(Solver):
                         return int(value)
                 finally:
                     self._pop()
-                    self._reset(temp_cs)
+                    self._start_query(temp_cs)
                     self._send(aux.declaration)
 
-            operation = {'maximize': Operators.UGT, 'minimize': Operators.ULT}[goal]
             self._assert(aux == X)
-            last_value = None
-            i = 0
-            while self._check() == 'sat':
-                last_value = self._getvalue(aux)
-                self._assert(operation(aux, last_value))
-                i = i + 1
-                if (i > M):
-                    raise SolverException("Optimizing error, maximum number of iterations was reached")
+            strategy = consts.optimize_strategy
+            if strategy not in ('bitwise', 'linear'):
+                raise SolverException("Unknown optimize strategy '{}'".format(strategy))
+
+            start = time.time()
+            checks = 0
+            try:
+                if strategy == 'bitwise':
+                    last_value, checks = self._optimize_bitwise(aux, goal)
+                else:
+                    last_value, checks = self._optimize_linear(aux, goal, M)
+            finally:
+                elapsed = time.time() - start
+                stats = self.optimize_stats[strategy]
+                stats['calls'] += 1
+                stats['checks'] += checks
+                stats['time'] += elapsed
+                logger.debug('%s took %d checks and %f seconds (%s)', goal, checks, elapsed, strategy)
+
             if last_value is not None:
                 return last_value
             raise SolverException("Optimizing error, unsat or unknown core")
 
-    #@memoized
+    def _optimize_linear(self, aux, goal, M):
+        ''' Ask for a better solution than the last one until there is none.
+            :return: the optimum (or None if unsat) and the number of checks '''
+        operation = {'maximize': Operators.UGT, 'minimize': Operators.ULT}[goal]
+        last_value = None
+        i = 0
+        while self._check() == 'sat':
+            last_value = self._getvalue(aux)
+            self._assert(operation(aux, last_value))
+            i = i + 1
+            if (i > M):
+                raise SolverException("Optimizing error, maximum number of iterations was reached")
+        return last_value, i + 1
+
+    def _optimize_bitwise(self, aux, goal):
+        ''' Fix the bits of the optimum from the most significant one down.
+            For each bit the last solution does not already have at its best
+            value, check in a pushed frame if there is a solution that keeps
+            the higher bits and flips it. Needs at most aux.size + 1 checks.
+            :return: the optimum (or None if unsat) and the number of checks '''
+        checks = 1
+        if self._check() != 'sat':
+            return None, checks
+        value = self._getvalue(aux)
+        mask = (1 << aux.size) - 1
+        for i in reversed(range(aux.size)):
+            bit = 1 << i
+            if bool(value & bit) == (goal == 'maximize'):
+                continue
+            prefix = mask & ~(bit - 1)
+            self._push()
+            try:
+                self._assert((aux & prefix) == ((value & prefix) ^ bit))
+                checks += 1
+                if self._check() == 'sat':
+                    value = self._getvalue(aux)
+            finally:
+                self._pop()
+        return value, checks
+
+    @instrumented
+    @memoized
     def get_value(self, constraints, expression):
         ''' Ask the solver for one possible assignment for val using current set
             of constraints.
@@ -479,29 +1037,20 @@ class Z3Solver(Solver):
                 var = temp_cs.new_bitvec(expression.size)
             elif isinstance(expression, Array):
                 var = []
-                result = []
                 for i in range(expression.index_max):
                     subvar = temp_cs.new_bitvec(expression.value_bits)
                     var.append(subvar)
                     temp_cs.add(subvar == expression[i])
 
-                self._reset(temp_cs)
+                self._start_query(temp_cs)
                 if self._check() != 'sat':
                     raise SolverException('Model is not available')
 
-                for i in range(expression.index_max):
-                    self._send('(get-value (%s))' % var[i].name)
-                    ret = self._recv()
-                    assert ret.startswith('((') and ret.endswith('))')
-                    pattern, base = self._get_value_fmt
-                    m = pattern.match(ret)
-                    expr, value = m.group('expr'), m.group('value')
-                    result.append(int(value, base))
-                return bytes(result)
+                return bytes(self._getvalues([subvar.name for subvar in var]))
 
             temp_cs.add(var == expression)
 
-            self._reset(temp_cs)
+            self._start_query(temp_cs)
 
         if self._check() != 'sat':
             raise SolverException('Model is not available')
@@ -520,5 +1069,525 @@ class Z3Solver(Solver):
             return int(value, base)
         raise NotImplementedError("get_value only implemented for Bool and BitVec")
 
+    @instrumented
+    def get_values(self, constraints, expressions):
+        ''' Ask the solver for one assignment of several expressions that is
+            consistent for all of them at once. Uses a single check and a single
+            (get-value ...) round trip.
+            :param expressions: a list of expressions or concrete values
+            :return: a list with a concrete value for each expression '''
+        with constraints as temp_cs:
+            names = []
+            for expression in expressions:
+                if not issymbolic(expression):
+                    continue
+                assert isinstance(expression, (Bool, BitVec, Array))
+                if isinstance(expression, Array):
+                    for i in range(expression.index_max):
+                        subvar = temp_cs.new_bitvec(expression.value_bits)
+                        temp_cs.add(subvar == expression[i])
+                        names.append(subvar.name)
+                else:
+                    if isinstance(expression, Bool):
+                        var = temp_cs.new_bool()
+                    else:
+                        var = temp_cs.new_bitvec(expression.size)
+                    temp_cs.add(var == expression)
+                    names.append(var.name)
+
+            if not names:
+                return list(expressions)
+
+            self._start_query(temp_cs)
+            if self._check() != 'sat':
+                raise SolverException('Model is not available')
+            values = iter(self._getvalues(names))
+
+        result = []
+        for expression in expressions:
+            if not issymbolic(expression):
+                result.append(expression)
+            elif isinstance(expression, Array):
+                result.append(bytes(next(values) for _ in range(expression.index_max)))
+            else:
+                result.append(next(values))
+        return result
+
+
+class PortfolioSolver(Z3Solver):
+    ''' Races every check across several SMT-LIB solver processes
+
+    All the processes get the same commands and the first definitive answer to
+    (check-sat) wins. The other processes are killed and the rest of the query
+    (e.g. get-value) is served by the winner. The next query starts the whole
+    portfolio again.
+    '''
+
+    def __init__(self):
+        self._procs = []
+        self._commands = self._portfolio_commands()
+        if not self._commands:
+            raise Z3NotFoundError
+        # Number of races won by each command
+        self.wins = collections.Counter()
+        super().__init__()
+
+    @staticmethod
+    def _portfolio_commands():
+        ''' Command lines of the portfolio members present in the system '''
+        if consts.portfolio_commands:
+            commands = [c.strip() for c in consts.portfolio_commands.split(';') if c.strip()]
+        else:
+            command = f'{consts.z3_bin} -t:{consts.timeout*1000} -memory:{consts.memory} -smt2 -in'
+            commands = [f'{command} smt.random_seed={seed} sat.random_seed={seed}' for seed in range(consts.portfolio_size)]
+
+        available = []
+        for command in commands:
+            if shutil.which(shlex.split(command)[0]) is None:
+                logger.warning("Portfolio solver '%s' not found, ignoring it", command)
+            else:
+                available.append(command)
+        return available
+
+    def _solver_version(self):
+        ''' Version of the z3 binary, used to select the supported features '''
+        if self._received_version is None:
+            try:
+                self._received_version = check_output([consts.z3_bin, '-smt2', '-in'],
+                                                      input='(get-info :version)\n',
+                                                      universal_newlines=True).strip()
+            except Exception as e:
+                logger.debug('Could not get the z3 version: %s', e)
+                return Version(0, 0, 0)
+        return super()._solver_version()
+
+    def _start_proc(self):
+        ''' Spawn a process for each command of the portfolio '''
+        assert not self._procs
+        for command in self._commands:
+            try:
+                proc = Popen(shlex.split(command), stdin=PIPE, stdout=PIPE, bufsize=0, universal_newlines=True)
+            except OSError as e:
+                logger.warning("Could not start portfolio solver '%s': %s", command, e)
+                continue
+            self._procs.append((command, proc))
+        if not self._procs:
+            raise Z3NotFoundError
+        self._proc = self._procs[0][1]
+
+        for cfg in self._init:
+            self._send(cfg)
+
+    def _stop_proc(self):
+        ''' Kill all the processes of the portfolio '''
+        for command, proc in self._procs:
+            self._kill(proc)
+        self._procs = []
+        self._proc = None
+        self._frames = []
+
+    @staticmethod
+    def _kill(proc):
+        try:
+            proc.kill()
+            proc.wait()
+            proc.stdin.close()
+            proc.stdout.close()
+        except (OSError, ValueError) as e:
+            logger.debug(str(e))
+
+    def _reset(self, constraints=None):
+        # The losers of the last race were killed, start all over again
+        if self._proc is not None and len(self._procs) < len(self._commands):
+            self._stop_proc()
+        super()._reset(constraints)
+
+    def _start_query(self, constraints, related_to=None):
+        # There are no frames to reuse as the losers are killed after each race
+        self._reset(constraints.to_string(related_to=related_to))
+        self._frames = None
+
+    def _send(self, cmd):
+        ''' Send a string to every live solver of the portfolio '''
+        logger.debug('>%s', cmd)
+        solver_stats.sent(cmd)
+        alive = []
+        for command, proc in self._procs:
+            try:
+                proc.stdin.write('{}\n'.format(cmd))
+                alive.append((command, proc))
+            except IOError as e:
+                logger.debug("Portfolio solver '%s' died: %s", command, e)
+                self._kill(proc)
+        if not alive:
+            raise SolverException('All the portfolio solvers died')
+        self._procs = alive
+        if all(proc is not self._proc for _, proc in alive):
+            self._proc = alive[0][1]
+
+    def _check_sat(self):
+        ''' Send a (check-sat) to every solver and keep the first one to give
+            a definitive answer.
+        '''
+        self._send('(check-sat)')
+        if len(self._procs) == 1:
+            status = self._recv()
+            while status in ('success', 'unsupported'):
+                status = self._recv()
+            return status
+
+        status = None
+        buffers = {}
+        with selectors.DefaultSelector() as selector:
+            for command, proc in self._procs:
+                selector.register(proc.stdout.fileno(), selectors.EVENT_READ, (command, proc))
+                buffers[proc] = ''
+
+            while selector.get_map():
+                for key, _ in selector.select():
+                    command, proc = key.data
+                    data = os.read(key.fd, 4096).decode()
+                    if not data:
+                        logger.debug("Portfolio solver '%s' died", command)
+                        selector.unregister(key.fd)
+                        continue
+                    buffers[proc] += data
+                    while '\n' in buffers[proc]:
+                        line, buffers[proc] = buffers[proc].split('\n', 1)
+                        line = line.strip()
+                        # Acknowledgements of commands other solvers take silently
+                        if line in ('', 'success', 'unsupported'):
+                            continue
+                        if line in ('sat', 'unsat'):
+                            self._won(command, proc)
+                            return line
+                        if line == 'unknown':
+                            status = line
+                        else:
+                            logger.debug("Portfolio solver '%s' failed: %s", command, line)
+                            status = status or line
+                        selector.unregister(key.fd)
+                        break
+
+        # Nobody got a definitive answer
+        return status or 'unknown'
+
+    def _won(self, command, proc):
+        ''' Keep only the process of the winner of a race '''
+        logger.debug("Portfolio solver '%s' won", command)
+        self.wins[command] += 1
+        for other_command, other in self._procs:
+            if other is not proc:
+                self._kill(other)
+        self._procs = [(command, proc)]
+        self._proc = proc
+
+
+class TranslatorZ3(Translator):
+    ''' Simple visitor to translate an expression into a z3 Python API AST
+    '''
+
+    _translation_table = None
+
+    def __init__(self, z3, *args, **kw):
+        super().__init__(*args, **kw)
+        self._z3 = z3
+        if TranslatorZ3._translation_table is None:
+            TranslatorZ3._translation_table = self._table()
+
+    def _table(self):
+        z3 = self._z3
+        return {
+            BoolNot: z3.Not,
+            BoolEq: lambda a, b: a == b,
+            BoolAnd: z3.And,
+            BoolOr: z3.Or,
+            BoolXor: z3.Xor,
+            BoolITE: z3.If,
+            BitVecAdd: lambda a, b: a + b,
+            BitVecSub: lambda a, b: a - b,
+            BitVecMul: lambda a, b: a * b,
+            BitVecDiv: lambda a, b: a / b,
+            BitVecUnsignedDiv: z3.UDiv,
+            BitVecMod: lambda a, b: a % b,
+            BitVecRem: z3.SRem,
+            BitVecUnsignedRem: z3.URem,
+            BitVecShiftLeft: lambda a, b: a << b,
+            BitVecShiftRight: z3.LShR,
+            BitVecArithmeticShiftLeft: lambda a, b: a << b,
+            BitVecArithmeticShiftRight: lambda a, b: a >> b,
+            BitVecAnd: lambda a, b: a & b,
+            BitVecOr: lambda a, b: a | b,
+            BitVecXor: lambda a, b: a ^ b,
+            BitVecNot: lambda a: ~a,
+            BitVecNeg: lambda a: -a,
+            LessThan: lambda a, b: a < b,
+            LessOrEqual: lambda a, b: a <= b,
+            Equal: lambda a, b: a == b,
+            GreaterThan: lambda a, b: a > b,
+            GreaterOrEqual: lambda a, b: a >= b,
+            UnsignedLessThan: z3.ULT,
+            UnsignedLessOrEqual: z3.ULE,
+            UnsignedGreaterThan: z3.UGT,
+            UnsignedGreaterOrEqual: z3.UGE,
+            BitVecITE: z3.If,
+            ArrayStore: z3.Store,
+            ArraySelect: z3.Select,
+        }
+
+    def visit_BitVecConstant(self, expression):
+        return self._z3.BitVecVal(expression.value & expression.mask, expression.size)
+
+    def visit_BoolConstant(self, expression):
+        return self._z3.BoolVal(expression.value)
+
+    def visit_BitVecVariable(self, expression):
+        return self._z3.BitVec(expression.name, expression.size)
+
+    def visit_BoolVariable(self, expression):
+        return self._z3.Bool(expression.name)
+
+    def visit_ArrayVariable(self, expression):
+        z3 = self._z3
+        return z3.Array(expression.name, z3.BitVecSort(expression.index_bits), z3.BitVecSort(expression.value_bits))
+
+    def visit_BitVecSignExtend(self, expression, operand):
+        return self._z3.SignExt(expression.extend, operand)
+
+    def visit_BitVecZeroExtend(self, expression, operand):
+        return self._z3.ZeroExt(expression.extend, operand)
+
+    def visit_BitVecExtract(self, expression, operand):
+        return self._z3.Extract(expression.end, expression.begining, operand)
+
+    def visit_BitVecConcat(self, expression, *operands):
+        if len(operands) == 1:
+            return operands[0]
+        return self._z3.Concat(*operands)
+
+    def visit_Operation(self, expression, *operands):
+        return self._translation_table[type(expression)](*operands)
+
+
+class Z3APISolver(Solver):
+    """Z3 API Solver
+    Builds z3 ASTs straight from the expressions and solves them in process
+    through the z3 Python bindings. Saves the SMT-LIB serialization and
+    response parsing round trips of :class:`Z3Solver`.
+    """
+    def __init__(self):
+        super().__init__()
+        try:
+            import z3
+        except ImportError:
+            raise Z3NotFoundError
+        self._z3 = z3
+        z3.set_param('memory_max_size', consts.memory)
+        # Translated sub-ASTs, shared by all the queries of this solver
+        self._cache = LRUCache('z3_translation', 150000, 'Maximum number of z3 ASTs kept per z3 API solver')
+
+    def _translate(self, expression):
+        if isinstance(expression, ArrayProxy):
+            expression = expression.array
+        translator = TranslatorZ3(self._z3, cache=self._cache)
+        translator.visit(expression)
+        return translator.result
+
+    def _solver(self, constraints, related_to=None, optimize=False):
+        ''' Auxiliary method to build a z3 solver asserting `constraints` '''
+        if optimize:
+            z3_solver = self._z3.Optimize()
+        else:
+            z3_solver = self._z3.Solver()
+        z3_solver.set('timeout', consts.timeout * 1000)
+        if isinstance(related_to, ArrayProxy):
+            related_to = related_to.array
+        related = constraints.get_related_constraints(related_to)
+        for constraint in related:
+            z3_solver.add(self._translate(constraint))
+        if solver_stats.query is not None:
+            solver_stats.asserted(len(related), len(constraints.get_related_variables(related_to)))
+        return z3_solver
+
+    def _check(self, z3_solver):
+        ''' Check the satisfiability of the z3 solver '''
+        start = time.time()
+        _status = str(z3_solver.check())
+        elapsed = time.time() - start
+        logger.debug("Check took %s seconds (%s)", elapsed, _status)
+        solver_stats.checked(_status, elapsed)
+        if consider_unknown_as_unsat:
+            if _status == 'unknown':
+                logger.warning('Found an unknown core, probably a solver timeout')
+                _status = 'unsat'
+
+        if _status == 'unknown':
+            raise SolverUnknown(_status)
+
+        return _status
+
+    def _getvalue(self, model, expression, term):
+        ''' Read the value of `expression` (translated as `term`) out of `model` '''
+        z3 = self._z3
+        if isinstance(expression, Array):
+            index_sort = z3.BitVecSort(expression.index_bits)
+            values = [model.eval(z3.Select(term, z3.BitVecVal(i, index_sort)), model_completion=True)
+                      for i in range(expression.index_max)]
+            return bytes(value.as_long() for value in values)
+        value = model.eval(term, model_completion=True)
+        if isinstance(expression, Bool):
+            return z3.is_true(value)
+        return value.as_long()
+
+    def _differ(self, expression, term, value):
+        ''' A z3 condition excluding `value` as a solution of `term` '''
+        z3 = self._z3
+        if isinstance(expression, Array):
+            index_sort = z3.BitVecSort(expression.index_bits)
+            return z3.Or([z3.Select(term, z3.BitVecVal(i, index_sort)) != z3.BitVecVal(byte, expression.value_bits)
+                          for i, byte in enumerate(value)])
+        if isinstance(expression, Bool):
+            return term != z3.BoolVal(value)
+        return term != z3.BitVecVal(value, expression.size)
+
+    @instrumented
+    @memoized
+    def can_be_true(self, constraints, expression):
+        ''' Check if two potentially symbolic values can be equal '''
+        if isinstance(expression, bool):
+            if not expression:
+                return expression
+            else:
+                #if True check if constraints are feasible
+                related_to = None
+                if consts.model_cache and constraints.model_satisfies(expression):
+                    return True
+                z3_solver = self._solver(constraints)
+        else:
+            assert isinstance(expression, Bool)
+            related_to = expression
+            if consts.model_cache and constraints.model_satisfies(expression):
+                return True
+            z3_solver = self._solver(constraints, related_to=expression)
+            z3_solver.add(self._translate(expression))
+
+        if self._check(z3_solver) != 'sat':
+            return False
+        if consts.model_cache:
+            model = z3_solver.model()
+            self._update_model(constraints, constraints.get_related_variables(related_to),
+                               lambda terms: [self._getvalue(model, term, self._translate(term)) for term in terms])
+        return True
+
+    @instrumented
+    @memoized
+    def get_all_values(self, constraints, expression, maxcnt=None, silent=False):
+        ''' Returns a list with all the possible values for the symbol x'''
+        if not isinstance(expression, Expression):
+            return [expression]
+        assert isinstance(constraints, ConstraintSet)
+        if not isinstance(expression, (Bool, BitVec, Array)):
+            raise NotImplementedError("get_all_values only implemented for Bool and BitVec")
+
+        if maxcnt is None:
+            maxcnt = consts.maxsolutions
+
+        z3_solver = self._solver(constraints, related_to=expression)
+        term = self._translate(expression)
+        result = []
+        while self._check(z3_solver) == 'sat':
+            value = self._getvalue(z3_solver.model(), expression, term)
+            result.append(value)
+            z3_solver.add(self._differ(expression, term, value))
+
+            if len(result) >= maxcnt:
+                if silent:
+                    break
+                else:
+                    raise TooManySolutions(result)
+
+        return result
+
+    @instrumented
+    @memoized
+    def optimize(self, constraints, x, goal, M=10000):
+        ''' Finds the maximum or minimal value for x using z3's optimizer
+            :param X: a symbol or expression
+            :param M: unused, the optimizer does not iterate
+        '''
+        assert goal in ('maximize', 'minimize')
+        assert isinstance(x, BitVec)
+
+        z3_optimizer = self._solver(constraints, related_to=x, optimize=True)
+        term = self._translate(x)
+        getattr(z3_optimizer, goal)(term)
+        if self._check(z3_optimizer) == 'sat':
+            return self._getvalue(z3_optimizer.model(), x, term)
+        raise SolverException("Optimizing error, unsat or unknown core")
+
+    @instrumented
+    @memoized
+    def get_value(self, constraints, expression):
+        ''' Ask the solver for one possible assignment for val using current set
+            of constraints.
+            The current set of assertions must be sat.
+            :param val: an expression or symbol '''
+        if not issymbolic(expression):
+            return expression
+        assert isinstance(expression, (Bool, BitVec, Array))
+
+        z3_solver = self._solver(constraints)
+        term = self._translate(expression)
+        if self._check(z3_solver) != 'sat':
+            raise SolverException('Model is not available')
+        return self._getvalue(z3_solver.model(), expression, term)
+
+    @instrumented
+    def get_values(self, constraints, expressions):
+        ''' Ask the solver for one assignment of several expressions that is
+            consistent for all of them at once, read from a single model.
+            :param expressions: a list of expressions or concrete values
+            :return: a list with a concrete value for each expression '''
+        if not any(issymbolic(expression) for expression in expressions):
+            return list(expressions)
+
+        z3_solver = self._solver(constraints)
+        if self._check(z3_solver) != 'sat':
+            raise SolverException('Model is not available')
+        model = z3_solver.model()
+        result = []
+        for expression in expressions:
+            if issymbolic(expression):
+                result.append(self._getvalue(model, expression, self._translate(expression)))
+            else:
+                result.append(expression)
+        return result
+
+
+class ConfiguredSolver(object):
+    """ Solver selected by the `smt.solver` configuration
+
+    Forwards every call to an instance of the configured backend, created the
+    first time it is used. The configuration can then be set after import.
+    """
+    backends = {'z3': Z3Solver,
+                'z3api': Z3APISolver,
+                'portfolio': PortfolioSolver}
+
+    def __init__(self):
+        self._instances = {}
+
+    @property
+    def backend(self):
+        name = consts.solver
+        if name not in self._instances:
+            if name not in self.backends:
+                raise SolverException("Solver '{}' not supported. Use one of: {}".format(name, ', '.join(self.backends)))
+            self._instances[name] = self.backends[name]()
+        return self._instances[name]
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
 
-solver = Z3Solver()
+solver = ConfiguredSolver()
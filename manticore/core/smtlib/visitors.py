@@ -1,11 +1,15 @@
-from manticore.utils.helpers import CacheDict
+from manticore.utils.cache import LRUCache, get_cache, memoize
 from .expression import *
-from functools import lru_cache
+import copy
 import logging
 import operator
 logger = logging.getLogger(__name__)
 
 
+# Stack marker used by Visitor.visit
+_OPERANDS_DONE = object()
+
+
 class Visitor(object):
     ''' Class/Type Visitor
 
@@ -31,6 +35,9 @@ class Visitor(object):
 
     '''
 
+    # (visitor class, expression class) -> visit_ functions, see _dispatch
+    _dispatch_table = {}
+
     def __init__(self, cache=None, **kwargs):
         super().__init__()
         self._stack = []
@@ -51,20 +58,35 @@ class Visitor(object):
         assert len(self._stack) == 1
         return self._stack[-1]
 
+    @classmethod
+    def _dispatch(cls, expression_class):
+        ''' The visit_ functions to try, in __mro__ order, for an expression
+            class. Resolved once per (visitor class, expression class) pair.
+        '''
+        try:
+            return cls._dispatch_table[cls, expression_class]
+        except KeyError:
+            pass
+        assert expression_class.__mro__[-1] is object
+        methods = []
+        for klass in expression_class.__mro__:
+            method = getattr(cls, 'visit_%s' % klass.__name__, None)
+            if method is not None:
+                methods.append(method)
+        methods = tuple(methods)
+        cls._dispatch_table[cls, expression_class] = methods
+        return methods
+
     def _method(self, expression, *args):
         #Special case. Need to get the unsleeved version of the array
         if isinstance(expression, ArrayProxy):
             expression = expression.array
 
-        assert expression.__class__.__mro__[-1] is object
-        for cls in expression.__class__.__mro__:
-            sort = cls.__name__
-            methodname = 'visit_%s' % sort
-            if hasattr(self, methodname):
-                value = getattr(self, methodname)(expression, *args)
-                if value is not None:
-                    assert isinstance(value, Expression)
-                    return value
+        for method in self._dispatch(type(expression)):
+            value = method(self, expression, *args)
+            if value is not None:
+                assert isinstance(value, Expression)
+                return value
         return self._rebuild(expression, args)
 
     def visit(self, node, use_fixed_point=False):
@@ -80,27 +102,35 @@ class Visitor(object):
         :type use_fixed_point: Bool
         '''
         cache = self._cache
-        visited = set()
-        stack = []
-        stack.append(node)
+        results = self._stack
+        method = self._method
+        # An operation is pushed again below this marker while its operands
+        # are explored, finding the marker means the operands are done
+        stack = [node]
         while stack:
             node = stack.pop()
-            if node in cache:
-                self.push(cache[node])
-            elif isinstance(node, Operation):
-                if node in visited:
-                    operands = [self.pop() for _ in range(len(node.operands))]
-                    value = self._method(node, *operands)
-
-                    visited.remove(node)
-                    self.push(value)
-                    cache[node] = value
+            if node is _OPERANDS_DONE:
+                node = stack.pop()
+                arity = len(node.operands)
+                if arity:
+                    operands = results[:-arity - 1:-1]
+                    del results[-arity:]
                 else:
-                    visited.add(node)
-                    stack.append(node)
-                    stack.extend(node.operands)
+                    operands = ()
+                value = method(node, *operands)
+                assert value is not None
+                results.append(value)
+                cache[node] = value
+            elif node in cache:
+                results.append(cache[node])
+            elif isinstance(node, Operation):
+                stack.append(node)
+                stack.append(_OPERANDS_DONE)
+                stack.extend(node.operands)
             else:
-                self.push(self._method(node))
+                value = method(node)
+                assert value is not None
+                results.append(value)
 
         if use_fixed_point:
             old_value = None
@@ -120,6 +150,8 @@ class Visitor(object):
                 import copy
                 aux = copy.copy(expression)
                 aux._operands = operands
+                if consts.hash_cons:
+                    return hash_cons(aux)
                 return aux
         return expression
 
@@ -132,14 +164,10 @@ class Translator(Visitor):
         #Special case. Need to get the unsleeved version of the array
         if isinstance(expression, ArrayProxy):
             expression = expression.array
-        assert expression.__class__.__mro__[-1] is object
-        for cls in expression.__class__.__mro__:
-            sort = cls.__name__
-            methodname = 'visit_{:s}'.format(sort)
-            if hasattr(self, methodname):
-                value = getattr(self, methodname)(expression, *args)
-                if value is not None:
-                    return value
+        for method in self._dispatch(type(expression)):
+            value = method(self, expression, *args)
+            if value is not None:
+                return value
         raise Exception("No translation for this {}".format(expression))
 
 
@@ -184,9 +212,7 @@ def get_depth(exp):
     :rtype: int
 
     """
-    visitor = GetDepth()
-    visitor.visit(exp)
-    return visitor.result
+    return exp.depth
 
 
 class PrettyPrinter(Visitor):
@@ -221,15 +247,9 @@ class PrettyPrinter(Visitor):
         Overload Visitor._method because we want to stop to iterate over the
         visit_ functions as soon as a valid visit_ function is found
         '''
-        assert expression.__class__.__mro__[-1] is object
-        for cls in expression.__class__.__mro__:
-            sort = cls.__name__
-            methodname = 'visit_%s' % sort
-            method = getattr(self, methodname, None)
-            if method is not None:
-                method(expression, *args)
-                return
-        return
+        methods = self._dispatch(type(expression))
+        if methods:
+            methods[0](self, expression, *args)
 
     def visit_Operation(self, expression, *operands):
         self._print(expression.__class__.__name__, expression)
@@ -368,10 +388,9 @@ class ConstantFolderSimplifier(Visitor):
         return expression
 
 
-constant_folder_simplifier_cache = CacheDict(max_size=150000, flush_perc=25)
+constant_folder_simplifier_cache = get_cache('constant_folder', 150000, 'Maximum number of expressions cached by the constant folder')
 
 
-@lru_cache(maxsize=128)
 def constant_folder(expression):
     global constant_folder_simplifier_cache
     simp = ConstantFolderSimplifier(cache=constant_folder_simplifier_cache)
@@ -423,7 +442,7 @@ class ArithmeticSimplifier(Visitor):
                 result = expression.operands[2]
             import copy
             result = copy.copy(result)
-            result._taint |= expression.operands[0].taint
+            result._taint |= expression.operands[0]._taint
             return result
         if self._changed(expression, operands):
             return BitVecITE(expression.size, *operands, taint=expression.taint)
@@ -572,10 +591,9 @@ class ArithmeticSimplifier(Visitor):
         return expression
 
 
-arithmetic_simplifier_cache = CacheDict(max_size=150000, flush_perc=25)
+arithmetic_simplifier_cache = get_cache('arithmetic_simplifier', 150000, 'Maximum number of expressions cached by the arithmetic simplifier')
 
 
-@lru_cache(maxsize=128)
 def arithmetic_simplify(expression):
     global arithmetic_simplifier_cache
     simp = ArithmeticSimplifier(cache=arithmetic_simplifier_cache)
@@ -583,6 +601,422 @@ def arithmetic_simplify(expression):
     return simp.result
 
 
+class RewriteRules(object):
+    ''' A named set of rewrite rules for :class:`RewriteSimplifier`
+
+    A rule is a function taking the expression to rewrite and returning its
+    replacement, or None if it does not apply. It is registered for a
+    pattern: the class of the expression and, optionally, the classes of its
+    operands (None matches any operand)::
+
+        @common_rules.rule(BitVecExtract, BitVecConcat)
+        def extract_concat(expression):
+            ...
+
+    A rule set also applies the rules of the sets it includes, first.
+    '''
+
+    # Bumped on every registration, invalidates the per class tables
+    _version = 0
+
+    def __init__(self, name, include=()):
+        self.name = name
+        self.include = tuple(include)
+        self._rules = []
+        self._table = {}
+        self._table_version = None
+        rewrite_rule_sets[name] = self
+
+    def rule(self, cls, *operands):
+        ''' Decorator registering a rule for expressions of `cls` whose
+            operands are instances of `operands` '''
+        def register(function):
+            self._rules.append((cls, operands, function))
+            RewriteRules._version += 1
+            return function
+        return register
+
+    @property
+    def rules(self):
+        for included in self.include:
+            yield from included.rules
+        yield from self._rules
+
+    def _candidates(self, expression_class):
+        if self._table_version != RewriteRules._version:
+            self._table = {}
+            self._table_version = RewriteRules._version
+        try:
+            return self._table[expression_class]
+        except KeyError:
+            candidates = tuple((operands, function) for cls, operands, function in self.rules
+                               if issubclass(expression_class, cls))
+            self._table[expression_class] = candidates
+            return candidates
+
+    def apply(self, expression):
+        ''' The rewriting of the first matching rule that applies to
+            expression, None if there is none '''
+        operands = expression.operands
+        for patterns, function in self._candidates(type(expression)):
+            if all(pattern is None or isinstance(operand, pattern) for pattern, operand in zip(patterns, operands)):
+                result = function(expression)
+                if result is not None:
+                    return result
+        return None
+
+
+# Rule sets by name, see RewriteRules and smt.rewrite_rules
+rewrite_rule_sets = {}
+common_rules = RewriteRules('common')
+evm_rules = RewriteRules('evm', include=(common_rules,))
+native_rules = RewriteRules('native', include=(common_rules,))
+
+consts.add('rewrite_rules', default='auto',
+           description="Rewrite rules applied by simplify: 'auto' (the rules of the platform), 'none', or a rule set name (common, evm, native)")
+
+# Rule set used when smt.rewrite_rules is 'auto', see set_platform_rewrite_rules
+_platform_rewrite_rules = 'common'
+
+
+def set_platform_rewrite_rules(name):
+    ''' Select the rewrite rules of the platform being explored, used by
+        simplify unless smt.rewrite_rules names a rule set '''
+    global _platform_rewrite_rules
+    if name not in rewrite_rule_sets:
+        raise ValueError("Unknown rewrite rule set {}".format(name))
+    _platform_rewrite_rules = name
+
+
+def _current_rewrite_rules():
+    name = consts.rewrite_rules
+    if name == 'none':
+        return None
+    if name == 'auto':
+        name = _platform_rewrite_rules
+    return rewrite_rule_sets[name]
+
+
+class RewriteSimplifier(Visitor):
+    """ Simplify expressions with a :class:`RewriteRules` set
+
+    Constants are folded and the rules are applied bottom up, to every node
+    until none applies. Use it with `use_fixed_point` so the nodes built by
+    the rules are simplified too.
+
+    """
+
+    # Rewrites of a single node before moving on, in case rules undo each other
+    MAX_REWRITES = 32
+
+    def __init__(self, rules, **kw):
+        super().__init__(**kw)
+        self.rules = rules
+
+    def visit_Operation(self, expression, *operands):
+        expression = self._rebuild(expression, operands)
+        for _ in range(self.MAX_REWRITES):
+            if not isinstance(expression, Operation):
+                break
+            if all(isinstance(o, Constant) for o in expression.operands):
+                folded = constant_folder(expression)
+                if folded is not expression:
+                    expression = folded
+                    continue
+            rewritten = self.rules.apply(expression)
+            if rewritten is None:
+                break
+            expression = rewritten
+        return expression
+
+    def visit_Expression(self, expression, *operands):
+        return expression
+
+
+_rewrite_caches = {}
+
+
+def rewrite(expression, rules=None):
+    """ Simplify expression with a rewrite rule set
+
+    :param expression: expression to simplify
+    :param rules: a :class:`RewriteRules`, its name or None for the rules
+                  selected by smt.rewrite_rules
+    """
+    if rules is None:
+        rules = _current_rewrite_rules()
+        if rules is None:
+            return expression
+    elif isinstance(rules, str):
+        rules = rewrite_rule_sets[rules]
+    cache = _rewrite_caches.get(rules.name)
+    if cache is None:
+        cache = _rewrite_caches[rules.name] = LRUCache('rewrite', 150000, 'Maximum number of expressions cached per rewrite rule set')
+    simp = RewriteSimplifier(rules, cache=cache)
+    simp.visit(expression, use_fixed_point=True)
+    return simp.result
+
+
+def _keep_taint(result, expression):
+    ''' result, carrying the taint of the expression it replaces. None if
+        result is a variable missing some of that taint: variables can not
+        be copied. '''
+    if not expression._taint & ~result._taint:
+        return result
+    if isinstance(result, Variable):
+        return None
+    result = copy.copy(result)
+    result._taint = result._taint | expression._taint
+    return result
+
+
+###############################################################################
+# Rules for any platform
+
+@common_rules.rule(BitVecITE, BoolConstant)
+def ite_constant_condition(expression):
+    ''' ite(true, a, b) ==> a
+        ite(false, a, b) ==> b
+    '''
+    condition, true, false = expression.operands
+    return _keep_taint(true if condition.value else false, expression)
+
+
+@common_rules.rule(BitVecITE)
+def ite_same_branches(expression):
+    ''' ite(c, a, a) ==> a '''
+    _, true, false = expression.operands
+    if true is false or isinstance(true, Constant) and isinstance(false, Constant) and \
+            (true.value & true.mask) == (false.value & false.mask):
+        return _keep_taint(true, expression)
+
+
+@common_rules.rule(BoolITE, None, BoolConstant, BoolConstant)
+def bool_ite_constant_branches(expression):
+    ''' ite(c, true, false) ==> c
+        ite(c, false, true) ==> not c
+    '''
+    condition, true, false = expression.operands
+    if true.value == false.value:
+        return _keep_taint(true, expression)
+    if true.value:
+        return _keep_taint(condition, expression)
+    return BoolNot(condition, taint=expression.taint)
+
+
+@common_rules.rule(BoolNot, BoolNot)
+def double_negation(expression):
+    ''' not not a ==> a '''
+    return _keep_taint(expression.operands[0].operands[0], expression)
+
+
+def hoist_ite(expression):
+    ''' op(ite(c, k1, k2), k3) ==> ite(c, op(k1, k3), op(k2, k3))
+        op(k3, ite(c, k1, k2)) ==> ite(c, op(k3, k1), op(k3, k2))
+
+        Only for constant branches, so both branches fold and the term
+        does not grow. EVM code compares the 0/1 words of ite often.
+    '''
+    a, b = expression.operands
+    if isinstance(a, BitVecITE) and isinstance(b, Constant):
+        ite = a
+        operands = lambda x: (x, b)
+    elif isinstance(b, BitVecITE) and isinstance(a, Constant):
+        ite = b
+        operands = lambda x: (a, x)
+    else:
+        return None
+    condition, true, false = ite.operands
+    if not isinstance(true, Constant) or not isinstance(false, Constant):
+        return None
+    true = Visitor._rebuild(expression, operands(true))
+    false = Visitor._rebuild(expression, operands(false))
+    if isinstance(expression, Bool):
+        return BoolITE(condition, true, false, taint=expression.taint)
+    return BitVecITE(expression.size, condition, true, false, taint=expression.taint)
+
+
+for _cls in (BitVecAdd, BitVecSub, BitVecMul, BitVecAnd, BitVecOr, BitVecXor,
+             BitVecShiftLeft, BitVecShiftRight, Equal, LessThan, LessOrEqual,
+             GreaterThan, GreaterOrEqual, UnsignedLessThan, UnsignedLessOrEqual,
+             UnsignedGreaterThan, UnsignedGreaterOrEqual):
+    common_rules.rule(_cls)(hoist_ite)
+
+
+@common_rules.rule(BitVecExtract)
+def extract_all(expression):
+    ''' extract(a)[sizeof(a)-1:0] ==> a '''
+    operand = expression.operands[0]
+    if expression.begining == 0 and expression.size == operand.size:
+        return _keep_taint(operand, expression)
+
+
+@common_rules.rule(BitVecExtract, BitVecConcat)
+def extract_concat(expression):
+    ''' extract(concat(.., a, ..)) ==> extract(a) if all the bits come from a '''
+    begining = expression.begining
+    size = expression.size
+    for item in reversed(expression.operands[0].operands):
+        if begining < item.size:
+            if begining + size > item.size:
+                return None
+            if begining == 0 and size == item.size:
+                return _keep_taint(item, expression)
+            return BitVecExtract(item, begining, size, taint=expression.taint)
+        begining -= item.size
+
+
+@common_rules.rule(BitVecExtract, BitVecExtract)
+def extract_extract(expression):
+    ''' extract(extract(a)) ==> extract(a) '''
+    inner = expression.operands[0]
+    return BitVecExtract(inner.operands[0], inner.begining + expression.begining, expression.size,
+                         taint=expression.taint)
+
+
+@common_rules.rule(BitVecExtract, BitVecZeroExtend)
+def extract_zero_extend(expression):
+    ''' extract(zero_extend(a)) ==> extract(a) if all the bits come from a
+        extract(zero_extend(a)) ==> 0 if none does
+    '''
+    operand = expression.operands[0].operands[0]
+    begining = expression.begining
+    size = expression.size
+    if begining + size <= operand.size:
+        if begining == 0 and size == operand.size:
+            return _keep_taint(operand, expression)
+        return BitVecExtract(operand, begining, size, taint=expression.taint)
+    if begining >= operand.size:
+        return BitVecConstant(size, 0, taint=expression.taint)
+
+
+@common_rules.rule(BitVecZeroExtend)
+def zero_extend_collapse(expression):
+    ''' zero_extend(zero_extend(a)) ==> zero_extend(a)
+        zero_extend(a) ==> a if it does not extend
+    '''
+    operand = expression.operands[0]
+    if expression.size == operand.size:
+        return _keep_taint(operand, expression)
+    if isinstance(operand, BitVecZeroExtend):
+        return BitVecZeroExtend(expression.size, operand.operands[0], taint=expression.taint)
+
+
+@common_rules.rule(BitVecAdd, BitVecAdd, BitVecConstant)
+@common_rules.rule(BitVecAdd, BitVecSub, BitVecConstant)
+@common_rules.rule(BitVecSub, BitVecAdd, BitVecConstant)
+@common_rules.rule(BitVecSub, BitVecSub, BitVecConstant)
+def reassociate_constants(expression):
+    ''' (a + k1) + k2 ==> a + (k1 + k2), likewise for subtractions '''
+    inner, k2 = expression.operands
+    a, k1 = inner.operands
+    if not isinstance(k1, BitVecConstant):
+        return None
+    value = k1.value if isinstance(inner, BitVecAdd) else -k1.value
+    value += k2.value if isinstance(expression, BitVecAdd) else -k2.value
+    value &= expression.mask
+    if value == 0:
+        return _keep_taint(a, expression)
+    return BitVecAdd(a, BitVecConstant(expression.size, value, taint=k1.taint | k2.taint), taint=expression.taint)
+
+
+@common_rules.rule(BitVecAdd, None, BitVecConstant)
+@common_rules.rule(BitVecSub, None, BitVecConstant)
+def add_zero(expression):
+    ''' a + 0 ==> a
+        a - 0 ==> a
+    '''
+    a, k = expression.operands
+    if not k.value & k.mask:
+        return _keep_taint(a, expression)
+
+
+@common_rules.rule(BitVecAdd, BitVecConstant)
+def constant_to_the_right(expression):
+    ''' k + a ==> a + k '''
+    k, a = expression.operands
+    if not isinstance(a, Constant):
+        return BitVecAdd(a, k, taint=expression.taint)
+
+
+@common_rules.rule(ArraySelect, ArrayStore, BitVecConstant)
+def select_store(expression):
+    ''' select(store(..store(a, i, v).., j, w), i) ==> v
+        if the later stores have concrete indexes other than i
+    '''
+    array, index = expression.operands
+    value = index.value & index.mask
+    while isinstance(array, ArrayStore) and isinstance(array._operands[1], BitVecConstant):
+        store_index = array._operands[1]
+        if store_index._value & store_index.mask == value:
+            return _keep_taint(array._operands[2], expression)
+        array = array._operands[0]
+    if array is not expression.operands[0]:
+        return ArraySelect(array, index, taint=expression.taint)
+
+
+###############################################################################
+# EVM rules
+
+@evm_rules.rule(BitVecConcat, BitVecConstant)
+def concat_zero_prefix(expression):
+    ''' concat(0, a, ..) ==> zero_extend(concat(a, ..)), words packed from
+        smaller values '''
+    prefix, *rest = expression.operands
+    if prefix.value & prefix.mask:
+        return None
+    if len(rest) == 1:
+        rest = rest[0]
+    else:
+        rest = BitVecConcat(expression.size - prefix.size, *rest)
+    return BitVecZeroExtend(expression.size, rest, taint=expression.taint)
+
+
+@evm_rules.rule(BitVecAnd, BitVecZeroExtend, BitVecConstant)
+def mask_zero_extend(expression):
+    ''' zero_extend(a) & mask ==> zero_extend(a) if mask keeps all the bits
+        of a, as when masking addresses '''
+    extended, mask = expression.operands
+    operand = extended.operands[0]
+    if mask.value & operand.mask == operand.mask:
+        return _keep_taint(extended, expression)
+
+
+###############################################################################
+# Native rules
+
+@native_rules.rule(BitVecExtract, BitVecSignExtend)
+def extract_sign_extend(expression):
+    ''' extract(sign_extend(a)) ==> extract(a) if all the bits come from a '''
+    operand = expression.operands[0].operands[0]
+    begining = expression.begining
+    size = expression.size
+    if begining + size <= operand.size:
+        if begining == 0 and size == operand.size:
+            return _keep_taint(operand, expression)
+        return BitVecExtract(operand, begining, size, taint=expression.taint)
+
+
+@native_rules.rule(BitVecConcat)
+def concat_adjacent_extracts(expression):
+    ''' concat(.., extract(a)[16:8], extract(a)[7:0], ..) ==> concat(.., extract(a)[16:0], ..)
+        as left by partial register writes
+    '''
+    operands = []
+    for item in expression.operands:
+        previous = operands[-1] if operands else None
+        if isinstance(item, BitVecExtract) and isinstance(previous, BitVecExtract) and \
+                previous.operands[0] is item.operands[0] and previous.begining == item.end + 1:
+            operands[-1] = BitVecExtract(item.operands[0], item.begining, previous.size + item.size)
+        else:
+            operands.append(item)
+    if len(operands) == len(expression.operands):
+        return None
+    if len(operands) == 1:
+        return _keep_taint(operands[0], expression)
+    return BitVecConcat(expression.size, *operands, taint=expression.taint)
+
+
 def to_constant(expression):
     """Simplify expression to constant if possible
 
@@ -608,15 +1042,53 @@ def to_constant(expression):
     return value
 
 
-@lru_cache(maxsize=128)
-def simplify(expression):
+# Rewrite rule set the results cached by simplify were rewritten with
+_simplify_rules = None
+
+
+@memoize('simplify', 10000, 'Maximum number of simplify results cached')
+def _simplify(expression):
     expression = constant_folder(expression)
     expression = arithmetic_simplify(expression)
+    expression = rewrite(expression)
     return expression
 
 
+def simplify(expression):
+    global _simplify_rules
+    # The rules can change with the platform or smt.rewrite_rules
+    rules = _current_rewrite_rules()
+    if rules is not _simplify_rules:
+        _simplify.cache.clear()
+        _simplify_rules = rules
+    return _simplify(expression)
+
+
+def _shared_operations(expression):
+    ''' Ids of the operations reachable more than once from expression '''
+    seen = set()
+    shared = set()
+    stack = [expression]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, Operation):
+            continue
+        key = id(node)
+        if key in seen:
+            shared.add(key)
+        else:
+            seen.add(key)
+            stack.extend(node.operands)
+    return shared
+
+
 class TranslatorSmtlib(Translator):
     ''' Simple visitor to translate an expression to its smtlib representation
+
+    With `use_bindings` every operation used more than once in the
+    expression DAG is translated once and bound to a name. The result is
+    then wrapped in a let per binding, so the names are local to it.
+    Otherwise shared subterms are repeated at every use.
     '''
     unique = 0
 
@@ -624,27 +1096,21 @@ class TranslatorSmtlib(Translator):
         assert 'bindings' not in kw
         super().__init__(*args, **kw)
         self.use_bindings = use_bindings
-        self._bindings_cache = {}
+        self._shared = set()
         self._bindings = []
 
-    def _add_binding(self, expression, smtlib):
-        if not self.use_bindings or len(smtlib) <= 10:
-            return smtlib
-
-        if smtlib in self._bindings_cache:
-            return self._bindings_cache[smtlib]
-
-        TranslatorSmtlib.unique += 1
-        name = 'a_%d' % TranslatorSmtlib.unique
-
-        self._bindings.append((name, expression, smtlib))
-
-        self._bindings_cache[expression] = name
-        return name
+    def visit(self, node, use_fixed_point=False):
+        if self.use_bindings:
+            self._shared |= _shared_operations(node)
+        super().visit(node, use_fixed_point=use_fixed_point)
 
-    @property
-    def bindings(self):
-        return self._bindings
+    def _method(self, expression, *args):
+        smtlib = super()._method(expression, *args)
+        if id(expression) in self._shared:
+            name = 'a!%d' % len(self._bindings)
+            self._bindings.append((name, expression, smtlib))
+            return name
+        return smtlib
 
     translation_table = {
         BoolNot: 'not',
@@ -701,13 +1167,6 @@ class TranslatorSmtlib(Translator):
     def visit_Variable(self, expression):
         return expression.name
 
-    def visit_ArraySelect(self, expression, *operands):
-        array_smt, index_smt = operands
-        if isinstance(expression.array, ArrayStore):
-            array_smt = self._add_binding(expression.array, array_smt)
-
-        return '(select %s %s)' % (array_smt, index_smt)
-
     def visit_Operation(self, expression, *operands):
         operation = self.translation_table[type(expression)]
         if isinstance(expression, (BitVecSignExtend, BitVecZeroExtend)):
@@ -715,7 +1174,6 @@ class TranslatorSmtlib(Translator):
         elif isinstance(expression, BitVecExtract):
             operation = operation % (expression.end, expression.begining)
 
-        operands = [self._add_binding(*x) for x in zip(expression.operands, operands)]
         return '(%s %s)' % (operation, ' '.join(operands))
 
     @property
@@ -725,9 +1183,11 @@ class TranslatorSmtlib(Translator):
     @property
     def result(self):
         output = super().result
-        if self.use_bindings:
-            for name, expr, smtlib in reversed(self._bindings):
-                output = '( let ((%s %s)) %s )' % (name, smtlib, output)
+        if self.use_bindings and self._bindings:
+            parts = ['(let ((%s %s)) ' % (name, smtlib) for name, _, smtlib in self._bindings]
+            parts.append(output)
+            parts.append(')' * len(self._bindings))
+            output = ''.join(parts)
         return output
 
 
@@ -744,6 +1204,215 @@ def translate_to_smtlib(expression, **kwargs):
     return translator.result
 
 
+def _signed(value, size):
+    return value - (1 << size) if value & (1 << (size - 1)) else value
+
+
+class Evaluator(Translator):
+    ''' Evaluate an expression under a concrete model
+
+    The model maps variable names to an int (BitVec), a bool (Bool) or a dict
+    from index to value (Array). Stores over an array evaluate to a
+    (array, index, value) tuple. A KeyError is raised if the model has no
+    value for a variable or array position the expression needs and a
+    NotImplementedError for expressions it can not evaluate.
+    '''
+
+    def __init__(self, model, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model
+
+    def _method(self, expression, *args):
+        if isinstance(expression, ArrayProxy):
+            # Proxies are not Operations, the array they wrap was not visited
+            evaluator = Evaluator(self.model, cache=self._cache)
+            evaluator.visit(expression.array)
+            return evaluator.result
+        return super()._method(expression, *args)
+
+    def visit_BitVecConstant(self, expression):
+        return expression.value & expression.mask
+
+    def visit_Constant(self, expression):
+        return expression.value
+
+    def visit_Variable(self, expression):
+        return self.model[expression.name]
+
+    def visit_BoolNot(self, expression, a):
+        return not a
+
+    def visit_BoolEq(self, expression, a, b):
+        return a == b
+
+    def visit_BoolAnd(self, expression, a, b):
+        return a and b
+
+    def visit_BoolOr(self, expression, a, b):
+        return a or b
+
+    def visit_BoolXor(self, expression, a, b):
+        return a != b
+
+    def visit_BoolITE(self, expression, cond, true, false):
+        return true if cond else false
+
+    def visit_BitVecITE(self, expression, cond, true, false):
+        return true if cond else false
+
+    def visit_BitVecAdd(self, expression, a, b):
+        return (a + b) & expression.mask
+
+    def visit_BitVecSub(self, expression, a, b):
+        return (a - b) & expression.mask
+
+    def visit_BitVecMul(self, expression, a, b):
+        return (a * b) & expression.mask
+
+    def visit_BitVecDiv(self, expression, a, b):
+        size = expression.size
+        a, b = _signed(a, size), _signed(b, size)
+        if b == 0:
+            return 1 if a < 0 else expression.mask
+        result = abs(a) // abs(b)
+        if (a < 0) != (b < 0):
+            result = -result
+        return result & expression.mask
+
+    def visit_BitVecUnsignedDiv(self, expression, a, b):
+        if b == 0:
+            return expression.mask
+        return a // b
+
+    def visit_BitVecMod(self, expression, a, b):
+        # The sign follows the divisor, as python does
+        if b == 0:
+            return a
+        size = expression.size
+        return (_signed(a, size) % _signed(b, size)) & expression.mask
+
+    def visit_BitVecRem(self, expression, a, b):
+        # The sign follows the dividend
+        if b == 0:
+            return a
+        size = expression.size
+        a, b = _signed(a, size), _signed(b, size)
+        result = abs(a) % abs(b)
+        return (-result if a < 0 else result) & expression.mask
+
+    def visit_BitVecUnsignedRem(self, expression, a, b):
+        if b == 0:
+            return a
+        return a % b
+
+    def visit_BitVecShiftLeft(self, expression, a, b):
+        if b >= expression.size:
+            return 0
+        return (a << b) & expression.mask
+
+    visit_BitVecArithmeticShiftLeft = visit_BitVecShiftLeft
+
+    def visit_BitVecShiftRight(self, expression, a, b):
+        return a >> b
+
+    def visit_BitVecArithmeticShiftRight(self, expression, a, b):
+        size = expression.size
+        return (_signed(a, size) >> min(b, size)) & expression.mask
+
+    def visit_BitVecAnd(self, expression, a, b):
+        return a & b
+
+    def visit_BitVecOr(self, expression, a, b):
+        return a | b
+
+    def visit_BitVecXor(self, expression, a, b):
+        return a ^ b
+
+    def visit_BitVecNot(self, expression, a):
+        return ~a & expression.mask
+
+    def visit_BitVecNeg(self, expression, a):
+        return -a & expression.mask
+
+    def visit_LessThan(self, expression, a, b):
+        size = expression.operands[0].size
+        return _signed(a, size) < _signed(b, size)
+
+    def visit_LessOrEqual(self, expression, a, b):
+        size = expression.operands[0].size
+        return _signed(a, size) <= _signed(b, size)
+
+    def visit_GreaterThan(self, expression, a, b):
+        size = expression.operands[0].size
+        return _signed(a, size) > _signed(b, size)
+
+    def visit_GreaterOrEqual(self, expression, a, b):
+        size = expression.operands[0].size
+        return _signed(a, size) >= _signed(b, size)
+
+    def visit_Equal(self, expression, a, b):
+        return a == b
+
+    def visit_UnsignedLessThan(self, expression, a, b):
+        return a < b
+
+    def visit_UnsignedLessOrEqual(self, expression, a, b):
+        return a <= b
+
+    def visit_UnsignedGreaterThan(self, expression, a, b):
+        return a > b
+
+    def visit_UnsignedGreaterOrEqual(self, expression, a, b):
+        return a >= b
+
+    def visit_BitVecSignExtend(self, expression, a):
+        return _signed(a, expression.operands[0].size) & expression.mask
+
+    def visit_BitVecZeroExtend(self, expression, a):
+        return a
+
+    def visit_BitVecExtract(self, expression, a):
+        return (a >> expression.begining) & expression.mask
+
+    def visit_BitVecConcat(self, expression, *operands):
+        result = 0
+        for operand, value in zip(expression.operands, operands):
+            result = (result << operand.size) | value
+        return result
+
+    def visit_ArrayStore(self, expression, array, index, value):
+        return (array, index, value)
+
+    def visit_ArraySelect(self, expression, array, index):
+        while isinstance(array, tuple):
+            array, stored_index, value = array
+            if stored_index == index:
+                return value
+        return array[index]
+
+    def visit_Expression(self, expression, *operands):
+        raise NotImplementedError("Can not evaluate {}".format(expression))
+
+
+def evaluate(expression, model, cache=None):
+    """ Evaluate expression under a concrete model
+
+    :param expression: expression to evaluate
+    :type expression: :obj:`Expression`
+    :param dict model: variable names to concrete values, see :obj:`Evaluator`
+    :param dict cache: optional evaluation cache, only valid for this model
+    :return: the concrete value or None if the model does not determine it
+    """
+    if not isinstance(expression, Expression):
+        return expression
+    evaluator = Evaluator(model, cache=cache)
+    try:
+        evaluator.visit(expression)
+    except (KeyError, NotImplementedError):
+        return None
+    return evaluator.result
+
+
 class Replace(Visitor):
     ''' Simple visitor to replaces expressions '''
 
@@ -791,7 +1460,4 @@ def get_variables(expression):
 
     :rtype: set[:obj:`Expression`]
     """
-
-    visitor = GetDeclarations()
-    visitor.visit(expression)
-    return visitor.result
+    return set(expression.variables)
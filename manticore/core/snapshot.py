@@ -0,0 +1,143 @@
+'''
+Delta snapshots of the states saved to a workspace.
+
+The states forked together share almost everything with their parent. So a
+state that forks is saved once as a snapshot, and its children are pickled
+as deltas of it: the pickler memo is primed with the objects of the snapshot
+that can not have changed since (immutable expressions, strings, memory maps
+and constraint sets that were not written) and a child only holds what is
+new, e.g. the fork constraint and the registers.
+
+A snapshot is itself a delta of the previous snapshot of the same worker,
+up to `workspace.snapshot_depth` snapshots in a row. To load a state, the
+snapshots it depends on are unpickled oldest first to rebuild the memo its
+pickle refers to.
+'''
+import io
+import logging
+import pickle
+import sys
+import types
+
+from .memory import AnonMap, FileMap
+from .smtlib import ConstraintSet
+from .smtlib.expression import Expression, ArrayProxy
+from ..utils.helpers import PickleSerializer
+
+logger = logging.getLogger(__name__)
+
+# Objects a delta can refer to whatever happened since the snapshot
+_IMMUTABLE_TYPES = frozenset((str, bytes, int, float, type, types.FunctionType, types.BuiltinFunctionType))
+# Objects a delta can refer to while their version does not change
+_VERSIONED_TYPES = (AnonMap, FileMap, ConstraintSet)
+
+
+def _immutable(obj):
+    if type(obj) in _IMMUTABLE_TYPES:
+        return True
+    if type(obj) is tuple:
+        return all(type(item) in _IMMUTABLE_TYPES or _immutable(item) for item in obj)
+    return isinstance(obj, Expression) and not isinstance(obj, ArrayProxy)
+
+
+class Snapshot(object):
+    '''
+    The memo of a snapshot pickle, to pickle deltas of it.
+
+    Each object pickled is memoized with an index, and later pickles refer to
+    it by that index. The memo given to a delta pickler keeps every index
+    taken, but the mutable objects (and the versioned ones that changed) are
+    replaced by placeholders no object pickled can match.
+
+    :param int snapshot_id: the snapshot id in its workspace
+    :param parent_id: id of the snapshot this one is a delta of, or None
+    :param int depth: number of snapshots in the chain ending in this one
+    :param entries: (index, object) pairs of the memo
+    :param live: if not None, the indices of the versioned objects that are
+        still current, the others are placeholders
+    :param Snapshot base: the snapshot whose memo primed the pickler, only
+        the entries after its own are looked at
+    '''
+
+    def __init__(self, snapshot_id, parent_id, depth, entries, live=None, base=None):
+        self.id = snapshot_id
+        self.parent_id = parent_id
+        self.depth = depth
+        if base is None:
+            self._memo = {}
+            # (index, object, version) of the versioned objects
+            self._versioned = []
+        else:
+            self._memo = base.memo()
+            self._versioned = [entry for entry in base._versioned if entry[1].version == entry[2]]
+        first = len(self._memo)
+        for index, obj in entries:
+            if index < first:
+                continue
+            if _immutable(obj):
+                pass
+            elif isinstance(obj, _VERSIONED_TYPES) and (live is None or index in live):
+                self._versioned.append((index, obj, obj.version))
+            else:
+                obj = object()
+            self._memo[id(obj)] = (index, obj)
+
+    @property
+    def live(self):
+        ''' Indices of the versioned objects deltas can refer to '''
+        return tuple(index for index, obj, version in self._versioned)
+
+    def memo(self):
+        ''' The memo to pickle a delta of this snapshot '''
+        memo = self._memo.copy()
+        for index, obj, version in self._versioned:
+            if obj.version != version:
+                memo[id(obj)] = (index, object())
+        return memo
+
+
+def dumps(obj, memo=None, persistent_id=None):
+    '''
+    Pickle `obj`, as a delta if a `memo` is given.
+
+    :param memo: see :meth:`Snapshot.memo`
+    :param persistent_id: the persistent id of the objects pickled by
+        reference (see :mod:`pickle`), if any
+    :return: the pickle and the memo of the pickler, as {id: (index, object)}
+    '''
+    while True:
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f, 2)
+        if memo is not None:
+            pickler.memo = memo
+        if persistent_id is not None:
+            pickler.persistent_id = persistent_id
+        try:
+            pickler.dump(obj)
+        except RuntimeError:
+            new_limit = sys.getrecursionlimit() * 2
+            if new_limit > PickleSerializer.MAX_RECURSION:
+                raise Exception(f'PickleSerializer recursion limit surpassed {PickleSerializer.MAX_RECURSION}, aborting')
+            logger.info(f'Recursion soft limit {sys.getrecursionlimit()} hit, increasing')
+            sys.setrecursionlimit(new_limit)
+            continue
+        return f.getvalue(), pickler.memo.copy()
+
+
+def load(f, memo=None, persistent_load=None):
+    '''
+    Unpickle an object from the stream `f`, a delta if a `memo` is given.
+
+    :param memo: the memo of the unpickler of the snapshot it is a delta of
+    :param persistent_load: the object of a persistent id, see :func:`dumps`
+    :return: the object and the memo of the unpickler (its ``copy()`` is a
+        dict {index: object})
+    '''
+    unpickler = pickle.Unpickler(f)
+    if memo is not None:
+        # Only a memo of another unpickler can be set, not a dict
+        unpickler.memo = memo
+    if persistent_load is not None:
+        unpickler.persistent_load = persistent_load
+    obj = unpickler.load()
+    return obj, unpickler.memo
@@ -1,16 +1,26 @@
 import os
 import sys
 import glob
+import fnmatch
+import zlib
+import hashlib
+import collections
 import signal
 import logging
 import tempfile
 import io
+import json
+import pickle
+import struct
 
 from contextlib import contextmanager
 from multiprocessing.managers import SyncManager
 
 from manticore.utils import config
-from manticore.utils.helpers import PickleSerializer
+from manticore.utils.cache import LRUCache
+from manticore.utils.helpers import PickleSerializer, FastSerializer
+from .memory import Map
+from .snapshot import Snapshot, dumps as dump_delta, load as load_delta
 from .smtlib import solver
 from .state import State
 
@@ -19,6 +29,14 @@ logger = logging.getLogger(__name__)
 consts = config.get_group('workspace')
 consts.add('prefix', default='mcore_', description="The prefix to use for output and workspace directories")
 consts.add('dir', default='.', description="Location of where to create workspace directories")
+consts.add('snapshots', default=True,
+           description="Save a state that forks as a snapshot, and its children as deltas of it")
+consts.add('snapshot_depth', default=8,
+           description="Maximum number of snapshots in a row saved as deltas of the previous one")
+consts.add('pages', default=True,
+           description="Store the memory pages of the states saved once, compressed, instead of in each state")
+consts.add('serialization', default='pickle',
+           description="How to serialize states: 'pickle', or 'fast' for states with deep expressions (without snapshots nor page store)")
 
 _manager = None
 
@@ -49,6 +67,8 @@ class Store(object):
 
        * This is used as a prefix for a store descriptor
 
+    The states are serialized by a :class:`~manticore.utils.helpers.PickleSerializer`, or a
+    :class:`~manticore.utils.helpers.FastSerializer` with ``state_serialization_method='fast'``.
     """
 
     @classmethod
@@ -70,7 +90,7 @@ class Store(object):
         type_, uri = ('fs', None) if desc is None else desc.split(':', 1)
         for subclass in cls.__subclasses__():
             if subclass.store_type == type_:
-                return subclass(uri)
+                return subclass(uri, state_serialization_method=consts.serialization)
         raise NotImplementedError("Storage type '{0}' not supported.".format(type_))
 
     def __init__(self, uri, state_serialization_method='pickle'):
@@ -79,8 +99,11 @@ class Store(object):
         self.uri = uri
         self._sub = []
 
+        self.state_serialization_method = state_serialization_method
         if state_serialization_method == 'pickle':
             self._serializer = PickleSerializer()
+        elif state_serialization_method == 'fast':
+            self._serializer = FastSerializer()
         else:
             raise NotImplementedError("Pickling method '{}' not supported.".format(state_serialization_method))
 
@@ -132,6 +155,13 @@ class Store(object):
         value = self.load_value(key, binary=binary)
         yield io.BytesIO(value) if binary else io.StringIO(value)
 
+    @property
+    def serializer(self):
+        """
+        The :class:`~manticore.utils.helpers.StateSerializer` of the states saved
+        """
+        return self._serializer
+
     def save_state(self, state, key):
         """
         Save a state to storage.
@@ -166,9 +196,10 @@ class Store(object):
 
     def ls(self, glob_str):
         """
-        List all keys in storage
+        List the keys in storage that match `glob_str`
 
-        :return:
+        :param str glob_str: A glob string, i.e. 'state_*'
+        :return: list of matched keys, as str
         """
         raise NotImplementedError
 
@@ -179,9 +210,10 @@ class FilesystemStore(Store):
     """
     store_type = 'fs'
 
-    def __init__(self, uri=None):
+    def __init__(self, uri=None, state_serialization_method='pickle'):
         """
         :param uri: The path to on-disk workspace, or None.
+        :param str state_serialization_method: 'pickle' or 'fast', see :class:`Store`
         """
         if not uri:
             uri = os.path.abspath(tempfile.mkdtemp(prefix=consts.prefix, dir=consts.dir))
@@ -191,7 +223,7 @@ class FilesystemStore(Store):
         else:
             os.mkdir(uri)
 
-        super().__init__(uri)
+        super().__init__(uri, state_serialization_method)
 
     @contextmanager
     def save_stream(self, key, binary=False):
@@ -248,9 +280,9 @@ class MemoryStore(Store):
     # TODO(yan): Once we get a global config store, check it to make sure
     # we're executing in a single-worker or test environment.
 
-    def __init__(self, uri=None):
+    def __init__(self, uri=None, state_serialization_method='pickle'):
         self._data = {}
-        super().__init__(None)
+        super().__init__(None, state_serialization_method)
 
     def save_value(self, key, value):
         self._data[key] = value
@@ -262,7 +294,7 @@ class MemoryStore(Store):
         del self._data[key]
 
     def ls(self, glob_str):
-        return list(self._data)
+        return fnmatch.filter(self._data, glob_str)
 
 
 class RedisStore(Store):
@@ -271,9 +303,10 @@ class RedisStore(Store):
     """
     store_type = 'redis'
 
-    def __init__(self, uri=None):
+    def __init__(self, uri=None, state_serialization_method='pickle'):
         """
         :param uri: A url for redis
+        :param str state_serialization_method: 'pickle' or 'fast', see :class:`Store`
         """
 
         # Local import to avoid an explicit dependency
@@ -282,7 +315,7 @@ class RedisStore(Store):
         hostname, port = uri.split(':')
         self._client = redis.StrictRedis(host=hostname, port=int(port), db=0)
 
-        super().__init__(uri)
+        super().__init__(uri, state_serialization_method)
 
     def save_value(self, key, value):
         """
@@ -307,7 +340,8 @@ class RedisStore(Store):
         self._client.delete(key)
 
     def ls(self, glob_str):
-        return self._client.keys(glob_str)
+        # Redis returns the keys as bytes
+        return [key.decode() for key in self._client.keys(glob_str)]
 
 
 # This is copied from Executor to not create a dependency on the naming of the lock field
@@ -323,9 +357,177 @@ def sync(f):
     return new_function
 
 
+# Header of the states saved as deltas: magic and snapshot id
+_DELTA_HEADER = struct.Struct('<4sQ')
+_DELTA_MAGIC = b'MDLT'
+
+# Memory pages stored and referenced by the states pickled in this process
+page_stats = collections.Counter()
+
+
+def page_report(stats):
+    """
+    Add the deduplication ratio and the bytes saved by the page store to
+    counts of :data:`page_stats`.
+
+    :param dict stats: page_stats counts, possibly summed over workers
+    :rtype: dict
+    """
+    report = dict(stats)
+    pages = report.get('pages', 0)
+    stored_pages = report.get('stored_pages', 0)
+    report['dedup_ratio'] = pages / stored_pages if stored_pages else 0.0
+    report['bytes_saved'] = report.get('page_bytes', 0) - report.get('stored_bytes', 0)
+    return report
+
+
+class PageStore(object):
+    """
+    Content-addressed store of the memory pages of the states saved to a
+    workspace.
+
+    The memory maps pickle their concrete contents as pages of bytes (see
+    :class:`~manticore.core.memory.AnonMap`). Pickled through
+    :meth:`persistent_id`, a page is saved compressed once under its digest
+    and the pickles only refer to the digest, so the pages many states have
+    in common are stored once.
+
+    The pages are removed by :meth:`collect` when no pickle saved to the
+    workspace refers to them anymore.
+    """
+
+    def __init__(self, lock, store):
+        self._lock = lock
+        self._store = store
+        self._prefix = 'page_'
+        self._size = 1 << Map._page_bits
+        # Digest -> compressed size of the pages stored, None for the ones of
+        # a reloaded workspace, that are never removed
+        self._stored = manager().dict()
+        # Key of a pickle -> digests of the pages it refers to
+        self._references = manager().dict()
+        # Digests known to be stored (by this process)
+        self._known = set()
+        # Digests of the pages of the pickle being made
+        self._pickled = set()
+        self._data = LRUCache('pages', 1 << 12, 'Memory pages kept in memory by each worker, to share them between states')
+
+    def _key(self, digest):
+        return self._prefix + digest
+
+    def load_workspace(self):
+        """
+        Keep the pages of a reloaded workspace, the states in it refer to them.
+        """
+        for name in self._store.ls('{}*'.format(self._prefix)):
+            digest = name[len(self._prefix):]
+            self._stored[digest] = None
+            self._known.add(digest)
+
+    def persistent_id(self, obj):
+        """
+        The digest of `obj` if it is a page, to pickle it by reference.
+        Saves the page if it is not stored yet.
+        """
+        if type(obj) is not bytes or len(obj) != self._size:
+            return None
+        digest = hashlib.blake2b(obj, digest_size=16).hexdigest()
+        page_stats['pages'] += 1
+        page_stats['page_bytes'] += len(obj)
+        if digest not in self._known:
+            self._save(digest, obj)
+            self._known.add(digest)
+        self._pickled.add(digest)
+        return digest
+
+    def persistent_load(self, digest):
+        """
+        The page of a digest pickled by :meth:`persistent_id`. The states
+        loaded by a process share the pages they have in common.
+        """
+        data = self._data.get(digest)
+        if data is None:
+            with self._store.load_stream(self._key(digest), binary=True) as f:
+                data = zlib.decompress(f.read())
+            self._data[digest] = data
+            self._known.add(digest)
+        return data
+
+    @sync
+    def _save(self, digest, data):
+        if digest in self._stored:
+            return
+        data = zlib.compress(data)
+        with self._store.save_stream(self._key(digest), binary=True) as f:
+            f.write(data)
+        self._stored[digest] = len(data)
+        page_stats['stored_pages'] += 1
+        page_stats['stored_bytes'] += len(data)
+
+    def dumps(self, obj, memo=None):
+        """
+        Pickle `obj` with its pages stored by reference, see
+        :func:`~manticore.core.snapshot.dumps`.
+
+        :return: the pickle, the memo of the pickler and the digests of the
+            pages the pickle refers to
+        """
+        self._pickled = set()
+        data, memo = dump_delta(obj, memo, self.persistent_id if consts.pages else None)
+        return data, memo, tuple(self._pickled)
+
+    def load(self, f, memo=None):
+        """
+        Unpickle a pickle of :meth:`dumps`, see :func:`~manticore.core.snapshot.load`.
+        """
+        return load_delta(f, memo, self.persistent_load)
+
+    def ref(self, key, digests):
+        """
+        Record the pages the pickle saved under `key` refers to.
+        """
+        if digests:
+            self._references[key] = digests
+
+    def unref(self, key):
+        """
+        Forget the pages of the pickle saved under `key`, it was removed.
+        """
+        self._references.pop(key, None)
+
+    @sync
+    def collect(self):
+        """
+        Remove the pages stored that no pickle refers to anymore.
+
+        :return: the number of pages removed
+        """
+        referenced = set()
+        for digests in self._references.values():
+            referenced.update(digests)
+        removed = 0
+        for digest, size in self._stored.items():
+            if size is not None and digest not in referenced:
+                del self._stored[digest]
+                self._store.rm(self._key(digest))
+                removed += 1
+        self._known.clear()
+        return removed
+
+
 class Workspace(object):
     """
     A workspace maintains a list of states to run and assigns them IDs.
+
+    The states saved in a :meth:`snapshot` context are deltas of the snapshot,
+    see :mod:`manticore.core.snapshot`. A snapshot is removed when no state or
+    snapshot depends on it anymore.
+
+    The memory pages of the states and snapshots are kept in a
+    :class:`PageStore`, call :meth:`collect_pages` to remove the unused ones.
+
+    Snapshots and the page store are built on pickle, the states of a store
+    with another state serialization method are saved whole by the store.
     """
 
     def __init__(self, lock, store_or_desc=None):
@@ -333,11 +535,24 @@ class Workspace(object):
             self._store = store_or_desc
         else:
             self._store = Store.fromdescriptor(store_or_desc)
-        self._serializer = PickleSerializer()
         self._last_id = manager().Value('i', 0)
         self._lock = lock
+        self._pages = PageStore(lock, self._store)
+        self._pickle = self._store.state_serialization_method == 'pickle'
         self._prefix = 'state_'
         self._suffix = '.pkl'
+        self._snapshot_prefix = 'snapshot_'
+        self._last_snapshot_id = manager().Value('i', 0)
+        # Snapshot id -> (references, parent snapshot id)
+        self._snapshots = manager().dict()
+        # Snapshot the states saved now are deltas of
+        self._current_snapshot = None
+        # (pid, Snapshot) of the last snapshot a process took or loaded a
+        # state from, it holds a reference. The next one is a delta of it.
+        self._lineage = None
+        # Snapshot pickles, not to read them again for each state
+        self._snapshot_data = LRUCache('snapshots', 1 << 26, 'Bytes of snapshots kept in memory by each worker',
+                                       weigher=lambda snapshot_id, data: len(data))
 
     def try_loading_workspace(self):
         """ Reload existing workspace
@@ -352,14 +567,188 @@ class Workspace(object):
             return int(name[len(self._prefix):-len(self._suffix)], 16)
 
         state_ids = list(map(get_state_id, state_names))
+        self._pages.load_workspace()
 
         if not state_ids:
             return []
 
         self._last_id.value = max(state_ids) + 1
+        self._load_snapshots(state_names)
 
         return state_ids
 
+    def _load_snapshots(self, state_names):
+        """
+        Count the references to the snapshots of a reloaded workspace and
+        remove the ones that are not used.
+
+        :param state_names: keys of the states in the workspace
+        """
+        snapshots = {}
+        for name in self._store.ls('{}*'.format(self._snapshot_prefix)):
+            with self._store.load_stream(name, binary=True) as f:
+                parent_id = pickle.load(f)[0]
+            snapshots[int(name[len(self._snapshot_prefix):-len(self._suffix)], 16)] = [0, parent_id]
+        if not snapshots:
+            return
+
+        for references_parent in list(snapshots.values()):
+            if references_parent[1] is not None:
+                snapshots[references_parent[1]][0] += 1
+        for name in state_names:
+            snapshot_id = self._delta_of(name)
+            if snapshot_id is not None:
+                snapshots[snapshot_id][0] += 1
+
+        self._last_snapshot_id.value = max(snapshots) + 1
+        for snapshot_id, (references, parent_id) in snapshots.items():
+            self._snapshots[snapshot_id] = (max(references, 1), parent_id)
+        for snapshot_id, (references, parent_id) in snapshots.items():
+            if not references:
+                self._snapshot_unref(snapshot_id)
+
+    def _snapshot_key(self, snapshot_id):
+        return '{}{:08x}{}'.format(self._snapshot_prefix, snapshot_id, self._suffix)
+
+    def _delta_of(self, key):
+        """
+        The snapshot the state saved under `key` is a delta of, or None.
+        """
+        with self._store.load_stream(key, binary=True) as f:
+            header = f.read(_DELTA_HEADER.size)
+        if len(header) == _DELTA_HEADER.size:
+            magic, snapshot_id = _DELTA_HEADER.unpack(header)
+            if magic == _DELTA_MAGIC:
+                return snapshot_id
+        return None
+
+    @sync
+    def _new_snapshot_id(self, parent_id):
+        """
+        Get a unique snapshot id, with one reference (the lineage of the caller).
+
+        :param parent_id: the snapshot the new one is a delta of, or None
+        :rtype: int
+        """
+        snapshot_id = self._last_snapshot_id.value
+        self._last_snapshot_id.value += 1
+        self._snapshots[snapshot_id] = (1, parent_id)
+        if parent_id is not None:
+            references, grandparent_id = self._snapshots[parent_id]
+            self._snapshots[parent_id] = (references + 1, grandparent_id)
+        return snapshot_id
+
+    @sync
+    def _snapshot_ref(self, snapshot_id):
+        references, parent_id = self._snapshots[snapshot_id]
+        self._snapshots[snapshot_id] = (references + 1, parent_id)
+
+    @sync
+    def _snapshot_unref(self, snapshot_id):
+        """
+        Drop a reference to a snapshot, removing it if it was the last one,
+        and so on with its parent.
+        """
+        while snapshot_id is not None:
+            references, parent_id = self._snapshots[snapshot_id]
+            if references > 1:
+                self._snapshots[snapshot_id] = (references - 1, parent_id)
+                return
+            del self._snapshots[snapshot_id]
+            self._store.rm(self._snapshot_key(snapshot_id))
+            self._pages.unref(self._snapshot_key(snapshot_id))
+            snapshot_id = parent_id
+
+    def _own_lineage(self):
+        """
+        The last snapshot this process took or loaded a state from, if any.
+
+        :rtype: Snapshot
+        """
+        if self._lineage is None or self._lineage[0] != os.getpid():
+            return None
+        return self._lineage[1]
+
+    def _set_lineage(self, lineage):
+        """
+        Replace the lineage of this process, releasing the previous one.
+
+        :param Snapshot lineage: the new lineage, with a reference for it, or None
+        """
+        previous = self._own_lineage()
+        self._lineage = None if lineage is None else (os.getpid(), lineage)
+        if previous is not None:
+            self._snapshot_unref(previous.id)
+
+    def release_snapshot(self):
+        """
+        Forget the last snapshot this process took or loaded a state from, so
+        it can be removed. For workers that are done saving states.
+        """
+        self._set_lineage(None)
+
+    @contextmanager
+    def snapshot(self, state):
+        """
+        Save `state` as a snapshot, the states saved in the context are deltas
+        of it. For the forks of `state`.
+
+        :param state: The state the ones saved in the context derive from
+        """
+        if not consts.snapshots or not self._pickle:
+            yield
+            return
+
+        base = self._own_lineage()
+        if base is not None and base.depth >= consts.snapshot_depth:
+            base = None
+        if base is None:
+            parent_id, depth, memo = None, 1, None
+        else:
+            parent_id, depth, memo = base.id, base.depth + 1, base.memo()
+        data, memo, pages = self._pages.dumps(state, memo)
+
+        snapshot_id = self._new_snapshot_id(parent_id)
+        self._pages.ref(self._snapshot_key(snapshot_id), pages)
+        current = Snapshot(snapshot_id, parent_id, depth, memo.values(), base=base)
+        data = pickle.dumps((parent_id, depth, current.live), 2) + data
+        with self._store.save_stream(self._snapshot_key(snapshot_id), binary=True) as f:
+            f.write(data)
+        self._snapshot_data[snapshot_id] = data
+        self._set_lineage(current)
+
+        self._current_snapshot = current
+        try:
+            yield
+        finally:
+            self._current_snapshot = None
+
+    def _replay(self, snapshot_id):
+        """
+        Unpickle the snapshots up to `snapshot_id`, oldest first.
+
+        :return: the memo to load a delta of the snapshot (see
+            :func:`~manticore.core.snapshot.load`) and the Snapshot to save
+            deltas of it
+        """
+        chain = []
+        while snapshot_id is not None:
+            data = self._snapshot_data.get(snapshot_id)
+            if data is None:
+                with self._store.load_stream(self._snapshot_key(snapshot_id), binary=True) as f:
+                    data = f.read()
+                self._snapshot_data[snapshot_id] = data
+            f = io.BytesIO(data)
+            parent_id, depth, live = pickle.load(f)
+            chain.append((snapshot_id, parent_id, depth, live, f))
+            snapshot_id = parent_id
+
+        memo = None
+        for _, _, _, _, f in reversed(chain):
+            memo = self._pages.load(f, memo)[1]
+        snapshot_id, parent_id, depth, live, _ = chain[0]
+        return memo, Snapshot(snapshot_id, parent_id, depth, memo.copy().items(), frozenset(live))
+
     @sync
     def _get_id(self):
         """
@@ -371,6 +760,14 @@ class Workspace(object):
         self._last_id.value += 1
         return id_
 
+    def new_state_id(self):
+        """
+        Get a unique id for a state that is not saved (yet).
+
+        :rtype: int
+        """
+        return self._get_id()
+
     def load_state(self, state_id, delete=True):
         """
         Load a state from storage identified by `state_id`.
@@ -379,7 +776,34 @@ class Workspace(object):
         :return: The deserialized state
         :rtype: State
         """
-        return self._store.load_state('{}{:08x}{}'.format(self._prefix, state_id, self._suffix), delete=delete)
+        key = '{}{:08x}{}'.format(self._prefix, state_id, self._suffix)
+        lineage = snapshot_id = None
+        with self._store.load_stream(key, binary=True) as f:
+            header = f.read(_DELTA_HEADER.size)
+            if len(header) == _DELTA_HEADER.size:
+                magic, snapshot_id = _DELTA_HEADER.unpack(header)
+                if magic != _DELTA_MAGIC:
+                    snapshot_id = None
+            if snapshot_id is None:
+                f.seek(0)
+                if self._pickle:
+                    state = self._pages.load(f)[0]
+                else:
+                    state = self._store.serializer.deserialize(f)
+            else:
+                memo, lineage = self._replay(snapshot_id)
+                state = self._pages.load(f, memo)[0]
+
+        # Later snapshots of this state are deltas of the one it came from
+        if lineage is not None:
+            self._snapshot_ref(lineage.id)
+        self._set_lineage(lineage)
+        if delete:
+            self._store.rm(key)
+            self._pages.unref(key)
+            if snapshot_id is not None:
+                self._snapshot_unref(snapshot_id)
+        return state
 
     def save_state(self, state, state_id=None):
         """
@@ -396,16 +820,45 @@ class Workspace(object):
         else:
             self.rm_state(state_id)
 
-        self._store.save_state(state, '{}{:08x}{}'.format(self._prefix, state_id, self._suffix))
+        key = '{}{:08x}{}'.format(self._prefix, state_id, self._suffix)
+        current = self._current_snapshot
+        if current is None and not (consts.pages and self._pickle):
+            self._store.save_state(state, key)
+        elif current is None:
+            data, _, pages = self._pages.dumps(state)
+            self._pages.ref(key, pages)
+            with self._store.save_stream(key, binary=True) as f:
+                f.write(data)
+        else:
+            data, _, pages = self._pages.dumps(state, current.memo())
+            self._pages.ref(key, pages)
+            self._snapshot_ref(current.id)
+            with self._store.save_stream(key, binary=True) as f:
+                f.write(_DELTA_HEADER.pack(_DELTA_MAGIC, current.id))
+                f.write(data)
         return state_id
 
+    def collect_pages(self):
+        """
+        Remove the memory pages no saved state refers to anymore. For when no
+        worker is saving states.
+
+        :return: the number of pages removed
+        """
+        return self._pages.collect()
+
     def rm_state(self, state_id):
         """
         Remove a state from storage identified by `state_id`.
 
         :param state_id: The state reference of what to load
         """
-        return self._store.rm('{}{:08x}{}'.format(self._prefix, state_id, self._suffix))
+        key = '{}{:08x}{}'.format(self._prefix, state_id, self._suffix)
+        snapshot_id = self._delta_of(key)
+        self._store.rm(key)
+        self._pages.unref(key)
+        if snapshot_id is not None:
+            self._snapshot_unref(snapshot_id)
 
 
 class ManticoreOutput(object):
@@ -509,6 +962,7 @@ class ManticoreOutput(object):
         self.save_trace(state)
         self.save_constraints(state)
         self.save_input_symbols(state)
+        self.save_solver_stats(state)
 
         for stream_name, data in state.platform.generate_workspace_files().items():
             with self._named_stream(stream_name, binary=True) as stream:
@@ -570,6 +1024,17 @@ class ManticoreOutput(object):
         with self._named_stream('smt') as f:
             f.write(str(state.constraints))
 
+    def save_solver_stats(self, state):
+        """ Write the solver queries made along the path of the state to file
+
+        Generate a `.solver_stats` file with the totals accounted in the state context, if any.
+
+        """
+        if 'solver_stats' not in state.context:
+            return
+        with self._named_stream('solver_stats') as f:
+            json.dump(state.context['solver_stats'], f, indent=2, sort_keys=True)
+
     def save_input_symbols(self, state):
         """ Write inputs to file
 
@@ -577,6 +1042,6 @@ class ManticoreOutput(object):
 
         """
         with self._named_stream('input') as f:
-            for symbol in state.input_symbols:
-                buf = solver.get_value(state.constraints, symbol)
+            values = solver.get_values(state.constraints, state.input_symbols)
+            for symbol, buf in zip(state.input_symbols, values):
                 f.write('%s: %s\n' % (symbol.name, repr(buf)))
@@ -8,6 +8,7 @@ import pyevmasm as EVMAsm
 from .. import Manticore
 from ..exceptions import EthereumError, DependencyError, NoAliveStates
 from ..core.smtlib import ConstraintSet, Operators, solver, BitVec, Array, ArrayProxy
+from ..core.smtlib.visitors import set_platform_rewrite_rules
 from ..platforms import evm
 from ..core.state import State, TerminateState
 from ..utils.helpers import issymbolic, PickleSerializer
@@ -498,6 +499,7 @@ class ManticoreEVM(Manticore):
         self._serializer = PickleSerializer()
 
         self._config_procs = procs
+        set_platform_rewrite_rules('evm')
         # Make the constraint store
         constraints = ConstraintSet()
         # make the ethereum world state
@@ -7,6 +7,7 @@ import functools
 import cProfile
 import pstats
 import itertools
+import json
 from multiprocessing import Process
 from contextlib import contextmanager
 
@@ -21,7 +22,8 @@ from elftools.elf.sections import SymbolTableSection
 from .core.executor import Executor
 from .core.state import State, TerminateState
 from .core.smtlib import solver, ConstraintSet
-from .core.workspace import ManticoreOutput
+from .core.smtlib.visitors import set_platform_rewrite_rules
+from .core.workspace import ManticoreOutput, page_report
 from .platforms import linux, evm, decree
 from .utils import config
 from .utils.helpers import issymbolic
@@ -47,6 +49,7 @@ def make_decree(program, concrete_start='', **kwargs):
     :type concrete_start: str [Default='']
 
     """
+    set_platform_rewrite_rules('native')
     constraints = ConstraintSet()
     platform = decree.SDecree(constraints, program)
     initial_state = State(constraints, platform)
@@ -82,6 +85,7 @@ def make_linux(program, argv=None, env=None, entry_symbol=None, symbolic_files=N
 
     logger.info('Loading program %s', program)
 
+    set_platform_rewrite_rules('native')
     constraints = ConstraintSet()
     platform = linux.SLinux(program, argv=argv, envp=env,
                             symbolic_files=symbolic_files)
@@ -628,6 +632,7 @@ class Manticore(Eventful):
 
         # Copy back the shared context
         self._context = dict(self._executor._shared_context)
+        self._executor._workspace.collect_pages()
 
         self._publish('did_finish_run')
 
@@ -720,6 +725,15 @@ class Manticore(Eventful):
         with self._output.save_stream('manticore.yml') as f:
             config.save(f)
 
+        with self._output.save_stream('solver_stats.json') as f:
+            json.dump(self.context.get('solver_stats', {}), f, indent=2, sort_keys=True)
+
+        with self._output.save_stream('cache_stats.json') as f:
+            json.dump(self.context.get('cache_stats', {}), f, indent=2, sort_keys=True)
+
+        with self._output.save_stream('workspace_stats.json') as f:
+            json.dump(page_report(self.context.get('workspace_stats', {})), f, indent=2, sort_keys=True)
+
         elapsed = time.time() - self._time_started
         logger.info('Results in %s', self._output.store.uri)
         logger.info('Total time: %s', elapsed)
@@ -6,11 +6,13 @@ import copy
 import inspect
 from functools import wraps
 from ..utils.helpers import issymbolic, get_taints, taint_with, istainted
+from ..utils.cache import LRUCache
 from ..platforms.platform import *
 from ..core.smtlib import solver, BitVec, Array, Operators, Constant, ArrayVariable, ArrayStore, BitVecConstant, translate_to_smtlib, to_constant
 from ..core.state import Concretize, TerminateState
 from ..utils.event import Eventful
 from ..core.smtlib.visitors import simplify
+from ..core.smtlib.guard import oversized, oversized_policy, abstract
 import pyevmasm as EVMAsm
 import logging
 from collections import namedtuple
@@ -654,7 +656,7 @@ class EVM(Eventful):
         try:
             _decoding_cache = getattr(self, '_decoding_cache')
         except:
-            _decoding_cache = self._decoding_cache = {}
+            _decoding_cache = self._decoding_cache = LRUCache('evm_instructions', 100000, 'Maximum number of decoded instructions kept per EVM')
 
         pc = self.pc
         if isinstance(pc, Constant):
@@ -878,6 +880,25 @@ class EVM(Eventful):
             assert last_instruction.pushes == 0
             assert result is None
 
+    def _guard_results(self, pushes):
+        ''' Abstract or concretize the oversized values among the last
+            `pushes` in the stack. The instruction is done at this point. '''
+        for pos in range(1, pushes + 1):
+            value = self.stack[-pos]
+            if not oversized(value):
+                continue
+            policy = oversized_policy('evm_stack', value)
+            if policy == 'abstract':
+                self.stack[-pos] = abstract(self.constraints, value)
+                continue
+
+            def setstate(state, concrete, pos=pos):
+                state.platform.current_vm.stack[-pos] = concrete
+            raise Concretize("Concretize oversized stack value",
+                             expression=value,
+                             setstate=setstate,
+                             policy=policy)
+
     #Execute an instruction from current pc
     def execute(self):
         pc = self.pc
@@ -899,6 +920,8 @@ class EVM(Eventful):
             last_pc, last_gas, instruction, arguments = self._checkpoint()
             result = self._handler(*arguments)
             self._advance(result)
+            if instruction.pushes:
+                self._guard_results(instruction.pushes)
         except ConcretizeStack as ex:
             self._rollback()
             pos = -ex.pos
@@ -2536,10 +2536,11 @@ class SLinux(Linux):
     def _transform_write_data(self, data: MixedSymbolicBuffer) -> bytes:
         bytes_concretized: int = 0
         concrete_data: bytes = bytes()
+        values = iter(solver.get_values(self.constraints, [c for c in data if issymbolic(c)]))
         for c in data:
             if issymbolic(c):
                 bytes_concretized += 1
-                c = bytes([solver.get_value(self.constraints, c)])
+                c = bytes([next(values)])
             concrete_data += cast(bytes, c)
 
         if bytes_concretized > 0:
@@ -2703,9 +2704,11 @@ class SLinux(Linux):
                     return c.encode()
                 return c
             try:
+                # Solve all the symbolic bytes of the buffer at once
+                values = iter(solver.get_values(self.constraints, [c for c in data if issymbolic(c)]))
                 for c in data:
                     if issymbolic(c):
-                        c = solver.get_value(self.constraints, c)
+                        c = next(values)
                     fd.write(make_chr(c))
             except SolverException:
                 fd.write('{SolverException}')
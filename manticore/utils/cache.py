@@ -0,0 +1,233 @@
+"""
+Named, bounded caches.
+
+Every cache has a name in the ``cache`` config group that holds its maximum
+size, so it can be tuned from a manticore.yml or from the command line (e.g.
+``--cache.simplify 0`` disables the simplify cache). Several caches may share a
+name (e.g. one instruction cache per cpu); they then share the size and the
+hit/miss/eviction counters reported by :func:`stats`.
+"""
+import functools
+import logging
+import weakref
+
+from collections import OrderedDict
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+consts = config.get_group('cache')
+consts.add('log_stats', default=False, description='Log the hits, misses and evictions of every cache when a worker stops')
+
+# name -> CacheCounters, for every registered name
+_counters = {}
+# name -> live caches with that name
+_instances = {}
+# name -> the cache returned by get_cache
+_shared = {}
+
+
+class CacheCounters(object):
+    ''' Hits, misses and evictions of all the caches with a name '''
+    __slots__ = ('hits', 'misses', 'evictions')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+def register(name, default_size, description=None):
+    '''
+    Define the size option of the caches named `name`. Registering a name
+    twice is fine, the first default and description win.
+
+    :param str name: the cache name, also its config option name
+    :param int default_size: default maximum size
+    :param str description: help for the config option
+    :rtype: CacheCounters
+    '''
+    if name not in consts:
+        consts.add(name, default=default_size, description=description)
+    counters = _counters.get(name)
+    if counters is None:
+        counters = _counters[name] = CacheCounters()
+        _instances[name] = weakref.WeakSet()
+    return counters
+
+
+class LRUCache(object):
+    '''
+    A least recently used cache with a size taken from ``cache.<name>``.
+
+    Without a `weigher` the size is the number of entries. With one, each
+    entry weighs ``weigher(key, value)`` and the least recently used entries are
+    evicted until the total weight fits. A size of 0 disables the cache.
+
+    ``key in cache`` counts a hit or a miss, so the usual
+    ``if key in cache: return cache[key]`` is accounted once.
+    '''
+
+    def __init__(self, name, default_size, description=None, weigher=None):
+        self.name = name
+        self.counters = register(name, default_size, description)
+        _instances[name].add(self)
+        self._weigher = weigher
+        self._weight = 0
+        self._entries = OrderedDict()
+
+    @property
+    def max_size(self):
+        return getattr(consts, self.name)
+
+    @property
+    def weight(self):
+        ''' Current size, in the units of max_size '''
+        return len(self._entries) if self._weigher is None else self._weight
+
+    def __contains__(self, key):
+        if key in self._entries:
+            self.counters.hits += 1
+            return True
+        self.counters.misses += 1
+        return False
+
+    def __getitem__(self, key):
+        value = self._entries[key]
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.counters.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.counters.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        entries = self._entries
+        weigher = self._weigher
+        if weigher is not None:
+            if key in entries:
+                self._weight -= weigher(key, entries[key])
+            self._weight += weigher(key, value)
+        entries[key] = value
+        entries.move_to_end(key)
+        self._evict(self.max_size)
+
+    def _evict(self, max_size):
+        entries = self._entries
+        weigher = self._weigher
+        counters = self.counters
+        if weigher is None:
+            while len(entries) > max_size:
+                entries.popitem(last=False)
+                counters.evictions += 1
+        else:
+            while self._weight > max_size and entries:
+                key, value = entries.popitem(last=False)
+                self._weight -= weigher(key, value)
+                counters.evictions += 1
+
+    def pop(self, key, default=None):
+        if key not in self._entries:
+            return default
+        value = self._entries.pop(key)
+        if self._weigher is not None:
+            self._weight -= self._weigher(key, value)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self._weight = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __repr__(self):
+        return f'<LRUCache {self.name} {self.weight}/{self.max_size}>'
+
+
+def get_cache(name, default_size, description=None, weigher=None):
+    '''
+    The process wide cache named `name`, created on first use
+
+    :rtype: LRUCache
+    '''
+    cache = _shared.get(name)
+    if cache is None:
+        cache = _shared[name] = LRUCache(name, default_size, description, weigher)
+    return cache
+
+
+def memoize(name, default_size, description=None):
+    '''
+    Decorator caching the results of a function of one hashable argument in
+    the shared cache `name`. The cache is available as ``function.cache``.
+    '''
+    def decorator(function):
+        cache = get_cache(name, default_size, description)
+        missing = object()
+
+        @functools.wraps(function)
+        def wrapper(argument):
+            value = cache.get(argument, missing)
+            if value is missing:
+                value = function(argument)
+                cache[argument] = value
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def stats(since=None):
+    '''
+    Counters of every cache name, as
+    ``{name: {'hits': .., 'misses': .., 'evictions': .., 'size': ..}}``.
+
+    :param dict since: a previous result of stats(); if given, only what
+        happened after it is counted (the size is always current)
+    '''
+    result = {}
+    for name, counters in _counters.items():
+        entry = {'hits': counters.hits,
+                 'misses': counters.misses,
+                 'evictions': counters.evictions,
+                 'size': sum(cache.weight for cache in _instances[name])}
+        if since is not None and name in since:
+            for key in ('hits', 'misses', 'evictions'):
+                entry[key] -= since[name][key]
+        result[name] = entry
+    return result
+
+
+def merge(total, report):
+    ''' Add the counters of a stats() `report` into `total`, keeping the
+        largest size '''
+    for name, entry in report.items():
+        total_entry = total.setdefault(name, {})
+        for key, value in entry.items():
+            if key == 'size':
+                total_entry[key] = max(total_entry.get(key, 0), value)
+            else:
+                total_entry[key] = total_entry.get(key, 0) + value
+    return total
+
+
+def log_stats(report, log=logger):
+    ''' Log one line per cache used in `report` '''
+    for name, entry in sorted(report.items()):
+        lookups = entry['hits'] + entry['misses']
+        if not lookups:
+            continue
+        log.info("Cache %s: %d hits, %d misses (%.1f%% hit rate), %d evictions, size %d/%d",
+                 name, entry['hits'], entry['misses'], 100.0 * entry['hits'] / lookups,
+                 entry['evictions'], entry['size'], getattr(consts, name))
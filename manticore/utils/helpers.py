@@ -2,13 +2,15 @@ import copy
 import functools
 import collections
 import logging
+import io
 import pickle
 import re
+import struct
 import sys
 import resource
 
-from collections import OrderedDict
 from ..core.smtlib import Expression, BitVecConstant
+from ..core.smtlib.expression import taint_mask, expression_values, fill_expression, ArrayProxy
 
 
 logger = logging.getLogger(__name__)
@@ -36,7 +38,7 @@ def istainted(arg, taint=None):
     if not issymbolic(arg):
         return False
     if taint is None:
-        return len(arg.taint) != 0
+        return arg.is_tainted
     for arg_taint in arg.taint:
         m = re.match(taint, arg_taint, re.DOTALL | re.IGNORECASE)
         if m:
@@ -69,57 +71,19 @@ def taint_with(arg, taint, value_bits=256, index_bits=256):
     :param arg: a value or Expression
     :param taint: a regular expression matching a taint value (eg. 'IMPORTANT.*'). If None, this function checks for any taint value.
     '''
-    tainted_fset = frozenset((taint,))
-
     if not issymbolic(arg):
         if isinstance(arg, int):
-            arg = BitVecConstant(value_bits, arg)
-            arg._taint = tainted_fset
+            arg = BitVecConstant(value_bits, arg, taint=(taint,))
         else:
             raise ValueError("type not supported")
 
     else:
         arg = copy.copy(arg)
-        arg._taint |= tainted_fset
+        arg._taint |= taint_mask((taint,))
 
     return arg
 
 
-class CacheDict(OrderedDict):
-    def __init__(self, *args, max_size=30000, flush_perc=30, **kwargs):
-        self._max_size = max_size
-        self._purge_percent = flush_perc * 0.01
-        self._misses = 0
-        self._hits = 0
-        self._flushes = 0
-        super().__init__(*args, **kwargs)
-
-    def __del__(self):
-        log = logging.getLogger(self.__class__.__name__)
-        log.debug(
-            f'DictCache: hits: {self._hits}, misses: {self._misses}, flushes: {self._flushes}, size: {self.__len__()}')
-
-    def __setitem__(self, key, value):
-        if len(self) > self._max_size:
-            self.flush()
-        return super().__setitem__(key, value)
-
-    def __contains__(self, item):
-        x = super().__contains__(item)
-        if x:
-            self._hits += 1
-        else:
-            self._misses += 1
-        return x
-
-    def flush(self):
-        self._flushes += 1
-        purge_count = int(len(self) * self._purge_percent)
-        for i in range(purge_count):
-            self.popitem(last=False)
-        self._hits -= purge_count
-
-
 class StateSerializer(object):
     """
     StateSerializer can serialize and deserialize :class:`~manticore.core.state.State` objects from and to
@@ -157,3 +121,90 @@ class PickleSerializer(StateSerializer):
 
     def deserialize(self, f):
         return pickle.load(f)
+
+
+def _new_expression(cls):
+    ''' An expression with no fields yet, see FastSerializer '''
+    return cls.__new__(cls)
+
+
+class _FlatPickler(pickle.Pickler):
+    '''
+    Pickles each expression as an empty node of its class, and collects it
+    in `pending` to pickle its fields later. The out-of-band buffers are
+    collected in `buffers`.
+    '''
+
+    def __init__(self, f):
+        self.pending = []
+        self.buffers = []
+        super().__init__(f, 5, buffer_callback=self.buffers.append)
+
+    def reducer_override(self, obj):
+        if isinstance(obj, Expression) and not isinstance(obj, ArrayProxy):
+            self.pending.append(obj)
+            return _new_expression, (obj.__class__,)
+        return NotImplemented
+
+
+class FastSerializer(StateSerializer):
+    """
+    Serializer for states with deep expressions, selected with
+    ``state_serialization_method='fast'``.
+
+    Pickle recurses on the operands of an expression, so PickleSerializer
+    needs a recursion limit over the depth of the expressions of a state.
+    This serializer pickles an expression as an empty node, and the fields
+    of the nodes afterwards, as a flat table with the operands referring to
+    their nodes. So the recursion does not depend on the depth of the
+    expressions, and shared subexpressions are still pickled once.
+
+    It uses pickle protocol 5, and writes the out-of-band buffers (e.g. the
+    data of the memory maps) before the pickle instead of copying them into
+    it. They are loaded back in place, and the maps take them over.
+    """
+    MAGIC: bytes = b'MFST'
+    _HEADER = struct.Struct('<4sI')
+    _BUFFER = struct.Struct('<?Q')
+
+    def serialize(self, state, f):
+        data = io.BytesIO()
+        pickler = _FlatPickler(data)
+        pickler.dump(state)
+        # The fields of the expressions found, which can find others
+        while pickler.pending:
+            nodes, pickler.pending = pickler.pending, []
+            pickler.dump([(node, expression_values(node)) for node in nodes])
+        pickler.dump([])
+
+        buffers = [buffer.raw() for buffer in pickler.buffers]
+        f.write(self._HEADER.pack(self.MAGIC, len(buffers)))
+        for buffer in buffers:
+            f.write(self._BUFFER.pack(not buffer.readonly, buffer.nbytes))
+        for buffer in buffers:
+            f.write(buffer)
+        f.write(data.getbuffer())
+
+    def deserialize(self, f):
+        magic, count = self._HEADER.unpack(f.read(self._HEADER.size))
+        if magic != self.MAGIC:
+            raise ValueError('Not a state serialized by FastSerializer')
+        sizes = [self._BUFFER.unpack(f.read(self._BUFFER.size)) for _ in range(count)]
+        buffers = []
+        for writable, size in sizes:
+            if writable:
+                buffer = bytearray(size)
+                f.readinto(buffer)
+            else:
+                buffer = f.read(size)
+            buffers.append(buffer)
+
+        unpickler = pickle.Unpickler(f, buffers=buffers)
+        state = unpickler.load()
+        while True:
+            nodes = unpickler.load()
+            if not nodes:
+                break
+            for node, values in nodes:
+                fill_expression(node, values)
+        return state
@@ -1,10 +1,20 @@
 from __future__ import print_function
 from manticore import Manticore
+from manticore.core.smtlib import SolverStats
 from sys import argv, exit
 
 def display(results):
-    for line in str(results).split('\n'):
-        print("  " + line)
+    callers = sorted(results.get('callers', {}).items(), key=lambda item: item[1].get('time', 0), reverse=True)
+    print("  {:<48} {:>8} {:>8} {:>10} {:>12} {:>10}".format('caller', 'queries', 'checks', 'sat/unsat', 'bytes', 'time'))
+    for caller, stats in callers:
+        print("  {:<48} {:>8} {:>8} {:>10} {:>12} {:>10.3f}".format(
+            caller, stats.get('queries', 0), stats.get('checks', 0),
+            '{}/{}'.format(stats.get('sat', 0), stats.get('unsat', 0)),
+            stats.get('bytes', 0), stats.get('time', 0)))
+    print("  Slowest queries:")
+    for query in results.get('slowest', []):
+        print("    {:10.3f}s {} from {} ({} checks, {} bytes, {})".format(
+            query['time'], query['method'], query['caller'], query['checks'], query['bytes'], query['result']))
 
 def benchmark(program):
     print("[*] Benchmarking program \"{}\"".format(program))
@@ -12,7 +22,7 @@ def benchmark(program):
     m = Manticore(program)
     m.run(should_profile=True)
 
-    results = m._executor.dump_stats()
+    results = m.context.get('solver_stats')
     if results is None:
         print("[*] Failed to collect stats for program {}".format(program))
         return
@@ -29,16 +39,13 @@ if __name__ == "__main__":
 
     first_program = args[0]
     other_programs = args[1:]
-    overall_results = benchmark(first_program)
+    overall_results = benchmark(first_program) or {}
 
     if other_programs:
         for program in other_programs:
             results = benchmark(program)
-            overall_results.time_elapsed += results.time_elapsed
-            overall_results.instructions_executed += results.instructions_executed
-            overall_results.solver_time += results.solver_time
-            overall_results.loading_time += results.loading_time
-            overall_results.saving_time += results.saving_time
-            
+            if results is not None:
+                SolverStats.merge(overall_results, results)
+
         print("Overall:")
         display(overall_results)
@@ -0,0 +1,103 @@
+from __future__ import print_function
+from manticore.core.smtlib import *
+from manticore.core.smtlib.expression import BitVecConcat, BitVecExtract, BitVecZeroExtend
+from manticore.utils.helpers import PickleSerializer
+from sys import argv
+import gc
+import io
+import pickle
+import time
+import tracemalloc
+
+# Size of the synthetic workloads
+WORDS = 2000
+STORES = 4000
+
+
+def evm_like():
+    ''' 256 bit words read out of symbolic calldata and combined like the
+        arithmetic and comparisons of a contract '''
+    cs = ConstraintSet()
+    calldata = cs.new_array(index_bits=256, index_max=4096, value_bits=8, name='CALLDATA').array
+    result = []
+    acc = BitVecConstant(256, 0)
+    for i in range(WORDS):
+        offset = (i * 32) % 4064
+        word = BitVecConcat(256, *[ArraySelect(calldata, BitVecConstant(256, offset + j)) for j in range(32)])
+        acc = BitVecITE(256, acc.ult(word), acc + word * 3, acc - (word & 0xff))
+        result.append(acc == 0)
+    return result
+
+
+def linux_like():
+    ''' A chain of 32 bit stores into symbolic memory plus the flags of the
+        instructions that computed the stored values '''
+    cs = ConstraintSet()
+    memory = cs.new_array(index_bits=32, value_bits=8, name='MEM').array
+    eax = cs.new_bitvec(32, name='EAX')
+    result = []
+    for i in range(STORES // 4):
+        eax = eax + i
+        for j in range(4):
+            memory = ArrayStore(memory, BitVecConstant(32, 0x1000 + i * 4 + j), BitVecExtract(eax, j * 8, 8))
+        zf = eax == 0
+        cf = BitVecZeroExtend(64, eax).ugt(0xffffffff)
+        result.append(Operators.OR(zf, cf))
+    result.append(memory)
+    return result
+
+
+def count_nodes(roots):
+    ''' Number of distinct expression nodes reachable from roots '''
+    seen = set()
+    stack = list(roots)
+    while stack:
+        expression = stack.pop()
+        if id(expression) in seen:
+            continue
+        seen.add(id(expression))
+        if isinstance(expression, Operation):
+            stack.extend(expression.operands)
+    return len(seen)
+
+
+def measure(name, build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    roots = build()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    nodes = count_nodes(roots)
+    serializer = PickleSerializer()
+    start = time.time()
+    f = io.BytesIO()
+    serializer.serialize(roots, f)
+    data = f.getvalue()
+    dump_time = time.time() - start
+    start = time.time()
+    serializer.deserialize(io.BytesIO(data))
+    load_time = time.time() - start
+    print("{:<12} {:>8} nodes {:>8.1f} bytes/node {:>10} pickle bytes {:>6.1f} bytes/node  dump {:.2f}s load {:.2f}s".format(
+        name, nodes, allocated / nodes, len(data), len(data) / nodes, dump_time, load_time))
+
+
+def measure_state(filename):
+    ''' Pickle size of a saved state (e.g. a .pkl of a workspace) '''
+    with open(filename, 'rb') as f:
+        state = PickleSerializer().deserialize(f)
+    f = io.BytesIO()
+    PickleSerializer().serialize(state, f)
+    data = f.getvalue()
+    nodes = count_nodes(state.constraints.constraints)
+    print("{:<40} {:>8} constraint nodes {:>10} pickle bytes".format(filename, nodes, len(data)))
+
+
+if __name__ == "__main__":
+    if len(argv) > 1:
+        for filename in argv[1:]:
+            measure_state(filename)
+    else:
+        measure('evm-like', evm_like)
+        measure('linux-like', linux_like)
@@ -0,0 +1,55 @@
+from __future__ import print_function
+from manticore.core.smtlib import *
+from manticore.core.smtlib.expression import BitVecITE
+from manticore.core.smtlib.visitors import translate_to_smtlib
+from sys import argv
+import time
+
+# Levels of the synthetic ITE trees
+DEPTH = 8
+
+
+def ite_chain(depth):
+    ''' Every level uses the previous one three times, like the flags
+        computed from a symbolic value or a read at a symbolic address '''
+    cs = ConstraintSet()
+    value = cs.new_bitvec(32, name='X')
+    for level in range(depth):
+        value = BitVecITE(32, value == level, value + 1, value * 2)
+    return cs, value
+
+
+def memory_read(depth):
+    ''' A read at a symbolic address over `depth` writes at symbolic
+        addresses, each depending on the previous read '''
+    cs = ConstraintSet()
+    memory = cs.new_array(index_bits=32, value_bits=32, name='M')
+    address = cs.new_bitvec(32, name='A')
+    value = BitVecConstant(32, 0)
+    known = []
+    for level in range(depth):
+        known.append((address + level, value))
+        read = BitVecConstant(32, 0)
+        for where, what in known:
+            read = BitVecITE(32, address + value == where, what, read)
+        value = read + memory[address]
+    return cs, value
+
+
+def measure(name, build, **kwargs):
+    cs, expression = build(DEPTH)
+    start = time.time()
+    smtlib = translate_to_smtlib(expression, **kwargs)
+    elapsed = time.time() - start
+    start = time.time()
+    value = solver.get_value(cs, expression)
+    print("{:<12} {:<9} {:>12} bytes {:>8.3f}s translate {:>8.3f}s get_value ({})".format(
+        name, 'bindings' if kwargs.get('use_bindings') else 'flat', len(smtlib), elapsed, time.time() - start, value))
+
+
+if __name__ == "__main__":
+    if len(argv) > 1:
+        DEPTH = int(argv[1])
+    for name, build in (('ite-chain', ite_chain), ('memory-read', memory_read)):
+        measure(name, build)
+        measure(name, build, use_bindings=True)
@@ -13,6 +13,7 @@ from manticore.core.plugin import Plugin
 from manticore.core.smtlib import ConstraintSet, operators
 from manticore.core.smtlib.expression import BitVec
 from manticore.core.smtlib import solver
+from manticore.core import workspace
 from manticore.core.state import State, TerminateState
 from manticore.ethereum import ManticoreEVM, DetectIntegerOverflow, Detector, NoAliveStates, ABI, EthereumError
 from manticore.platforms.evm import EVMWorld, ConcretizeStack, concretized_args, Return, Stop
@@ -29,6 +30,19 @@ from manticore.utils.log import init_logging
 
 init_logging()
 
+
+def setUpModule():
+    # Keep the workspaces of the test runs out of the working directory
+    global _workspace_dir
+    _workspace_dir = tempfile.mkdtemp()
+    workspace.consts.dir = _workspace_dir
+
+
+def tearDownModule():
+    workspace.consts.dir = '.'
+    shutil.rmtree(_workspace_dir)
+
+
 def make_mock_evm_state():
     cs = ConstraintSet()
     fakestate = State(cs, EVMWorld(cs))
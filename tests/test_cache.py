@@ -0,0 +1,90 @@
+import unittest
+
+from manticore.utils import cache
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.LRUCache('test_lru', 3)
+        self.before = cache.stats()
+
+    def tearDown(self):
+        cache.consts.test_lru = 3
+
+    def test_least_recently_used_is_evicted(self):
+        c = self.cache
+        c['a'] = 1
+        c['b'] = 2
+        c['c'] = 3
+        # Touch a, so b is the least recently used
+        self.assertEqual(c['a'], 1)
+        c['d'] = 4
+        self.assertEqual(list(c), ['c', 'a', 'd'])
+        self.assertEqual(len(c), 3)
+
+    def test_counters(self):
+        c = self.cache
+        c['a'] = 1
+        self.assertTrue('a' in c)
+        self.assertFalse('b' in c)
+        self.assertEqual(c.get('a'), 1)
+        self.assertIsNone(c.get('b'))
+        for key in 'bcd':
+            c[key] = key
+        report = cache.stats(since=self.before)['test_lru']
+        self.assertEqual(report['hits'], 2)
+        self.assertEqual(report['misses'], 2)
+        self.assertEqual(report['evictions'], 1)
+
+    def test_size_from_config(self):
+        c = self.cache
+        cache.consts.test_lru = 1
+        c['a'] = 1
+        c['b'] = 2
+        self.assertEqual(list(c), ['b'])
+        cache.consts.test_lru = 0
+        c['c'] = 3
+        self.assertEqual(len(c), 0)
+
+    def test_weigher(self):
+        c = cache.LRUCache('test_lru', 3, weigher=lambda key, value: len(value))
+        c['a'] = 'xx'
+        c['b'] = 'y'
+        self.assertEqual(c.weight, 3)
+        c['c'] = 'zz'
+        self.assertEqual(list(c), ['b', 'c'])
+        self.assertEqual(c.weight, 3)
+        c.pop('c')
+        self.assertEqual(c.weight, 1)
+
+    def test_shared_name(self):
+        other = cache.LRUCache('test_lru', 100)
+        self.cache['a'] = 1
+        other['b'] = 2
+        self.assertEqual(other.max_size, 3)
+        self.assertEqual(cache.stats()['test_lru']['size'], 2)
+
+    def test_memoize(self):
+        calls = []
+
+        @cache.memoize('test_memoize', 10)
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(calls, [2])
+        double.cache.clear()
+        self.assertEqual(double(2), 4)
+        self.assertEqual(calls, [2, 2])
+
+    def test_merge(self):
+        total = {}
+        cache.merge(total, {'x': {'hits': 1, 'misses': 2, 'evictions': 0, 'size': 5}})
+        cache.merge(total, {'x': {'hits': 3, 'misses': 1, 'evictions': 1, 'size': 4}})
+        self.assertEqual(total, {'x': {'hits': 4, 'misses': 3, 'evictions': 1, 'size': 5}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,9 @@ from manticore.core.cpu.x86 import *
 from manticore.core.smtlib import Operators
 from manticore.core.memory import *
 from manticore.core.smtlib import BitVecOr
+from manticore.core.smtlib.expression import Variable
+from manticore.core.smtlib import guard
+from manticore.core.cpu.abstractcpu import ConcretizeRegister
 from tests import mockmem
 from functools import reduce
 
@@ -1144,6 +1147,52 @@ Using the SAR instruction to perform a division operation does not produce the s
 
         self.assertEqual(cpu.EIP, code+1)
 
+    def _oversized_cpu(self, policy):
+        guard.consts.max_expression_depth = 8
+        guard.consts.oversized_policy = policy
+        self.addCleanup(setattr, guard.consts, 'max_expression_depth', 0)
+        self.addCleanup(setattr, guard.consts, 'oversized_policy', 'ONE')
+        cs = ConstraintSet()
+        mem = SMemory32(cs)
+        cpu = I386Cpu(mem)
+        value = cs.new_bitvec(32, 'VALUE')
+        for i in range(6):
+            value = value * 3 + i
+        return cs, cpu, value
+
+    def test_oversized_register_abstracted(self):
+        cs, cpu, value = self._oversized_cpu('abstract')
+        cpu.EAX = value
+        self.assertIsInstance(cpu.EAX, Variable)
+        cs.add(cs.get_variable('VALUE') == 0)
+        self.assertEqual(solver.get_value(cs, cpu.EAX), 179)
+
+    def test_oversized_memory_abstracted(self):
+        cs, cpu, value = self._oversized_cpu('abstract')
+        stack = cpu.memory.mmap(0xf000, 0x1000, 'rw')
+        cpu.write_int(stack, value, 32)
+        self.assertLess(cpu.read_int(stack, 32).depth, 8)
+
+    def test_oversized_register_concretized(self):
+        cs, cpu, value = self._oversized_cpu('ONE')
+        code = cpu.memory.mmap(0x1000, 0x1000, 'rwx')
+        # add esi, edx
+        cpu.memory[code:code+2] = '\x01\xd6'
+        cpu.EIP = code
+        cpu.ESI = 1
+        cpu.EDX = value
+        self.assertIs(cpu.EDX, value)
+        # Written out of an instruction, concretized before the next one
+        with self.assertRaises(ConcretizeRegister) as e:
+            cpu.execute()
+        self.assertEqual((e.exception.reg_name, e.exception.policy), ('EDX', 'ONE'))
+        self.assertEqual(cpu.EIP, code)
+        # Concretized once the instruction is done
+        with self.assertRaises(ConcretizeRegister) as e:
+            cpu.execute()
+        self.assertEqual(e.exception.reg_name, 'ESI')
+        self.assertEqual(cpu.EIP, code + 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -10,8 +10,22 @@ import collections
 import time
 
 from manticore import Manticore, issymbolic
+from manticore.core import workspace
 from manticore.core.smtlib import BitVecVariable
 
+
+def setUpModule():
+    # Keep the workspaces of the test runs out of the working directory
+    global _workspace_dir
+    _workspace_dir = tempfile.mkdtemp()
+    workspace.consts.dir = _workspace_dir
+
+
+def tearDownModule():
+    workspace.consts.dir = '.'
+    shutil.rmtree(_workspace_dir)
+
+
 class ManticoreDriverTest(unittest.TestCase):
     _multiprocess_can_split_ = True
     def setUp(self):
@@ -0,0 +1,123 @@
+import glob
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from manticore import Manticore
+from manticore.core import executor, workspace
+from manticore.core.executor import StateQueues
+from manticore.core.plugin import Plugin
+
+
+def setUpModule():
+    # Keep the workspaces of the test runs out of the working directory
+    global _workspace_dir
+    _workspace_dir = tempfile.mkdtemp()
+    workspace.consts.dir = _workspace_dir
+
+
+def tearDownModule():
+    workspace.consts.dir = '.'
+    shutil.rmtree(_workspace_dir)
+
+
+def _explore(queues, explored, forks):
+    ''' Worker running a binary tree of states: state i forks 2i+1 and 2i+2 '''
+    queues.start_worker()
+    while True:
+        state_id = queues.get(lambda state_ids: state_ids[-1], lambda: False)
+        if state_id is None:
+            break
+        explored.put(state_id)
+        if state_id < forks:
+            queues.put(2 * state_id + 1)
+            queues.put(2 * state_id + 2)
+        queues.done()
+    queues.stop_worker()
+
+
+class StateQueuesTest(unittest.TestCase):
+    def test_single_worker(self):
+        queues = StateQueues()
+        queues.put(0)
+        queues.put(1)
+        self.assertEqual(queues.list(), [0, 1])
+        explored = multiprocessing.Queue()
+        _explore(queues, explored, 0)
+        self.assertEqual(sorted(explored.get() for _ in range(2)), [0, 1])
+        self.assertEqual(queues.list(), [])
+
+    def test_policy_picks_from_the_local_queue(self):
+        queues = StateQueues()
+        queues.start_worker()
+        for state_id in (5, 6, 7):
+            queues.put(state_id)
+        self.assertEqual(queues.get(min, lambda: False), 5)
+        self.assertEqual(queues.list(), [6, 7])
+
+    def test_workers_share_the_states(self):
+        queues = StateQueues()
+        explored = multiprocessing.Queue()
+        queues.put(0)
+        workers = [multiprocessing.Process(target=_explore, args=(queues, explored, 100)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        states = sorted(explored.get(timeout=60) for _ in range(201))
+        for worker in workers:
+            worker.join(60)
+            self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(states, list(range(201)))
+        self.assertTrue(explored.empty())
+        self.assertEqual(queues.list(), [])
+
+    def test_shutdown(self):
+        queues = StateQueues()
+        queues.start_worker()
+        queues.put(1)
+        self.assertIsNone(queues.get(min, lambda: True))
+        queues.stop_worker()
+        self.assertEqual(queues.list(), [1])
+
+
+class StateEventsPlugin(Plugin):
+    def __init__(self):
+        super().__init__()
+        self.enqueued = []
+        self.loaded = []
+
+    def did_enqueue_state_callback(self, state_id, state):
+        self.enqueued.append(state_id)
+
+    def will_load_state_callback(self, state_id):
+        self.loaded.append(state_id)
+
+
+class KeepForkedStateTest(unittest.TestCase):
+    def tearDown(self):
+        executor.consts.keep_forked_state = True
+
+    def _run(self, keep):
+        executor.consts.keep_forked_state = keep
+        dirname = os.path.dirname(__file__)
+        m = Manticore(os.path.join(dirname, 'binaries', 'basic_linux_amd64'))
+        events = StateEventsPlugin()
+        m.register_plugin(events)
+        m.run()
+        return events, len(glob.glob(os.path.join(m.workspace, '*.stdin')))
+
+    def test_keep_forked_state(self):
+        spilled, spilled_testcases = self._run(False)
+        kept, kept_testcases = self._run(True)
+        self.assertEqual(kept_testcases, spilled_testcases)
+        # The initial state and both children of the fork
+        self.assertEqual(len(spilled.enqueued), 3)
+        # The child kept in memory is loaded but never enqueued
+        self.assertEqual(len(kept.enqueued), 2)
+        self.assertEqual(len(kept.loaded), 3)
+        self.assertEqual(len(set(kept.loaded)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,22 @@
 import unittest
 import os
+import shutil
+import tempfile
 
 from manticore import Manticore
+from manticore.core import workspace
+
+
+def setUpModule():
+    # Keep the workspaces of the test runs out of the working directory
+    global _workspace_dir
+    _workspace_dir = tempfile.mkdtemp()
+    workspace.consts.dir = _workspace_dir
+
+
+def tearDownModule():
+    workspace.consts.dir = '.'
+    shutil.rmtree(_workspace_dir)
 
 
 class ManticoreTest(unittest.TestCase):
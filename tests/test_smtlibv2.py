@@ -1,4 +1,7 @@
 from manticore.core.smtlib import *
+from manticore.core.smtlib.solver import consts as smt_consts
+from manticore.core.smtlib import guard
+from manticore.utils.helpers import taint_with
 import unittest
 import fcntl
 import resource
@@ -32,6 +35,20 @@ class ExpressionTest(unittest.TestCase):
         cs = ConstraintSet()
         self.assertFalse(self.solver.can_be_true(cs, x == False))
 
+    def test_duplicated_constraint(self):
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32)
+        # The shared subterm is bound to a name in the assertion
+        square = x * x + 3
+        constraint = square + square > 10
+        cs.add(constraint)
+        cs.add(constraint)
+        self.assertTrue(self.solver.check(cs))
+        with cs as child:
+            child.add(constraint)
+            self.assertTrue(self.solver.can_be_true(child, x == 10))
+            self.assertTrue(self.solver.get_value(child, constraint))
+
     def testBasicAST_001(self):
         ''' Can't build abstract classes '''
         a = BitVecConstant(32, 100)
@@ -77,6 +94,96 @@ class ExpressionTest(unittest.TestCase):
         b = cs.new_bitvec(32)
         cs.add(a + b > 100)
 
+    def testConstraintsSlicing(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        b = cs.new_bitvec(32)
+        c = cs.new_bitvec(32)
+        d = cs.new_bitvec(32)
+        a_gt = a > 10
+        cs.add(a_gt)
+        cs.add(c > 20)
+        self.assertEqual(cs.cluster_stats['clusters'], 2)
+        self.assertEqual(cs.get_related_constraints(a + 1), {a_gt})
+
+        with cs as temp_cs:
+            # linking a and c merges their clusters in the child only
+            temp_cs.add(a == c)
+            temp_cs.add(d == 1)
+            self.assertEqual(len(temp_cs.get_related_constraints(a)), 3)
+            self.assertEqual(len(temp_cs.get_related_constraints(d)), 1)
+            self.assertNotIn(' %s ' % a.name, temp_cs.to_string(related_to=d))
+            self.assertEqual(temp_cs.cluster_stats['clusters'], 2)
+            self.assertEqual(temp_cs.cluster_stats['max_cluster'], 3)
+            self.assertFalse(self.solver.can_be_true(temp_cs, a != c))
+
+        self.assertEqual(cs.get_related_constraints(a), {a_gt})
+        self.assertEqual(len(cs.get_related_constraints(b)), 0)
+        self.assertEqual(cs.cluster_stats['clusters'], 2)
+        cs.add(a == b)
+        cs.add(b == c)
+        self.assertEqual(len(cs.get_related_constraints(a)), 4)
+        self.assertEqual(cs.cluster_stats['clusters'], 1)
+
+        # an impossible constraint is related to everything
+        false = BoolConstant(False)
+        cs.add(false)
+        self.assertIn(false, cs.get_related_constraints(d))
+        self.assertFalse(self.solver.check(cs))
+
+    def testConstraintsSlicingLineage(self):
+        import contextlib
+        cs = ConstraintSet()
+        variables = [cs.new_bitvec(32) for _ in range(ConstraintSet.MAX_INDEX_DEPTH * 2)]
+        for var in variables:
+            cs.add(var > 1)
+        self.assertEqual(cs.cluster_stats['clusters'], len(variables))
+
+        with contextlib.ExitStack() as stack:
+            # Every child links the next variable to the first one
+            current = cs
+            for i, var in enumerate(variables[1:], 2):
+                current = stack.enter_context(current)
+                current.add(var == variables[0])
+                self.assertEqual(len(current.get_related_constraints(variables[0])), i * 2 - 1)
+                self.assertEqual(current.cluster_stats['clusters'], len(variables) - i + 1)
+                # A child only holds the index entries it changed
+                self.assertLessEqual(len(current._uf.maps[0]), 2)
+                self.assertLessEqual(len(current._clusters.maps[0]), 2)
+                self.assertLessEqual(len(current._uf.maps), ConstraintSet.MAX_INDEX_DEPTH + 1)
+
+        # The parents are left as they were
+        self.assertEqual(cs.cluster_stats['clusters'], len(variables))
+        self.assertEqual(len(cs.get_related_constraints(variables[0])), 1)
+
+    def testConstraintsSerialization(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        b = cs.new_bitvec(32)
+        cs.add(a.ugt(10))
+        cs.add(a + b == 100)
+        parent_smtlib = cs.to_string()
+        self.assertEqual(parent_smtlib.count('declare-fun %s ' % a.name), 1)
+
+        with cs as temp_cs:
+            c = temp_cs.new_bitvec(32)
+            temp_cs.add(c == a)
+            child_smtlib = temp_cs.to_string()
+            # the parent serialization is reused as is
+            self.assertTrue(child_smtlib.startswith(parent_smtlib))
+            self.assertIs(cs._smtlib_segment(), cs._smtlib)
+            self.assertEqual(child_smtlib.count('declare-fun %s ' % a.name), 1)
+            self.assertEqual(child_smtlib.count('declare-fun %s ' % c.name), 1)
+            self.assertTrue(self.solver.check(temp_cs))
+
+        # once detached the child declares everything it uses
+        self.assertIn('declare-fun %s ' % a.name, temp_cs.to_string())
+        self.assertNotIn('declare-fun %s ' % b.name, temp_cs.to_string())
+
+        cs.add(b.ult(50))
+        self.assertTrue(cs.to_string().startswith(parent_smtlib))
+        self.assertEqual(self.solver.minmax(cs, a), (51, 100))
+
     def testSolver(self):
         cs =  ConstraintSet()
         a = cs.new_bitvec(32)
@@ -310,6 +417,20 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue(self.solver.check(cs))
         self.assertEqual(self.solver.get_value(cs, a), 1)
 
+    def test_get_values(self):
+        cs = ConstraintSet()
+        buf = cs.new_array(index_max=3)
+        x = cs.new_bitvec(32)
+        b = cs.new_bool()
+        cs.add(buf[0] == ord('A'))
+        cs.add(buf[1] == buf[0] + 1)
+        cs.add(buf[2] == 0)
+        cs.add(x == Operators.ZEXTEND(buf[1], 32))
+        cs.add(b == (x == 0x42))
+        self.assertEqual(self.solver.get_values(cs, [buf, x, 7, b]), [b'AB\x00', 0x42, 7, True])
+        self.assertEqual(self.solver.get_all_values(cs, buf), [b'AB\x00'])
+        self.assertEqual(self.solver.get_value(cs, buf), b'AB\x00')
+
     def testBitvector_max(self):
         cs = ConstraintSet()
         a = cs.new_bitvec(32)
@@ -326,6 +447,67 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue(self.solver.check(cs))
         self.assertEqual(self.solver.minmax(cs, a), (101,199))
 
+    def test_optimize_strategies(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        b = cs.new_bitvec(32)
+        cs.add(a.ult(0x12345))
+        cs.add(b == a * 3)
+        cs.add(a & 0xf0 != 0x30)
+        try:
+            for strategy in ('bitwise', 'linear'):
+                smt_consts.optimize_strategy = strategy
+                with cs as temp_cs:
+                    temp_cs.add(a.ugt(0x12300))
+                    self.assertEqual(self.solver.minmax(temp_cs, a), (0x12301, 0x12344))
+                    self.assertEqual(self.solver.max(temp_cs, b - a), 0x12344 * 2)
+        finally:
+            smt_consts.optimize_strategy = 'bitwise'
+
+        stats = self.solver.optimize_stats['bitwise']
+        self.assertEqual(stats['calls'], 3)
+        self.assertLessEqual(stats['checks'], 3 * 33)
+        self.assertEqual(self.solver.optimize_stats['linear']['calls'], 3)
+
+    def test_query_stats(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        cs.add(a.ult(10))
+
+        solver_stats.clear()
+        mark = solver_stats.mark()
+        self.assertTrue(self.solver.can_be_true(cs, a == 5))
+        self.assertFalse(self.solver.can_be_true(cs, a == 50))
+        self.assertLess(self.solver.get_value(cs, a), 10)
+        report = solver_stats.report(mark)
+
+        stats = report['callers']['test_smtlibv2.test_query_stats']
+        self.assertEqual(stats['queries'], 3)
+        self.assertEqual(stats['sat'], 2)
+        self.assertEqual(stats['unsat'], 1)
+        self.assertGreaterEqual(stats['checks'], 3)
+        self.assertGreaterEqual(stats['constraints'], 3)
+        self.assertGreater(stats['variables'], 0)
+        self.assertEqual([query['method'] for query in report['slowest']].count('can_be_true'), 2)
+        self.assertEqual(solver_stats.totals(mark)['queries'], 3)
+
+        merged = SolverStats.merge(SolverStats.merge({}, report), report)
+        self.assertEqual(merged['callers']['test_smtlibv2.test_query_stats']['queries'], 6)
+
+    def test_query_stats_caller(self):
+        from manticore.core.smtlib.solver import memoized
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        # More wrappers between the caller and the query
+        can_be_true = memoized(memoized(type(self.solver).can_be_true))
+
+        def forward(constraints, expression):
+            return can_be_true(self.solver, constraints, expression)
+
+        mark = solver_stats.mark()
+        self.assertTrue(forward(cs, a == 5))
+        self.assertEqual(list(solver_stats.report(mark)['callers']), ['test_smtlibv2.forward'])
+
     def testBool_nonzero(self):
         self.assertTrue(BoolConstant(True).__bool__())
         self.assertFalse(BoolConstant(False).__bool__())
@@ -371,6 +553,38 @@ class ExpressionTest(unittest.TestCase):
         self.assertItemsEqual(z.taint, ('important', 'stuff'))
         self.assertEqual(z.value, 300)
 
+    def test_evaluate(self):
+        cs = ConstraintSet()
+        x = cs.new_bitvec(8)
+        y = cs.new_bitvec(8)
+        arr = cs.new_array(index_max=4)
+        expressions = [BitVecAdd(x, y), BitVecSub(x, y), BitVecMul(x, y),
+                       BitVecDiv(x, y), BitVecUnsignedDiv(x, y), BitVecMod(x, y),
+                       BitVecRem(x, y), BitVecUnsignedRem(x, y), BitVecShiftLeft(x, y),
+                       BitVecShiftRight(x, y), BitVecArithmeticShiftRight(x, y),
+                       BitVecNot(x), BitVecNeg(x), x & y, x | y, x ^ y,
+                       Operators.SEXTEND(x, 8, 16), Operators.ZEXTEND(x, 16),
+                       Operators.EXTRACT(Operators.CONCAT(16, x, y), 4, 8), Operators.CONCAT(16, x, y),
+                       Operators.ITEBV(8, x < y, x, y),
+                       ArraySelect(ArrayStore(arr, Operators.ZEXTEND(x, 32), y), BitVecConstant(32, 1)),
+                       x < y, x <= y, x > y, x >= y, x == y,
+                       x.ult(y), x.ule(y), x.ugt(y), x.uge(y),
+                       Operators.AND(x == 3, Operators.OR(y == 3, x != y))]
+        model = {arr.name: {0: 7, 1: 0x80, 2: 9, 3: 10}}
+        for vx, vy in ((3, 0), (0xfd, 3), (3, 0xfd), (0x80, 0xff), (1, 1), (3, 9)):
+            model[x.name], model[y.name] = vx, vy
+            with cs as temp_cs:
+                temp_cs.add(x == vx)
+                temp_cs.add(y == vy)
+                for index, value in model[arr.name].items():
+                    temp_cs.add(arr[index] == value)
+                for expression in expressions:
+                    self.assertEqual(evaluate(expression, model), self.solver.get_value(temp_cs, expression))
+
+        # not enough information
+        self.assertIsNone(evaluate(arr[Operators.ZEXTEND(x, 32) + 4] + x, model))
+        self.assertIsNone(evaluate(x + cs.new_bitvec(8), model))
+
     def test_arithmetic_simplify(self):
         cs = ConstraintSet()
         arr = cs.new_array(name='MEM')
@@ -824,6 +1038,658 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue(self.solver._solver_version() > Version(major=4, minor=4, patch=1))
 
 
+class IncrementalExpressionTest(ExpressionTest):
+    ''' Same tests, solving incrementally over a single solver process '''
+
+    def setUp(self):
+        smt_consts.incremental = True
+        super().setUp()
+
+    def tearDown(self):
+        smt_consts.incremental = False
+        super().tearDown()
+
+    def test_incremental_reuses_process(self):
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32)
+        cs.add(x.ugt(10))
+        self.assertTrue(self.solver.check(cs))
+        proc = self.solver._proc
+
+        with cs as temp_cs:
+            temp_cs.add(x.ult(20))
+            self.assertItemsEqual(self.solver.get_all_values(temp_cs, x), range(11, 20))
+        self.assertTrue(self.solver.can_be_true(cs, x == 30))
+        self.assertFalse(self.solver.can_be_true(cs, x == 3))
+        cs.add(x.ult(15))
+        self.assertFalse(self.solver.can_be_true(cs, x == 30))
+        self.assertEqual(self.solver.minmax(cs, x), (11, 14))
+        self.assertIs(self.solver._proc, proc)
+
+        # An unrelated constraint set starts over
+        other = ConstraintSet()
+        y = other.new_bitvec(32)
+        other.add(y == 3)
+        self.assertEqual(self.solver.get_value(other, y), 3)
+        self.assertIsNot(self.solver._proc, proc)
+
+
+class ModelCacheExpressionTest(ExpressionTest):
+    ''' Same tests, answering can_be_true from the cached model when possible '''
+
+    def setUp(self):
+        smt_consts.model_cache = True
+        super().setUp()
+
+    def tearDown(self):
+        smt_consts.model_cache = False
+        super().tearDown()
+
+    def test_model_short_circuits_solver(self):
+        checks = []
+        check = self.solver._check
+        self.solver._check = lambda *args: checks.append(1) or check(*args)
+
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32)
+        y = cs.new_bitvec(32)
+        buf = cs.new_array(index_max=2)
+        cs.add(x.ugt(10))
+        cs.add(buf[0] == Operators.EXTRACT(x, 0, 8))
+        self.assertTrue(self.solver.can_be_true(cs, x.ult(5000)))
+        self.assertEqual(len(checks), 1)
+        values, _ = cs.model
+        self.assertIn(x.name, values)
+        self.assertEqual(values[buf.name][0], values[x.name] & 0xff)
+
+        # the model of x.ult(5000) also satisfies these
+        self.assertTrue(self.solver.can_be_true(cs, x.ugt(5)))
+        self.assertTrue(self.solver.can_be_true(cs, Operators.ZEXTEND(buf[0], 32) == x & 0xff))
+        self.assertTrue(self.solver.check(cs))
+        self.assertEqual(len(checks), 1)
+
+        # children and unrelated variables
+        with cs as temp_cs:
+            temp_cs.add(y == 3)
+            self.assertTrue(self.solver.can_be_true(temp_cs, x.ult(5000)))
+            self.assertEqual(len(checks), 1)
+            self.assertTrue(self.solver.can_be_true(temp_cs, y + x != 0))
+            self.assertEqual(len(checks), 2)
+            self.assertFalse(self.solver.can_be_true(temp_cs, y == 4))
+            self.assertEqual(len(checks), 3)
+
+        # a model that violates a newer constraint is not used
+        cs.add(x == values[x.name] + 1)
+        self.assertTrue(self.solver.can_be_true(cs, x.ugt(5)))
+        self.assertEqual(len(checks), 4)
+        self.assertFalse(self.solver.can_be_true(cs, x.ult(5)))
+        self.assertEqual(len(checks), 5)
+
+
+class Z3APIExpressionTest(ExpressionTest):
+    ''' Same tests, solving through the z3 Python bindings '''
+
+    def setUp(self):
+        smt_consts.solver = 'z3api'
+        self.solver = Z3APISolver()
+
+    def tearDown(self):
+        smt_consts.solver = 'z3'
+        del self.solver
+
+    def test_check_solver_min(self):
+        self.skipTest('Only the z3 process backend parses the z3 version')
+
+    def test_optimize_strategies(self):
+        self.skipTest('The z3 bindings backend always optimizes natively')
+
+    def test_check_solver_newer(self):
+        self.skipTest('Only the z3 process backend parses the z3 version')
+
+    def test_configured_backend(self):
+        self.assertIsInstance(solver.backend, Z3APISolver)
+        cs = ConstraintSet()
+        buf = cs.new_array(index_max=4)
+        cs.add(buf[0] == ord('A'))
+        cs.add(buf[1] == buf[0] + 1)
+        cs.add(buf[2] == 0)
+        cs.add(buf[3] == 0)
+        self.assertEqual(solver.get_value(cs, buf), b'AB\x00\x00')
+        self.assertEqual(len(solver.get_all_values(cs, buf)), 1)
+
+
+class PortfolioExpressionTest(ExpressionTest):
+    ''' Same tests, racing two z3 processes with different seeds '''
+
+    def setUp(self):
+        smt_consts.solver = 'portfolio'
+        self.solver = PortfolioSolver()
+
+    def tearDown(self):
+        smt_consts.solver = 'z3'
+        smt_consts.portfolio_commands = ''
+        del self.solver
+
+    def test_portfolio_first_answer_wins(self):
+        # A member that never answers must not block the query
+        smt_consts.portfolio_commands = 'sleep 60;%s -smt2 -in;not-a-solver-binary' % smt_consts.z3_bin
+        portfolio = PortfolioSolver()
+        self.assertEqual(len(portfolio._commands), 2)
+
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32)
+        cs.add(x.ugt(10))
+        self.assertTrue(portfolio.check(cs))
+        self.assertEqual(len(portfolio._procs), 1)
+        self.assertIn('-smt2', portfolio._procs[0][0])
+        self.assertEqual(portfolio.minmax(cs, x), (11, 0xffffffff))
+        self.assertFalse(portfolio.can_be_true(cs, x == 3))
+        self.assertGreaterEqual(sum(portfolio.wins.values()), 3)
+        self.assertEqual(set(portfolio.wins), {portfolio._procs[0][0]})
+
+    def test_configured_backend(self):
+        self.assertIsInstance(solver.backend, PortfolioSolver)
+        cs = ConstraintSet()
+        x = cs.new_bitvec(8)
+        cs.add(x.ult(3))
+        self.assertItemsEqual(solver.get_all_values(cs, x), [0, 1, 2])
+
+
+class QueryCacheTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        smt_consts.query_cache = True
+        query_cache.clear()
+        self.solver = Z3Solver()
+
+    def tearDown(self):
+        smt_consts.query_cache = False
+        query_cache.clear()
+        del self.solver
+
+    def test_sibling_states_share_results(self):
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32)
+        y = cs.new_bitvec(32)
+        cs.add(x.ult(10))
+        with cs as left:
+            left.add(y == 1)
+            misses = query_cache.misses
+            self.assertEqual(sorted(self.solver.get_all_values(left, x)), list(range(10)))
+            self.assertEqual(query_cache.misses, misses + 1)
+        with cs as right:
+            right.add(y == 2)
+            hits = query_cache.hits
+            self.assertEqual(sorted(self.solver.get_all_values(right, x)), list(range(10)))
+            self.assertEqual(query_cache.hits, hits + 1)
+            self.assertFalse(self.solver.can_be_true(right, x == 10))
+            self.assertFalse(self.solver.can_be_true(right, x == 10))
+            self.assertEqual(query_cache.hits, hits + 2)
+            self.assertEqual(self.solver.max(right, x), 9)
+
+    def test_variables_of_different_sorts(self):
+        # Same constraint and query text, but over variables of other sizes
+        hits = query_cache.hits
+        results = []
+        for size in (8, 32):
+            cs = ConstraintSet()
+            x = cs.new_bitvec(size, name='x')
+            a = cs.new_bitvec(size, name='a')
+            cs.add(a == x)
+            results.append(self.solver.max(cs, x))
+        self.assertEqual(results, [0xff, 0xffffffff])
+        self.assertEqual(query_cache.hits, hits)
+
+    def test_lru_eviction(self):
+        cache = QueryCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), (True, 1))
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_disk_backing(self):
+        import tempfile
+        import os
+        fd, filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            cache = QueryCache(filename=filename)
+            cache.put('key', [1, 2, 3])
+            cache = QueryCache(filename=filename)
+            self.assertEqual(cache.get('key'), (True, [1, 2, 3]))
+            self.assertEqual(cache.stats['disk_hits'], 1)
+        finally:
+            os.remove(filename)
+
+
+class HashConsTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        smt_consts.hash_cons = True
+
+    def tearDown(self):
+        smt_consts.hash_cons = False
+
+    def test_identical_operations_are_shared(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        b = cs.new_bitvec(32)
+        self.assertIs((a + 1) * b, (a + 1) * b)
+        self.assertIs(BitVecConstant(32, 7), BitVecConstant(32, 7))
+        self.assertIsNot(a + 1, b + 1)
+        self.assertIsNot(a + 1, a + 2)
+        self.assertIsNot(BitVecExtract(a, 0, 8), BitVecExtract(a, 8, 8))
+        self.assertIsNot(BitVecConstant(32, 7), BitVecConstant(32, 7, taint=('T',)))
+        self.assertIs(simplify(a + (BitVecConstant(32, 1) + 1)), a + 2)
+
+    def test_copies_are_private(self):
+        import copy
+        a = BitVecVariable(32, 'a')
+        x = a + 1
+        y = copy.copy(x)
+        self.assertIsNot(x, y)
+        y._taint |= taint_mask(('T',))
+        self.assertFalse(x.taint)
+
+    def test_unpickled_nodes_are_shared(self):
+        import pickle
+        a = BitVecVariable(32, 'a')
+        smt_consts.hash_cons = False
+        x, y = a * 3, a * 3
+        self.assertIsNot(x, y)
+        smt_consts.hash_cons = True
+        x, y = pickle.loads(pickle.dumps((x, y)))
+        self.assertIs(x, y)
+        self.assertEqual(translate_to_smtlib(x), '(bvmul a #x00000003)')
+
+    def test_disabled(self):
+        smt_consts.hash_cons = False
+        a = BitVecVariable(32, 'a')
+        self.assertIsNot(a + 1, a + 1)
+
+
+class CompactExpressionTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_no_instance_dict(self):
+        a = BitVecVariable(32, 'a')
+        for expression in (a, a + 1, BitVecConstant(32, 1000), BoolConstant(True),
+                           BitVecExtract(a, 8, 8), ArrayVariable(32, 16, 8, 'm')):
+            self.assertFalse(hasattr(expression, '__dict__'), type(expression).__name__)
+
+    def test_shared_empty_taint(self):
+        a = BitVecVariable(32, 'a')
+        b = BitVecVariable(32, 'b')
+        self.assertIs((a + b).taint, BitVecConstant(32, 1000).taint)
+        self.assertEqual((a + BitVecConstant(32, 1000, taint=('T',))).taint, frozenset(('T',)))
+
+    def test_taint_masks(self):
+        a = BitVecVariable(32, 'a', taint=('A',))
+        b = BitVecVariable(32, 'b', taint=('B', 'A'))
+        self.assertEqual(a._taint & ~b._taint, 0)
+        self.assertIs((a + b).taint, b.taint)
+        self.assertEqual(a.taint, frozenset(('A',)))
+        self.assertIs(taint_labels(taint_mask(('A', 'B'))), b.taint)
+        self.assertTrue((a + 1).is_tainted)
+        self.assertFalse(BitVecVariable(32, 'c').is_tainted)
+        self.assertEqual((a + 1 + BitVecConstant(32, 1000, taint=('C',))).taint, frozenset(('A', 'C')))
+
+    def test_small_constants_are_shared(self):
+        self.assertIs(BitVecConstant(32, 7), BitVecConstant(32, 7))
+        self.assertIsNot(BitVecConstant(32, 7), BitVecConstant(8, 7))
+        self.assertIsNot(BitVecConstant(32, 1000), BitVecConstant(32, 1000))
+        self.assertIsNot(BitVecConstant(32, 7), BitVecConstant(32, 7, taint=('T',)))
+
+    def test_pickle(self):
+        import pickle
+        a = BitVecVariable(32, 'a', taint=('T',))
+        m = ArrayVariable(32, 16, 8, 'm')
+        x = BitVecExtract(a, 8, 8) + m[BitVecConstant(32, 1000)]
+        y = pickle.loads(pickle.dumps(x))
+        self.assertEqual(translate_to_smtlib(y), translate_to_smtlib(x))
+        self.assertEqual(y.taint, frozenset(('T',)))
+        self.assertEqual((y.operands[0].begining, y.operands[0].end), (8, 15))
+        self.assertEqual(y.operands[1].array.index_max, 16)
+        self.assertIs(pickle.loads(pickle.dumps(BitVecConstant(32, 7))), BitVecConstant(32, 7))
+
+        proxy = ArrayProxy(m)
+        proxy[1] = 5
+        proxy = pickle.loads(pickle.dumps(proxy))
+        self.assertEqual(proxy.name, 'm')
+        self.assertEqual(proxy.written, {BitVecConstant(32, 1)})
+
+
+class VisitorDispatchTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_fall_through_mro(self):
+        from manticore.core.smtlib.visitors import Translator
+
+        class Names(Translator):
+            def visit_BitVecAdd(self, expression, *operands):
+                return None
+
+            def visit_Operation(self, expression, *operands):
+                return '{}({})'.format(type(expression).__name__, ','.join(operands))
+
+            def visit_Variable(self, expression):
+                return expression.name
+
+        a = BitVecVariable(32, 'a')
+        b = BitVecVariable(32, 'b')
+        translator = Names()
+        translator.visit((a + b) * a)
+        self.assertEqual(translator.result, 'BitVecMul(BitVecAdd(a,b),a)')
+        self.assertEqual(Names._dispatch(BitVecAdd), (Names.visit_BitVecAdd, Names.visit_Operation))
+        self.assertEqual(Translator._dispatch(BitVecAdd), ())
+
+    def test_shared_operands(self):
+        a = BitVecVariable(32, 'a')
+        b = a + a
+        for _ in range(10):
+            b = b * b
+        self.assertEqual(get_depth(b), 12)
+        self.assertEqual(get_variables(b), {a})
+
+
+class FreeVariablesTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_cached_and_shared(self):
+        a = BitVecVariable(32, 'a')
+        b = BitVecVariable(32, 'b')
+        x = (a + 1) * b
+        self.assertEqual(x.variables, frozenset((a, b)))
+        self.assertIs(x.variables, x.variables)
+        y = x - a
+        self.assertIs(y.variables, x.variables)
+        self.assertEqual(BitVecConstant(32, 1000).variables, frozenset())
+        self.assertEqual(get_variables(y), {a, b})
+
+    def test_arrays(self):
+        cs = ConstraintSet()
+        m = cs.new_array(name='M')
+        i = cs.new_bitvec(32, name='I')
+        m[i] = 1
+        self.assertEqual(m.variables, frozenset((m.array.array, i)))
+        self.assertEqual(m[0:2][0].variables, frozenset((m.array.array, i)))
+
+    def test_deep_chain(self):
+        m = ArrayVariable(32, None, 8, 'm')
+        i = BitVecVariable(32, 'i')
+        for n in range(20000):
+            m = ArrayStore(m, BitVecConstant(32, n), BitVecExtract(i, 0, 8))
+        self.assertEqual(len(m.variables), 2)
+
+    def test_not_copied(self):
+        import copy
+        import pickle
+        a = BitVecVariable(32, 'a')
+        b = BitVecVariable(32, 'b')
+        x = a + 1
+        self.assertEqual(x.variables, {a})
+        self.assertEqual([v.name for v in pickle.loads(pickle.dumps(x)).variables], ['a'])
+        y = copy.copy(x)
+        y._operands = (b, BitVecConstant(32, 1))
+        self.assertEqual(y.variables, {b})
+
+    def test_is_declared(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32, name='a')
+        self.assertTrue(cs.is_declared(a))
+        self.assertFalse(cs.is_declared(BitVecVariable(32, 'a')))
+        with cs as child:
+            self.assertTrue(child.is_declared(a))
+
+
+class RewriteTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.a = BitVecVariable(32, 'a')
+        self.b = BitVecVariable(8, 'b')
+        self.c = BoolVariable('c')
+
+    def assertRewrites(self, expression, expected, rules='common'):
+        from manticore.core.smtlib.visitors import rewrite
+        self.assertEqual(translate_to_smtlib(rewrite(expression, rules)), expected)
+
+    def test_extract(self):
+        from manticore.core.smtlib.expression import BitVecConcat, BitVecExtract, BitVecZeroExtend
+        a, b = self.a, self.b
+        self.assertRewrites(BitVecExtract(BitVecConcat(40, b, a), 8, 8), '((_ extract 15 8) a)')
+        self.assertRewrites(BitVecExtract(BitVecConcat(40, b, a), 32, 8), 'b')
+        self.assertRewrites(BitVecExtract(BitVecExtract(a, 8, 16), 4, 8), '((_ extract 19 12) a)')
+        self.assertRewrites(BitVecExtract(BitVecZeroExtend(64, a), 0, 16), '((_ extract 15 0) a)')
+        self.assertRewrites(BitVecExtract(BitVecZeroExtend(64, a), 32, 16), '#x0000')
+        self.assertRewrites(BitVecZeroExtend(64, BitVecZeroExtend(40, a)), '((_ zero_extend 32) a)')
+
+    def test_arithmetic(self):
+        a = self.a
+        self.assertRewrites(((a + 3) - 5) + 2, 'a')
+        self.assertRewrites((a - 3) - 5, '(bvadd a #xfffffff8)')
+        self.assertRewrites(BitVecAdd(BitVecConstant(32, 1000), a), '(bvadd a #x000003e8)')
+
+    def test_ite(self):
+        one, zero = BitVecConstant(32, 1), BitVecConstant(32, 0)
+        self.assertRewrites(BitVecITE(32, self.c, one, zero) == 0, '(not c)')
+        self.assertRewrites(BitVecITE(32, self.c, one, zero) + 2, '(ite c #x00000003 #x00000002)')
+        self.assertRewrites(BitVecITE(32, self.c, self.a, self.a), 'a')
+
+    def test_select_store(self):
+        m = ArrayVariable(32, None, 8, 'm')
+        m = ArrayStore(m, BitVecConstant(32, 1), self.b)
+        m = ArrayStore(m, BitVecConstant(32, 2), BitVecConstant(8, 7))
+        self.assertRewrites(ArraySelect(m, BitVecConstant(32, 1)), 'b')
+        self.assertRewrites(ArraySelect(m, BitVecConstant(32, 3)), '(select m #x00000003)')
+        m = ArrayStore(m, self.a, self.b)
+        self.assertRewrites(ArraySelect(m, BitVecConstant(32, 1)),
+                            '(select (store (store (store m #x00000001 b) #x00000002 #x07) a b) #x00000001)')
+
+    def test_rule_sets(self):
+        from manticore.core.smtlib.expression import BitVecConcat, BitVecExtract
+        a = self.a
+        packed = BitVecConcat(64, BitVecConstant(32, 0), a)
+        self.assertRewrites(packed, '(concat #x00000000 a)')
+        self.assertRewrites(packed, '((_ zero_extend 32) a)', rules='evm')
+        parts = BitVecConcat(32, BitVecExtract(a, 16, 16), BitVecExtract(a, 8, 8), BitVecExtract(a, 0, 8))
+        self.assertRewrites(parts, 'a', rules='native')
+        self.assertEqual(translate_to_smtlib(parts).count('extract'), 3)
+
+    def test_simplify_follows_rule_set(self):
+        from manticore.core.smtlib.expression import BitVecConcat
+        packed = BitVecConcat(64, BitVecConstant(32, 0), self.a)
+        try:
+            smt_consts.rewrite_rules = 'common'
+            self.assertEqual(translate_to_smtlib(simplify(packed)), '(concat #x00000000 a)')
+            # Not the result cached under the previous rules
+            smt_consts.rewrite_rules = 'evm'
+            self.assertEqual(translate_to_smtlib(simplify(packed)), '((_ zero_extend 32) a)')
+            smt_consts.rewrite_rules = 'none'
+            self.assertEqual(translate_to_smtlib(simplify(packed)), '(concat #x00000000 a)')
+        finally:
+            smt_consts.rewrite_rules = 'auto'
+
+    def test_custom_rules(self):
+        from manticore.core.smtlib.visitors import RewriteRules, common_rules, rewrite_rule_sets
+
+        rules = RewriteRules('test', include=(common_rules,))
+        try:
+            @rules.rule(BitVecMul, None, BitVecConstant)
+            def multiply_by_two(expression):
+                if expression.operands[1].value == 2:
+                    return expression.operands[0] + expression.operands[0]
+
+            self.assertRewrites((self.a + 0) * 2, '(bvadd a a)', rules='test')
+            self.assertRewrites(self.a * 2, '(bvmul a #x00000002)')
+        finally:
+            del rewrite_rule_sets['test']
+
+    def test_taint(self):
+        from manticore.core.smtlib.visitors import rewrite
+        a = BitVecVariable(32, 'a', taint=('A',))
+        k = BitVecConstant(32, 3, taint=('K',))
+        self.assertEqual(rewrite((a + k) - 3, 'common').taint, frozenset(('A', 'K')))
+        x = BitVecITE(32, BoolConstant(True, taint=('C',)), a + 1, a)
+        self.assertEqual(rewrite(x, 'common').taint, frozenset(('A', 'C')))
+
+
+class ArrayProxyIndexTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.cs = ConstraintSet()
+        self.memory = self.cs.new_array(index_bits=32, value_bits=8, name='M')
+        self.i = self.cs.new_bitvec(32, name='I')
+
+    def test_concrete_select_skips_concrete_stores(self):
+        memory = self.memory
+        for address in range(100):
+            memory[address] = address
+        self.assertEqual(memory[5], BitVecConstant(8, 5))
+        self.assertEqual(translate_to_smtlib(memory[200]), '(select M #x000000c8)')
+
+    def test_symbolic_store_aliases(self):
+        memory = self.memory
+        memory[1] = 1
+        memory[self.i] = 2
+        memory[3] = 3
+        self.assertEqual(memory[3], BitVecConstant(8, 3))
+        value = memory[1]
+        self.assertIsInstance(value, ArraySelect)
+        self.assertEqual(translate_to_smtlib(memory[4]), '(select (store (store M #x00000001 #x01) I #x02) #x00000004)')
+        self.assertCountEqual(solver.get_all_values(self.cs, value), [1, 2])
+
+    def test_overwritten_stores_are_dropped(self):
+        memory = self.memory
+        for n in range(200):
+            memory[n % 4] = n
+        self.assertLess(translate_to_smtlib(memory[self.i]).count('store'), 40)
+        for address in range(4):
+            self.assertEqual(memory[address].value, 196 + address)
+        self.assertCountEqual(solver.get_all_values(self.cs, memory[self.i] == 199), [True, False])
+
+    def test_copy_and_pickle(self):
+        import pickle
+        memory = self.memory
+        memory[1] = 1
+        memory[self.i] = 2
+        memory[3] = 3
+        for copy in (ArrayProxy(memory), pickle.loads(pickle.dumps(memory))):
+            copy[3] = 4
+            self.assertEqual(copy[3], BitVecConstant(8, 4))
+            self.assertEqual(memory[3], BitVecConstant(8, 3))
+            self.assertIsInstance(copy[1], ArraySelect)
+
+
+class SmtlibBindingsTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def ite_chain(self, depth):
+        x = BitVecVariable(32, 'x')
+        value = x
+        for level in range(depth):
+            value = BitVecITE(32, value == level, value + 1, value * 2)
+        return x, value
+
+    def test_shared_nodes_are_bound_once(self):
+        a = BitVecVariable(32, 'a')
+        b = BitVecVariable(32, 'b')
+        x = a + b
+        self.assertEqual(translate_to_smtlib(x * x), '(bvmul (bvadd a b) (bvadd a b))')
+        self.assertEqual(translate_to_smtlib(x * x, use_bindings=True), '(let ((a!0 (bvadd a b))) (bvmul a!0 a!0))')
+        self.assertEqual(translate_to_smtlib(x * a, use_bindings=True), '(bvmul (bvadd a b) a)')
+
+    def test_size_is_linear(self):
+        _, value = self.ite_chain(60)
+        smtlib = translate_to_smtlib(value, use_bindings=True)
+        self.assertLess(len(smtlib), 10000)
+        self.assertEqual(smtlib.count('(let '), 59)
+
+    def test_subterm_shared_by_constraints_and_query(self):
+        x = BitVecVariable(32, 'x')
+        shared = x * x + 3
+        cs = ConstraintSet()
+        cs.add(shared + shared > 10)
+        cs.add(Operators.UGT(shared * shared, 100))
+        query = shared + shared
+        for incremental in (False, True):
+            smt_consts.incremental = incremental
+            try:
+                z3 = Z3Solver()
+                self.assertTrue(z3.can_be_true(cs, query == 24))
+                self.assertFalse(z3.can_be_true(cs, query == 6))
+                with cs as child:
+                    child.add(query == 24)
+                    value = z3.get_value(child, x)
+                    self.assertEqual((value * value + 3) * 2 & 0xffffffff, 24)
+            finally:
+                smt_consts.incremental = False
+
+    def test_solver(self):
+        from manticore.core.smtlib.constraints import constraint_to_smtlib
+        x, value = self.ite_chain(60)
+        expected = evaluate(value, {'x': 5})
+        constraint = Operators.AND(value == expected, x == 5)
+        self.assertEqual(constraint_to_smtlib(value == expected).count('(let '), 59)
+        z3 = Z3Solver()
+        z3._reset(ConstraintSet().to_string())
+        z3._send(x.declaration)
+        z3._assert(constraint)
+        self.assertEqual(z3._check(), 'sat')
+        self.assertEqual(z3._model_values([value]), [expected])
+        cs = ConstraintSet()
+        cs.add(constraint)
+        self.assertEqual(z3.get_value(cs, value), expected)
+
+
+class ExpressionGuardTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def tearDown(self):
+        guard.consts.max_expression_depth = 0
+        guard.consts.max_expression_size = 0
+
+    def test_metrics(self):
+        x = BitVecVariable(32, 'x')
+        a = x + x
+        b = a * a
+        self.assertEqual((x.depth, x.tree_size), (1, 1))
+        self.assertEqual((a.depth, a.tree_size), (2, 3))
+        self.assertEqual((b.depth, b.tree_size), (3, 7))
+        m = ArrayProxy(ArrayVariable(32, 16, 8, 'm'))
+        m[b] = 1
+        self.assertEqual(m.depth, 4)
+
+    def test_oversized(self):
+        x = BitVecVariable(32, 'x')
+        value = x
+        for i in range(10):
+            value = BitVecITE(32, value == i, value, value + 1)
+        self.assertFalse(guard.oversized(value))
+        guard.consts.max_expression_depth = 30
+        self.assertFalse(guard.oversized(value))
+        guard.consts.max_expression_size = 1000
+        self.assertTrue(guard.oversized(value))
+        self.assertFalse(guard.oversized(x))
+
+    def test_abstract(self):
+        cs = ConstraintSet()
+        x = cs.new_bitvec(32, name='x')
+        value = taint_with(x * 3 + 1, 'T')
+        abstraction = guard.abstract(cs, value)
+        self.assertIsInstance(abstraction, BitVecVariable)
+        self.assertEqual(abstraction.taint, frozenset(('T',)))
+        cs.add(x == 2)
+        self.assertEqual(solver.get_value(cs, abstraction), 7)
+        self.assertIsInstance(guard.abstract(cs, x < 3), BoolVariable)
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,4 +1,5 @@
 import signal
+import sys
 import unittest
 import os
 
@@ -7,6 +8,7 @@ from multiprocessing.managers import SyncManager
 from manticore.platforms import linux
 from manticore.core.state import State
 from manticore.core.smtlib import BitVecVariable, ConstraintSet
+from manticore.core.smtlib.expression import BitVecAdd
 from manticore.core.workspace import *
 from manticore.utils.event import Eventful
 
@@ -87,6 +89,16 @@ class StateTest(unittest.TestCase):
         id_ = workspace.save_state(self.state)
         self.assertEquals(id_, 0)
 
+    def test_store_ls(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as dirname:
+            for store in (MemoryStore(), FilesystemStore(dirname)):
+                for key in ('state_00000000.pkl', 'snapshot_00000000.pkl', 'page_00'):
+                    store.save_value(key, '')
+                self.assertEqual(store.ls('state_*'), ['state_00000000.pkl'])
+                self.assertEqual(store.ls('snapshot_*'), ['snapshot_00000000.pkl'])
+                self.assertEqual(store.ls('test_*'), [])
+
     def test_output(self):
         out = ManticoreOutput('mem:')
         name = 'mytest'
@@ -111,3 +123,145 @@ class StateTest(unittest.TestCase):
         self.assertIn('messages', keys)
         self.assertIn('input', keys)
         self.assertIn('pkl', keys)
+
+    def _fork(self, workspace, values):
+        ''' Save a child of self.state per value, with the value written at the stack pointer '''
+        var = self.state.new_symbolic_value(32)
+        state_ids = []
+        with workspace.snapshot(self.state):
+            for value in values:
+                with self.state as child:
+                    child.constrain(var == value)
+                    child.cpu.write_int(child.cpu.STACK, value, 32)
+                    state_ids.append(workspace.save_state(child))
+        return state_ids
+
+    def test_snapshot_deltas(self):
+        workspace = Workspace(self.lock, 'mem:')
+        data = workspace._store._data
+        first, second = self._fork(workspace, [1, 2])
+        snapshots = [key for key in data if key.startswith('snapshot_')]
+        self.assertEqual(len(snapshots), 1)
+        # The children only hold what changed, not the memory maps
+        full = len(data[snapshots[0]])
+        self.assertLess(len(data['state_{:08x}.pkl'.format(first)]) * 10, full)
+
+        stack = self.state.cpu.STACK
+        for state_id, value in ((first, 1), (second, 2)):
+            state = workspace.load_state(state_id)
+            self.assertEqual(state.cpu.read_int(stack, 32), value)
+            self.assertEqual(len(state.constraints), len(self.state.constraints) + 1)
+            for left, right in zip(sorted(self.state.mem._maps), sorted(state.mem._maps)):
+                self.assertEqual(left.start, right.start)
+                self.assertEqual(left.end, right.end)
+
+        # The last process lineage keeps the snapshot until released
+        self.assertIn(snapshots[0], data)
+        workspace.release_snapshot()
+        self.assertEqual([key for key in data if key.startswith(('state_', 'snapshot_'))], [])
+
+    def test_snapshot_chain(self):
+        workspace = Workspace(self.lock, 'mem:')
+        data = workspace._store._data
+        first, = self._fork(workspace, [1])
+        self.state = workspace.load_state(first)
+        # A snapshot of a state loaded from a snapshot is a delta of it
+        second, = self._fork(workspace, [2])
+        snapshots = sorted(key for key in data if key.startswith('snapshot_'))
+        self.assertEqual(len(snapshots), 2)
+        self.assertLess(len(data[snapshots[1]]) * 10, len(data[snapshots[0]]))
+
+        state = workspace.load_state(second)
+        self.assertEqual(state.cpu.read_int(state.cpu.STACK, 32), 2)
+        workspace.release_snapshot()
+        self.assertEqual([key for key in data if key.startswith(('state_', 'snapshot_'))], [])
+
+    def test_snapshot_impossible_constraint(self):
+        workspace = Workspace(self.lock, 'mem:')
+        var = self.state.new_symbolic_value(32)
+        self.state.constrain(var > 1)
+        self.state.constrain(var < 10)
+        with workspace.snapshot(self.state):
+            # Replaces the two constraints with as many False ones
+            self.state.constrain(False)
+            state_id = workspace.save_state(self.state)
+
+        state = workspace.load_state(state_id)
+        self.assertEqual(str(state.constraints), str(self.state.constraints))
+        self.assertFalse(state.is_feasible())
+        workspace.release_snapshot()
+
+    def test_snapshot_reload(self):
+        workspace = Workspace(self.lock, 'mem:')
+        first, second = self._fork(workspace, [1, 2])
+        workspace.release_snapshot()
+
+        reloaded = Workspace(self.lock, workspace._store)
+        self.assertEqual(sorted(reloaded.try_loading_workspace()), [first, second])
+        data = reloaded._store._data
+        self.assertEqual(reloaded.load_state(first).cpu.read_int(self.state.cpu.STACK, 32), 1)
+        reloaded.load_state(second)
+        reloaded.release_snapshot()
+        self.assertEqual([key for key in data if key.startswith(('state_', 'snapshot_'))], [])
+
+    def test_pages(self):
+        workspace = Workspace(self.lock, 'mem:')
+        data = workspace._store._data
+        before = dict(page_stats)
+        first = workspace.save_state(self.state)
+        self.state.cpu.write_int(self.state.cpu.STACK, 0x41414141, 32)
+        second = workspace.save_state(self.state)
+        pages = [key for key in data if key.startswith('page_')]
+        report = page_report({key: count - before.get(key, 0) for key, count in page_stats.items()})
+        # Most pages are zeros, and the states share all the pages but the
+        # one of the stack written
+        self.assertEqual(report['stored_pages'], len(pages))
+        self.assertGreater(report['pages'], 2 * len(pages))
+        self.assertGreater(report['dedup_ratio'], 2)
+        self.assertGreater(report['bytes_saved'], report['page_bytes'] // 2)
+
+        state = workspace.load_state(first)
+        self.assertNotEqual(state.cpu.read_int(state.cpu.STACK, 32), 0x41414141)
+        self.assertEqual(workspace.collect_pages(), 1)
+        state = workspace.load_state(second)
+        self.assertEqual(state.cpu.read_int(state.cpu.STACK, 32), 0x41414141)
+        self.assertEqual(workspace.collect_pages(), len(pages) - 1)
+        self.assertEqual([key for key in data if key.startswith('page_')], [])
+
+    def test_fast_serialization(self):
+        store = MemoryStore(state_serialization_method='fast')
+        workspace = Workspace(self.lock, store)
+        var = self.state.new_symbolic_value(32)
+        value = var
+        for _ in range(50000):
+            value = BitVecAdd(value, var)
+        self.state.constrain(value == 1)
+        self.state.cpu.write_int(self.state.cpu.STACK, 0x41414141, 32)
+
+        # Saved whole, not as deltas of a snapshot
+        limit = sys.getrecursionlimit()
+        with workspace.snapshot(self.state):
+            state_id = workspace.save_state(self.state)
+        self.assertEqual(list(store._data), ['state_{:08x}.pkl'.format(state_id)])
+        self.assertEqual(sys.getrecursionlimit(), limit)
+
+        state = workspace.load_state(state_id)
+        self.assertEqual(state.cpu.read_int(state.cpu.STACK, 32), 0x41414141)
+        self.assertEqual(len(state.constraints), len(self.state.constraints))
+        self.assertEqual(state.constraints.constraints[-1].depth, 50002)
+        self.assertEqual(state.constraints.constraints[-1].taint, frozenset())
+
+    def test_fast_serialization_slices(self):
+        store = MemoryStore(state_serialization_method='fast')
+        workspace = Workspace(self.lock, store)
+        data = self.state.new_symbolic_buffer(16, taint=('T',))
+        # Like the calldata[:4] of EVM
+        self.state.context['view'] = data[4:8]
+        self.state.constrain(self.state.context['view'][0] == 0x41)
+
+        state = workspace.load_state(workspace.save_state(self.state))
+        view = state.context['view']
+        self.assertEqual(len(view), 4)
+        self.assertEqual(view.taint, frozenset({'T'}))
+        self.assertEqual(view.underlying_variable.name, data.underlying_variable.name)
+        self.assertEqual(state.solve_one(view[0]), 0x41)